@@ -1,31 +1,27 @@
-import os
 import threading
-import time
 
 import pygame
 
-from util import make_path
+from constants import HARP_CHANNELS
+from events import CHORD, HARP
+from scheduler import PlaybackScheduler
+from sound_bank import get_sound_bank, init_mixer
 
 
-#
-# {
-#    C: { chord, h1, h2, h3, ... }
-#    Bb: { chord, h1, h2, h3, ... }
-# }
-
 class AudioManager:
-    def __init__(self, window, slow_down_chord=1.0, slow_down_harp=1.0):
-        pygame.mixer.init(frequency=44100, size=-16, channels=2, buffer=512)
+    def __init__(self, window, slow_down_chord=1.0, slow_down_harp=1.0, bank=None, clock=None):
+        # the bank lives for the whole process, so Stop/Start does not decode everything again
+        self.bank = bank if bank is not None else get_sound_bank()
+        init_mixer()
 
         self.window = window
-        self.dict = {}
         self.current_chord_name = None
 
         # single channel for chord playback
         self.chord_channel = pygame.mixer.Channel(0)
 
         # multiple channels for harp playback
-        self.harp_channels = [pygame.mixer.Channel(i) for i in range(1, 8)]
+        self.harp_channels = [pygame.mixer.Channel(i) for i in range(1, HARP_CHANNELS + 1)]
         self.harp_channel_index = 0
 
         # control
@@ -36,36 +32,8 @@ class AudioManager:
         self.slow_down_chord = slow_down_chord
         self.slow_down_harp = slow_down_harp
 
-        self._read_all_from_sounds_folder()
-
-    def _read_all_from_sounds_folder(self):
-        """Load all audio files from the sounds folder"""
-        sounds_folder = make_path("sounds")
-        chords = [f for f in os.listdir(sounds_folder)
-                  if os.path.isdir(os.path.join(sounds_folder, f))]
-
-        for chord in chords:
-            chord_path = os.path.join(sounds_folder, chord)
-            files = [f for f in os.listdir(chord_path) if f.endswith('.ogg')]
-
-            self.dict[chord] = {}
-
-            for file in files:
-                file_path = os.path.join(chord_path, file)
-
-                try:
-                    sound = pygame.mixer.Sound(file_path)
-
-                    if file.endswith('chord.ogg'):
-                        self.dict[chord]['chord'] = sound
-                    else:
-                        harp_note = file.replace(chord, '', 1).replace('.ogg', '')
-                        self.dict[chord][harp_note] = sound
-
-                except Exception as e:
-                    print(f"Error loading {file_path}: {e}")
-
-        print(f"Loaded {len(self.dict)} chords")
+        # a single timeline for every note, shared by audio and display
+        self.scheduler = PlaybackScheduler(clock=clock)
 
     def play_chord(self, token):
         """Play a chord on loop"""
@@ -76,19 +44,19 @@ class AudioManager:
             if self.chord_playing:
                 self.chord_channel.stop()
 
-            if token not in self.dict or 'chord' not in self.dict[token]:
+            chord_sound = self.bank.sound(token)
+            if chord_sound is None:
                 print(f"Chord {token} not found.")
                 return
 
-            chord_sound = self.dict[token]['chord']
             self.current_chord_name = token
 
             self.chord_channel.play(chord_sound, loops=-1)
             self.chord_playing = True
             self.current_chord_name = token
 
-    def play_harp(self, token):
-        """Play a harp note once using one of the harp channels"""
+    def play_harp(self, harp):
+        """Play a harp note once using one of the harp channels. H1 is harp 0, like the files"""
         if not self.window.is_playing:
             return
 
@@ -96,15 +64,9 @@ class AudioManager:
             print("No chord is currently playing. Cannot play harp note.")
             return
 
-        try:
-            harp_key = str(int(token) - 1)  # although H1 is the first harp, the files start on 0
-        except ValueError:
-            print(f"Invalid harp token: {token}")
-            return
-
-        harp_sound = self.dict[self.current_chord_name].get(harp_key)
+        harp_sound = self.bank.sound(self.current_chord_name, harp)
         if harp_sound is None:
-            print(f"Harp note {token} not found for chord {self.current_chord_name}")
+            print(f"Harp note {harp + 1} not found for chord {self.current_chord_name}")
             return
 
         # get the next available harp channel so we dont stop the currently playing harp
@@ -113,37 +75,32 @@ class AudioManager:
 
         channel.play(harp_sound, loops=0)
 
-    def interpret_sequence(self, text):
-        """Interprets a sequence of tokens generated by the model"""
-        tokens = text.split()
-        for token in tokens:
-            if not self.window.is_playing:
-                break
-
-            if '_' not in token:
-                continue
-
-            parts = token.split('_')
-            if len(parts) != 2:
-                continue
-
-            name, duration_str = parts
-            try:
-                duration_ms = int(duration_str)
-            except ValueError:
-                print(f"Invalid duration in token: {token}")
-                continue
-
-            if name in self.dict:
-                self.play_chord(name)
-                time.sleep(duration_ms * self.slow_down_chord / 1000.0)
-            elif name.startswith('H'):
-                harp_note = name[1:]
-                self.play_harp(harp_note)
-                time.sleep(duration_ms * self.slow_down_harp / 1000.0)
-            else:
-                print(f"Unknown token: {token}")
-                raise ValueError(f"Unknown chord name: {name}")
+    def duration_of(self, event):
+        """How long an event lasts in seconds, with the current slowdowns"""
+        if event.kind == CHORD:
+            return event.duration_ms * self.slow_down_chord / 1000.0
+        return event.duration_ms * self.slow_down_harp / 1000.0
+
+    def play_events(self, events, on_event=None, should_continue=None):
+        """
+        Plays a sequence of TokenEvents generated by the model.
+        Notes are dispatched by the scheduler's clock, and `on_event(index, event)` fires on the same timeline.
+        """
+
+        def dispatch(i, event):
+            if event.kind == CHORD:
+                self.play_chord(event.name)
+            elif event.kind == HARP:
+                self.play_harp(event.harp)
+            if on_event is not None:
+                on_event(i, event)
+
+        def keep_playing():
+            if should_continue is not None and not should_continue():
+                return False
+            return self.window.is_playing
+
+        return self.scheduler.play(events, dispatch, self.duration_of, keep_playing)
 
     def stop_all(self):
         """Stop all audio playback"""
@@ -153,12 +110,43 @@ class AudioManager:
                 channel.stop()
             self.chord_playing = False
             self.current_chord_name = None
+            self.scheduler.reset()
             print("Stopped all audio")
 
     def __del__(self):
-        """Clean up pygame mixer resources"""
+        """Stop our channels; the mixer itself belongs to the sound bank and stays up"""
         try:
             self.stop_all()
-            pygame.mixer.quit()
         except:
             pass
+
+
+class NullAudioManager(AudioManager):
+    """
+    Same timeline and callbacks as AudioManager, but nothing is played.
+    Needs neither the mixer nor the sound files, for headless runs like replay.py
+    """
+
+    def __init__(self, window, slow_down_chord=1.0, slow_down_harp=1.0, clock=None):
+        self.window = window
+        self.current_chord_name = None
+        self.chord_playing = False
+        self.lock = threading.Lock()
+
+        self.slow_down_chord = slow_down_chord
+        self.slow_down_harp = slow_down_harp
+
+        self.scheduler = PlaybackScheduler(clock=clock)
+
+    def play_chord(self, token):
+        self.current_chord_name = token
+        self.chord_playing = True
+
+    def play_harp(self, harp):
+        pass
+
+    def stop_all(self):
+        with self.lock:
+            self.chord_playing = False
+            self.current_chord_name = None
+            self.scheduler.reset()
@@ -0,0 +1,250 @@
+import threading
+import time
+
+import numpy as np
+import pygame
+
+from constants import STREAM_CHUNK_FRAMES
+from events import CHORD
+from offline_render import OfflineRenderer, VoiceState
+from scheduler import PlaybackScheduler
+from sound_bank import get_sound_bank, init_mixer
+
+
+class PygameSink:
+    """Streams pcm chunks through a single mixer channel: one chunk plays while the next one waits in its queue"""
+
+    def __init__(self, channel=0, timeout=1.0):
+        init_mixer()
+        self.channel = pygame.mixer.Channel(channel)
+        self.timeout = timeout
+
+        # a single silent frame, queued in place of a chunk that should not play after all
+        self._silence = None
+
+    def wait_for_room(self):
+        """Blocks until nothing waits in the queue, i.e. the last chunk written is the one playing"""
+        deadline = time.monotonic() + self.timeout
+        while self.channel.get_queue() is not None:
+            if time.monotonic() > deadline:
+                raise TimeoutError("Audio channel did not start the queued chunk in time")
+            time.sleep(0.001)
+
+    def write(self, pcm):
+        sound = pygame.mixer.Sound(buffer=np.ascontiguousarray(pcm))
+        # queueing over a queued chunk would replace it, wait until the playing one hands over
+        self.wait_for_room()
+        if not self.channel.get_busy():
+            self.channel.play(sound)
+        else:
+            self.channel.queue(sound)
+
+    def drop_queued(self):
+        """Takes back the chunk waiting in the queue. Returns False if there was none, it already plays"""
+        if self.channel.get_queue() is None:
+            return False
+        if self._silence is None:
+            self._silence = pygame.mixer.Sound(buffer=np.zeros((1, 2), dtype=np.int16))
+        self.channel.queue(self._silence)
+        return True
+
+    def stop(self):
+        self.channel.stop()
+
+
+class NullSink:
+    """Takes chunks without playing them, for headless runs. With `keep` the chunks are stored for inspection"""
+
+    def __init__(self, keep=False):
+        self.keep = keep
+        self.chunks = []
+        self.frames = 0
+
+    def wait_for_room(self):
+        pass
+
+    def write(self, pcm):
+        self.frames += len(pcm)
+        if self.keep:
+            self.chunks.append(pcm)
+
+    def drop_queued(self):
+        return False
+
+    def stop(self):
+        pass
+
+
+class StreamingAudioManager:
+    """
+    Same interface as AudioManager, but sequences are mixed ahead of time into fixed-size pcm chunks
+    streamed to a single sink. Notes land on exact sample positions, and playback wakes up once per chunk
+    instead of once per note. `on_event` fires once the chunk holding the note is the one playing.
+    """
+
+    def __init__(self, window, slow_down_chord=1.0, slow_down_harp=1.0, bank=None, clock=None, sink=None,
+                 chunk_frames=STREAM_CHUNK_FRAMES):
+        self.bank = bank if bank is not None else get_sound_bank()
+        self.window = window
+        self.renderer = OfflineRenderer(self.bank, slow_down_chord, slow_down_harp)
+        self.rate = self.renderer.rate
+        self.sink = sink if sink is not None else PygameSink()
+        self.chunk_frames = chunk_frames
+
+        self.lock = threading.Lock()
+        # paces the chunks: each one is due when the previous one ends
+        self.scheduler = PlaybackScheduler(clock=clock)
+        self._reset_stream()
+
+    # slowdowns apply from the next sequence on, the current one is already on the timeline
+    @property
+    def slow_down_chord(self):
+        return self.renderer.slow_down_chord
+
+    @slow_down_chord.setter
+    def slow_down_chord(self, value):
+        self.renderer.slow_down_chord = value
+
+    @property
+    def slow_down_harp(self):
+        return self.renderer.slow_down_harp
+
+    @slow_down_harp.setter
+    def slow_down_harp(self, value):
+        self.renderer.slow_down_harp = value
+
+    @property
+    def current_chord_name(self):
+        return self._state.chord_name
+
+    def _reset_stream(self):
+        # voices that may still sound at or after the written position, in stream frames
+        self._voices = []
+        # frames handed to the sink so far, and where the scheduled sequences end
+        self._written = 0
+        self._end = 0
+        # (voice, name) of the chord loops placed since the last cut, the last one keeps looping
+        self._chords = []
+        # the chord and harp rotation the next sequence continues from
+        self._state = VoiceState(self.renderer.harp_channels)
+
+    def duration_of(self, event):
+        """How long an event lasts in seconds, with the current slowdowns"""
+        if event.kind == CHORD:
+            return event.duration_ms * self.slow_down_chord / 1000.0
+        return event.duration_ms * self.slow_down_harp / 1000.0
+
+    def _place(self, events):
+        """Puts a sequence on the stream right after the previous one, returns the start frame of each event"""
+        starts, length = self.renderer.frames(events)
+        offset = self._end
+        voices, _ = self.renderer.voices(events, self._state, offset=offset)
+
+        names = [e.name for e in events if e.kind == CHORD and self.bank.pcm(e.name) is not None]
+        chords = list(zip([v for v in voices if v.loop], names))
+        if self._chords:
+            # the chord of the previous sequence loops on until this one changes it
+            self._chords[-1][0].end = chords[0][0].start if chords else offset + length
+        if chords:
+            self._chords = self._chords[-1:] + chords
+
+        self._voices.extend(voices)
+        self._end = offset + length
+        return starts + offset
+
+    def _write(self, start, end):
+        """Mixes [start, end) of the stream and hands it to the sink, once the chunk before it is playing"""
+        # outside the lock, so stop_all does not wait for the playing chunk to end
+        self.sink.wait_for_room()
+        with self.lock:
+            mixed = self.renderer.mix(self._voices, start, end)
+            last_chord = self._chords[-1][0] if self._chords else None
+            # voices still sounding in this chunk stay, in case it is taken back and mixed again
+            self._voices = [v for v in self._voices if v.end > start or v is last_chord]
+            self._written = end
+            self.sink.write(np.clip(mixed, -32768, 32767).astype(np.int16))
+
+    def _truncate(self, heard):
+        """Playback stopped inside a sequence: nothing after `heard` plays, the next sequence starts there"""
+        with self.lock:
+            self._written = heard
+            self._end = heard
+            self._voices = [v for v in self._voices if v.start < heard]
+            self._chords = [c for c in self._chords if c[0].start < heard][-1:]
+            self._state.chord_name = self._chords[-1][1] if self._chords else None
+            # harp notes taken back no longer sound, later ones do not cut them
+            harps = self._state.harp_voices
+            for channel, voice in enumerate(harps):
+                if voice is not None and voice.start >= heard:
+                    harps[channel] = None
+
+    def play_events(self, events, on_event=None, should_continue=None):
+        """
+        Plays a sequence of TokenEvents generated by the model. One chunk is always queued ahead of the one
+        playing, and `on_event(index, event)` fires for the notes of a chunk once it is the one playing.
+        """
+        if not self.window.is_playing:
+            return False
+
+        with self.lock:
+            starts = self._place(events).tolist()
+            chunks = [(pos, min(pos + self.chunk_frames, self._end))
+                      for pos in range(self._written, self._end, self.chunk_frames)]
+            if len(chunks) > 1 and chunks[-1][1] - chunks[-1][0] < self.chunk_frames // 2:
+                # a sliver at the end would leave the next sequence almost no time to be queued behind it
+                chunks[-2:] = [(chunks[-2][0], chunks[-1][1])]
+
+        # the last chunk handed to the sink, and the last one whose notes were reported
+        written = -1
+        reported = -1
+        if chunks:
+            # queued behind the end of the previous sequence, so there is no gap between them
+            self._write(*chunks[0])
+            written = 0
+
+        next_note = 0
+
+        def dispatch(i, chunk):
+            nonlocal next_note, written, reported
+            # the sink takes the next chunk once this one left the queue, so its notes are audible from here
+            if i + 1 < len(chunks):
+                self._write(*chunks[i + 1])
+                written = i + 1
+            else:
+                self.sink.wait_for_room()
+            reported = i
+            while next_note < len(events) and starts[next_note] < chunk[1]:
+                if on_event is not None:
+                    on_event(next_note, events[next_note])
+                next_note += 1
+
+        def keep_playing():
+            if should_continue is not None and not should_continue():
+                return False
+            return self.window.is_playing
+
+        finished = self.scheduler.play(chunks, dispatch, lambda chunk: (chunk[1] - chunk[0]) / self.rate,
+                                       keep_playing)
+        if not finished:
+            heard = self._written
+            if written > reported:
+                # its notes were never reported: take it back from the queue, or silence it if it already started
+                if not self.sink.drop_queued():
+                    self.sink.stop()
+                heard = chunks[written][0]
+            self._truncate(heard)
+        return finished
+
+    def stop_all(self):
+        """Stop all audio playback"""
+        with self.lock:
+            self.sink.stop()
+            self.scheduler.reset()
+            self._reset_stream()
+            print("Stopped all audio")
+
+    def __del__(self):
+        try:
+            self.stop_all()
+        except:
+            pass
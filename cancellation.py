@@ -0,0 +1,19 @@
+import threading
+
+
+class GenerationCancelled(Exception):
+    """Raised by generate when its cancel token fires"""
+    pass
+
+
+class CancelToken:
+    """Checked by generate between steps, so a running generation can be abandoned right away"""
+
+    def __init__(self):
+        self._event = threading.Event()
+
+    def cancel(self):
+        self._event.set()
+
+    def cancelled(self):
+        return self._event.is_set()
@@ -1,5 +1,6 @@
 # this file contains important constants used across the project.
 # feel free to mess w them
+import os
 
 # how many tokens should we use when continuing generation from a given prompt
 TOKEN_CUTOFF_FOR_GEN = 20
@@ -18,3 +19,76 @@ CHORD_SLOWDOWN = 1.2
 INITIAL_PROMPT = "c_200"
 # amount of tokens to be kept in the history array
 HISTORY_TOKEN_CUTOFF = 1024
+
+# sample rate used by the mixer and every decoded sound
+SAMPLE_RATE = 44100
+# folder where omnisong keeps files it generates at runtime (caches, sessions, ...)
+CACHE_DIR = os.path.join(os.path.expanduser("~"), ".omnisong")
+# packed pcm of the whole sound bank, memory-mapped on later launches
+SOUND_CACHE_FILE = os.path.join(CACHE_DIR, "sounds.pcm")
+# decode each chord only when it is first played instead of the whole bank upfront
+SOUND_BANK_LAZY = False
+# threads used to decode the sound bank
+SOUND_BANK_WORKERS = 8
+# the scheduler wakes this early before a note is due and spins the rest, to bound jitter
+SCHEDULER_LOOKAHEAD_MS = 2
+# if playback falls behind its timeline by more than this, the timeline restarts instead of rushing notes
+SCHEDULER_RESYNC_MS = 250
+# how many mixer channels are used round-robin for harp notes
+HARP_CHANNELS = 7
+# extra seconds of audio kept ahead of playback on top of the time it takes to generate the next chunk
+LOOKAHEAD_MARGIN_SECONDS = 1.5
+# generation chunks are sized to take about this long to generate (capped by the max length slider)
+LOOKAHEAD_CHUNK_COMPUTE_SECONDS = 1.0
+# never generate chunks shorter than this
+LOOKAHEAD_MIN_CHUNK = 16
+# run the model in a separate process so inference never competes with audio for the GIL
+INFERENCE_IN_SUBPROCESS = False
+# token ids the shared-memory ring between the inference process and the app can hold
+INFERENCE_RING_CAPACITY = 4096
+# the inference process hands generated ids over in batches this size, while it keeps sampling
+INFERENCE_STREAM_BATCH = 8
+# seconds to wait for the inference process to load the model
+INFERENCE_WORKER_TIMEOUT = 120
+# seconds a request may go without a word from the inference process before it is considered hung and restarted
+INFERENCE_REQUEST_TIMEOUT = 10
+# how often the currently playing view and status bar pick up playback progress, in ms (about one display frame)
+DISPLAY_REFRESH_MS = 16
+# a sampling slider must rest this long before the look-ahead is dropped, so a drag cuts playback once
+PARAMS_DEBOUNCE_MS = 300
+# the history is saved here on exit and restored on the next launch
+SESSION_FILE = os.path.join(CACHE_DIR, "session.bin")
+# record a timestamped trace of generation, playback and ui events, written to TRACE_FILE on exit (see replay.py)
+TRACE_ENABLED = False
+TRACE_FILE = os.path.join(CACHE_DIR, "trace.jsonl")
+# fine-tuned adapter (see FINETUNE in train.py) merged into omni.pth when the model loads, None for the base model
+ADAPTER_FILE = None
+# torch threads for cpu inference, None picks them from the core count (and a calibration run)
+INFERENCE_THREADS = None
+# torch inter-op threads, generation runs one op after another so more rarely helps
+INFERENCE_INTEROP_THREADS = 1
+# cores kept free of inference for playback and the ui
+RESERVED_CORES = 2
+# pin inference to the non-reserved cores and playback to the reserved ones (linux only)
+PIN_INFERENCE = False
+# measure tokens/sec and wakeup jitter for a few thread counts at startup and keep the best trade-off
+GOVERNOR_CALIBRATE = True
+# worst wakeup lateness (p99) a calibration candidate may cause, in ms
+GOVERNOR_JITTER_BUDGET_MS = 2.0
+# mix upcoming notes into pcm chunks streamed to a single mixer channel instead of starting each note from python
+AUDIO_STREAMING = False
+# frames per streamed chunk (4096 is about 93 ms): playback wakes up once per chunk, and up to two chunks are
+# already committed to the sink when a look-ahead chunk is cut
+STREAM_CHUNK_FRAMES = 4096
+# keep pre-generated continuations on disk, so Start and Clear History play right away instead of waiting for
+# a generation from a cold prompt. the pool is filled in the background while the app is stopped
+CONTINUATION_POOL = True
+POOL_DIR = os.path.join(CACHE_DIR, "pool")
+# continuations kept on disk, the least recently used prompts are evicted first
+POOL_MAX_ENTRIES = 64
+# continuations kept ready per prompt and sampling settings
+POOL_PER_KEY = 2
+# tokens in a pooled continuation
+POOL_SEQUENCE_LENGTH = 64
+# the pool is only filled while the 1 minute load average per core is under this
+POOL_IDLE_LOAD = 0.5
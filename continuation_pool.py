@@ -0,0 +1,152 @@
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+from constants import POOL_DIR, POOL_MAX_ENTRIES
+from metrics import metrics
+
+POOL_SUFFIX = ".ids"
+
+
+def pool_key(model, prompt_ids, temperature, top_p):
+    """
+    Identifies the continuations of a prompt tail, generated by a model with some sampling settings.
+    `model` is the engine's identity, so a checkpoint swapped in with the same vocabulary gets keys of its own
+    """
+    text = f"{model}|{temperature:.2f}|{top_p:.2f}|" + ",".join(str(int(i)) for i in prompt_ids)
+    return hashlib.sha1(text.encode()).hexdigest()
+
+
+class ContinuationPool:
+    """
+    Pre-generated continuations kept on disk, one int32 file per sequence, so Start can play right away
+    instead of waiting for a generation from a cold prompt. A continuation is used once and then deleted.
+    Past `max_entries`, the continuations of the least recently used key go first; file times keep that
+    order across launches.
+    """
+
+    def __init__(self, directory=POOL_DIR, max_entries=POOL_MAX_ENTRIES):
+        self.directory = directory
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+
+        # key -> paths, oldest first. keys are in least recently used order
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._load()
+
+    def _load(self):
+        try:
+            names = [name for name in os.listdir(self.directory) if name.endswith(POOL_SUFFIX)]
+        except OSError:
+            return
+
+        files = []
+        for name in names:
+            path = os.path.join(self.directory, name)
+            try:
+                files.append((os.path.getmtime(path), path, name.split(".", 1)[0]))
+            except OSError:
+                pass
+
+        for _, path, key in sorted(files):
+            self._entries.setdefault(key, []).append(path)
+            self._entries.move_to_end(key)
+
+    def __len__(self):
+        with self._lock:
+            return sum(len(paths) for paths in self._entries.values())
+
+    def count(self, key):
+        with self._lock:
+            return len(self._entries.get(key, ()))
+
+    def put(self, key, ids):
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, f"{key}.{time.time_ns()}{POOL_SUFFIX}")
+        tmp_path = path + ".tmp"
+        np.asarray(ids, dtype=np.int32).tofile(tmp_path)
+        os.replace(tmp_path, path)
+
+        with self._lock:
+            self._entries.setdefault(key, []).append(path)
+            self._entries.move_to_end(key)
+            evicted = self._evict()
+        for old_path in evicted:
+            self._remove(old_path)
+        metrics.set("pool.entries", len(self))
+
+    def take(self, key):
+        """Removes and returns the oldest continuation for `key`, None on a miss"""
+        with self._lock:
+            paths = self._entries.get(key)
+            if paths:
+                path = paths.pop(0)
+                if paths:
+                    self._entries.move_to_end(key)
+                else:
+                    del self._entries[key]
+                remaining = list(paths)
+            else:
+                path = None
+
+        ids = None
+        if path is not None:
+            try:
+                ids = np.fromfile(path, dtype=np.int32).tolist()
+            except OSError:
+                pass
+            self._remove(path)
+            # the other continuations of this prompt were just used too, as far as eviction goes
+            for other in remaining:
+                try:
+                    os.utime(other)
+                except OSError:
+                    pass
+
+        with self._lock:
+            if ids:
+                self.hits += 1
+            else:
+                self.misses += 1
+            metrics.set("pool.hits", self.hits)
+            metrics.set("pool.misses", self.misses)
+            metrics.set("pool.hit_rate", self.hits / (self.hits + self.misses))
+        return ids or None
+
+    def _evict(self):
+        """Pops continuations of the least recently used keys until the pool fits. Returns their paths"""
+        evicted = []
+        total = sum(len(paths) for paths in self._entries.values())
+        while total > self.max_entries and self._entries:
+            key, paths = next(iter(self._entries.items()))
+            evicted.append(paths.pop(0))
+            if not paths:
+                del self._entries[key]
+            total -= 1
+        return evicted
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    """Returns the process-wide continuation pool"""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ContinuationPool()
+        return _pool
@@ -0,0 +1,196 @@
+import os
+import threading
+
+import torch
+
+from constants import INFERENCE_THREADS, INFERENCE_INTEROP_THREADS, RESERVED_CORES, PIN_INFERENCE, \
+    GOVERNOR_CALIBRATE, GOVERNOR_JITTER_BUDGET_MS
+from metrics import metrics
+from model.benchmark import generation_speed
+from scheduler import MonotonicClock
+
+
+def available_cores():
+    """The cores this process may run on"""
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+def _pin(cores):
+    """
+    Pins the calling thread (and the threads it starts later) to `cores`. Linux only, False elsewhere.
+    Threads that already exist keep their affinity: torch's intra-op pool is made by the first thread
+    that runs a parallel op, so it only follows if that thread was pinned before
+    """
+    if not cores or not hasattr(os, "sched_setaffinity"):
+        return False
+    try:
+        os.sched_setaffinity(0, cores)
+        return True
+    except OSError:
+        return False
+
+
+class JitterProbe(threading.Thread):
+    """Sleeps to a deadline every few ms like the playback thread does and records how late it wakes up"""
+
+    def __init__(self, interval_ms=5.0, cores=None):
+        super().__init__(daemon=True, name="jitter-probe")
+        self.interval = interval_ms / 1000.0
+        self.cores = cores
+        self.lateness = []
+        self._stop_event = threading.Event()
+
+    def run(self):
+        if self.cores:
+            _pin(self.cores)
+        clock = MonotonicClock()
+        deadline = clock.now() + self.interval
+        while not self._stop_event.is_set():
+            clock.sleep_until(deadline)
+            self.lateness.append(clock.now() - deadline)
+            deadline += self.interval
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+    def p99_ms(self):
+        if not self.lateness:
+            return 0.0
+        ordered = sorted(self.lateness)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * 0.99))] * 1000.0
+
+
+class CpuGovernor:
+    """
+    Decides how many cores cpu inference gets, so torch's thread pool does not starve playback and the ui.
+    RESERVED_CORES are kept out of inference; INFERENCE_THREADS (or a calibration run) sets the torch thread
+    count, and with PIN_INFERENCE the inference thread is pinned to the remaining cores.
+    Until a calibration finishes, inference runs with the provisional count: INFERENCE_THREADS, or every
+    inference core. A calibration that overlaps playback measures under that load.
+    """
+
+    def __init__(self, threads=INFERENCE_THREADS, interop_threads=INFERENCE_INTEROP_THREADS,
+                 reserved=RESERVED_CORES, pin=PIN_INFERENCE, calibrate=GOVERNOR_CALIBRATE,
+                 jitter_budget_ms=GOVERNOR_JITTER_BUDGET_MS):
+        cores = available_cores()
+        # never reserve every core, inference needs at least one
+        reserved = min(reserved, len(cores) - 1)
+        self.reserved_cores = cores[:reserved]
+        self.inference_cores = cores[reserved:]
+
+        self.threads = threads if threads is not None else len(self.inference_cores)
+        self.interop_threads = interop_threads
+        self.pin = pin
+        self.calibrate = calibrate and threads is None
+        self.jitter_budget_ms = jitter_budget_ms
+
+        # (threads, tokens/sec, probe jitter p99 ms) of every calibration candidate
+        self.calibration = []
+        self._configured = False
+        self._lock = threading.Lock()
+        # set once the thread count is final
+        self._settled = threading.Event()
+
+    def _candidates(self):
+        counts = []
+        n = 1
+        while n < len(self.inference_cores):
+            counts.append(n)
+            n *= 2
+        counts.append(len(self.inference_cores))
+        return counts
+
+    def _calibrate(self, model, vocab_size):
+        """Measures tokens/sec and playback-like wakeup jitter for a few thread counts, picks the best trade-off"""
+        for count in self._candidates():
+            torch.set_num_threads(count)
+            probe = JitterProbe(cores=self.reserved_cores if self.pin else None)
+            probe.start()
+            try:
+                speed = generation_speed(model, vocab_size, steps=32)
+            finally:
+                probe.stop()
+            self.calibration.append((count, speed, probe.p99_ms()))
+
+        within_budget = [c for c in self.calibration if c[2] <= self.jitter_budget_ms]
+        if not within_budget:
+            # nothing keeps the jitter down, take whatever hurts playback least
+            return min(self.calibration, key=lambda c: c[2])[0]
+        best = max(c[1] for c in within_budget)
+        # the fewest threads that get close to the best speed, the rest of the cores stay free
+        return min(c[0] for c in within_budget if c[1] >= best * 0.9)
+
+    def configure(self, model=None, vocab_size=None, wait=True):
+        """
+        Settles the thread counts once per process, calibrating against `model` if allowed.
+        The first caller runs the calibration. Later callers wait for it, or with `wait=False` go on with
+        the provisional count and pick up the final one through apply_to_inference_thread.
+        """
+        with self._lock:
+            calibrate = False
+            if not self._configured:
+                self._configured = True
+                try:
+                    # only possible before torch runs any inter-op work
+                    torch.set_num_interop_threads(self.interop_threads)
+                except RuntimeError:
+                    pass
+                torch.set_num_threads(self.threads)
+
+                on_cpu = model is not None and next(model.parameters()).device.type == "cpu"
+                calibrate = self.calibrate and on_cpu and len(self.inference_cores) > 1
+                if not calibrate:
+                    self._settled.set()
+                    self.publish()
+
+        if calibrate:
+            # outside the lock, it takes a few seconds
+            threads = self._calibrate(model, vocab_size)
+            self.threads = threads
+            torch.set_num_threads(threads)
+            self._settled.set()
+            self.publish()
+        elif wait:
+            self._settled.wait()
+
+    def apply_to_inference_thread(self):
+        """Called from the thread that runs the model, again whenever `threads` changed"""
+        torch.set_num_threads(self.threads)
+        pinned = _pin(self.inference_cores) if self.pin else False
+        metrics.set("governor.inference_pinned", pinned)
+
+    def apply_to_realtime_thread(self):
+        """Called from playback: it gets the reserved cores, where inference never runs"""
+        if self.pin and self.reserved_cores:
+            _pin(self.reserved_cores)
+
+    def settings(self):
+        return {
+            "threads": self.threads,
+            "interop_threads": self.interop_threads,
+            "inference_cores": self.inference_cores,
+            "reserved_cores": self.reserved_cores,
+            "pinned": self.pin,
+            "calibration": self.calibration,
+        }
+
+    def publish(self, settings=None):
+        """Puts the settings in the metrics, `settings` comes from a governor in another process"""
+        for name, value in (settings or self.settings()).items():
+            metrics.set(f"governor.{name}", value)
+
+
+_governor = None
+_governor_lock = threading.Lock()
+
+
+def get_governor():
+    """Returns the process-wide governor"""
+    global _governor
+    with _governor_lock:
+        if _governor is None:
+            _governor = CpuGovernor()
+        return _governor
@@ -0,0 +1,320 @@
+import argparse
+import json
+import math
+import multiprocessing
+import os
+import time
+
+import numpy as np
+import torch
+from torch.utils.data import DataLoader
+
+from model.checkpoint import load_checkpoint
+from model.dataset import MusicDataset
+from model.device import device
+from model.grammar_mask import GrammarChecker, is_chord, MAX_HARP_RUN
+
+EVAL_SEQ_LENGTH = 64
+# windows overlap by seq_length - stride tokens, so every scored token sees at least that much context
+EVAL_STRIDE = 32
+EVAL_BATCH_SIZE = 256
+# bytes of the token file read at a time
+EVAL_BLOCK_BYTES = 8 * 1024 * 1024
+
+
+def read_token_blocks(path, start=0, end=None, block_bytes=EVAL_BLOCK_BYTES):
+    """
+    Streams whitespace separated tokens from the byte range [start, end) of a file, a block at a time.
+    A token belongs to the range it starts in, so shards never split or repeat a token.
+    """
+    with open(path, "rb") as f:
+        if start > 0:
+            f.seek(start - 1)
+            if not f.read(1).isspace():
+                # we landed in the middle of a token owned by the previous shard, skip it
+                while True:
+                    byte = f.read(1)
+                    if not byte or byte.isspace():
+                        break
+        position = f.tell()
+
+        leftover = b""
+        while end is None or position < end:
+            size = block_bytes if end is None else min(block_bytes, end - position)
+            block = f.read(size)
+            if not block:
+                break
+            position += len(block)
+
+            if end is not None and position >= end and not block[-1:].isspace():
+                # finish the token that crosses the end of our range
+                while True:
+                    byte = f.read(1)
+                    if not byte or byte.isspace():
+                        break
+                    block += byte
+
+            data = leftover + block
+            if end is not None and position >= end:
+                leftover = b""
+            else:
+                # the last token may continue in the next block
+                cut = max(data.rfind(b" "), data.rfind(b"\n"), data.rfind(b"\t"), data.rfind(b"\r"))
+                leftover = data[cut + 1:]
+                data = data[:cut + 1]
+
+            if data:
+                yield data.decode("utf-8", errors="replace")
+
+        if leftover:
+            yield leftover.decode("utf-8", errors="replace")
+
+
+def read_tokens_before(path, start, count, known=None, block_bytes=64 * 1024):
+    """
+    The last `count` tokens that start before byte `start` (those of the shards in front of it),
+    keeping only the ones in `known` when given. Reads backwards a block at a time.
+    """
+    if start <= 0:
+        return []
+    with open(path, "rb") as f:
+        # a token that crosses `start` belongs to the shard in front, read all of it
+        f.seek(start - 1)
+        crossing = b""
+        if not f.read(1).isspace():
+            while True:
+                byte = f.read(1)
+                if not byte or byte.isspace():
+                    break
+                crossing += byte
+
+        size = block_bytes
+        while True:
+            low = max(0, start - size)
+            f.seek(low)
+            tokens = (f.read(start - low) + crossing).split()
+            if low > 0 and tokens:
+                # may be cut in half by the start of the read
+                tokens = tokens[1:]
+            tokens = [t.decode("utf-8", errors="replace") for t in tokens]
+            if known is not None:
+                tokens = [t for t in tokens if t in known]
+            if len(tokens) >= count or low == 0:
+                return tokens[-count:] if count else []
+            size *= 2
+
+
+class Evaluator:
+    """Scores a token stream against a model: log-likelihood, perplexity and grammar violations"""
+
+    def __init__(self, model, stoi, itos, seq_length=EVAL_SEQ_LENGTH, stride=EVAL_STRIDE,
+                 batch_size=EVAL_BATCH_SIZE, dump=None, model_device=device, history=()):
+        self.model = model
+        self.device = model_device
+        self.stoi = stoi
+        self.seq_length = seq_length
+        self.stride = min(stride, seq_length)
+        self.batch_size = batch_size
+        self.dump = dump
+
+        self.id_is_chord = np.zeros(len(itos), dtype=bool)
+        for i, token in itos.items():
+            self.id_is_chord[i] = is_chord(token)
+
+        self.nll = 0.0
+        self.scored = 0
+        self.unknown = 0
+        self.total_tokens = 0
+
+        # ids not scored yet (plus the context in front of them), and where the unscored part starts
+        self._carry = []
+        self._unscored_from = 1
+        # the first token has no target to score but still opens the grammar runs
+        self._unchecked_from = 0
+        # `history` are the tokens in front of the stream (e.g. of a shard), they only seed the grammar runs
+        self.grammar = GrammarChecker([is_chord(token) for token in history])
+
+    @torch.inference_mode()
+    def _score(self, x, y, first_scored):
+        """Adds up the nll of y[:, first_scored:]"""
+        x = x.to(self.device, non_blocking=True)
+        y = y.to(self.device, non_blocking=True)
+        logits = self.model(x)[:, first_scored:, :]
+        targets = y[:, first_scored:]
+        log_probs = torch.log_softmax(logits.float(), dim=-1)
+        token_nll = -log_probs.gather(-1, targets.unsqueeze(-1)).squeeze(-1)
+
+        self.nll += token_nll.sum(dtype=torch.float64).item()
+        self.scored += targets.numel()
+        if self.dump is not None:
+            token_nll.reshape(-1).cpu().numpy().astype(np.float32).tofile(self.dump)
+
+    @property
+    def violations(self):
+        return self.grammar.violations
+
+    def _check_grammar(self, ids):
+        self.grammar.feed(self.id_is_chord[np.asarray(ids, dtype=np.int64)])
+
+    def feed(self, text):
+        """Scores every full window that fits in what was read so far"""
+        dataset = MusicDataset(text, seq_length=self.seq_length, stoi=self.stoi, stride=self.stride)
+        self.unknown += dataset.unknown_tokens
+        self.total_tokens += len(dataset.data) + dataset.unknown_tokens
+
+        # continue from the tokens left over from the previous block
+        dataset.data = self._carry + dataset.data
+        windows = len(dataset)
+        if windows == 0:
+            self._carry = dataset.data
+            return
+
+        # in every window only the targets that no earlier window scored count
+        first_window_scored = self._unscored_from - 1
+        overlap = self.seq_length - self.stride
+
+        loader = DataLoader(dataset, batch_size=self.batch_size, shuffle=False,
+                            pin_memory=self.device.type == "cuda")
+        first = True
+        for x, y in loader:
+            if first and first_window_scored < overlap:
+                # the very first window of the stream scores all of its targets
+                self._score(x[:1], y[:1], first_window_scored)
+                x, y = x[1:], y[1:]
+            first = False
+            if len(x):
+                self._score(x, y, overlap)
+
+        last_scored = (windows - 1) * self.stride + self.seq_length
+        self._check_grammar(dataset.data[self._unchecked_from:last_scored + 1])
+
+        self._carry = dataset.data[windows * self.stride:]
+        self._unscored_from = overlap + 1
+        self._unchecked_from = overlap + 1
+
+    def finish(self):
+        """Scores the tokens left at the end of the stream with one last window"""
+        data = self._carry
+        unscored = len(data) - self._unscored_from
+        if unscored > 0 and len(data) >= 2:
+            window = data[-(self.seq_length + 1):]
+            x = torch.tensor([window[:-1]], dtype=torch.long)
+            y = torch.tensor([window[1:]], dtype=torch.long)
+            self._score(x, y, len(window) - 1 - unscored)
+        self._check_grammar(data[self._unchecked_from:])
+        self._carry = []
+
+    def result(self, elapsed):
+        mean_nll = self.nll / self.scored if self.scored else float("nan")
+        return {
+            "tokens": self.total_tokens,
+            "scored": self.scored,
+            "unknown": self.unknown,
+            "nll": self.nll,
+            "mean_log_likelihood": -mean_nll,
+            "perplexity": math.exp(mean_nll) if self.scored else float("nan"),
+            "grammar_violations": self.violations,
+            "grammar_violation_rate": self.violations / self.scored if self.scored else float("nan"),
+            "seconds": elapsed,
+            "tokens_per_sec": self.scored / elapsed if elapsed > 0 else 0.0,
+        }
+
+
+def evaluate_file(checkpoint, path, start=0, end=None, quantize=False, seq_length=EVAL_SEQ_LENGTH,
+                  stride=EVAL_STRIDE, batch_size=EVAL_BATCH_SIZE, dump_path=None):
+    """Scores the tokens that start in the byte range [start, end) of a file"""
+    # quantized kernels only run on the cpu
+    model_device = torch.device("cpu") if quantize else device
+    model, stoi, itos, _ = load_checkpoint(checkpoint, model_device, quantize=quantize)
+
+    dump = open(dump_path, "wb") if dump_path else None
+    try:
+        # grammar runs continue from the tokens in front of the range
+        history = read_tokens_before(path, start, MAX_HARP_RUN, known=stoi)
+        evaluator = Evaluator(model, stoi, itos, seq_length=seq_length, stride=stride,
+                              batch_size=batch_size, dump=dump, model_device=model_device, history=history)
+        started = time.time()
+        for text in read_token_blocks(path, start, end):
+            evaluator.feed(text)
+        evaluator.finish()
+        return evaluator.result(time.time() - started)
+    finally:
+        if dump is not None:
+            dump.close()
+
+
+def _evaluate_shard(args):
+    checkpoint, path, start, end, quantize, seq_length, stride, batch_size, threads, dump_path = args
+    torch.set_num_threads(threads)
+    return evaluate_file(checkpoint, path, start, end, quantize, seq_length, stride, batch_size, dump_path)
+
+
+def evaluate_sharded(checkpoint, path, shards, quantize=False, seq_length=EVAL_SEQ_LENGTH, stride=EVAL_STRIDE,
+                     batch_size=EVAL_BATCH_SIZE, dump_path=None):
+    """
+    Splits the file into byte ranges scored by separate processes. Each shard starts without model context,
+    so its first seq_length tokens see a shorter history than they would in a single pass; grammar runs
+    do continue across shard boundaries.
+    """
+    size = os.path.getsize(path)
+    bounds = [size * i // shards for i in range(shards + 1)]
+    threads = max(1, (os.cpu_count() or 1) // shards)
+    jobs = [(checkpoint, path, bounds[i], bounds[i + 1], quantize, seq_length, stride, batch_size, threads,
+             f"{dump_path}.{i}" if dump_path else None) for i in range(shards)]
+
+    started = time.time()
+    with multiprocessing.get_context("spawn").Pool(shards) as pool:
+        results = pool.map(_evaluate_shard, jobs)
+    elapsed = time.time() - started
+
+    total = {key: sum(r[key] for r in results)
+             for key in ("tokens", "scored", "unknown", "nll", "grammar_violations")}
+    mean_nll = total["nll"] / total["scored"] if total["scored"] else float("nan")
+    total.update({
+        "mean_log_likelihood": -mean_nll,
+        "perplexity": math.exp(mean_nll) if total["scored"] else float("nan"),
+        "grammar_violation_rate": total["grammar_violations"] / total["scored"] if total["scored"] else float("nan"),
+        "seconds": elapsed,
+        "tokens_per_sec": total["scored"] / elapsed if elapsed > 0 else 0.0,
+    })
+    return total
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Score token files against omnisong checkpoints")
+    parser.add_argument("files", nargs="+", help="token files to score")
+    parser.add_argument("--checkpoint", action="append", default=None,
+                        help="checkpoint to score with, can be given several times (default omni.pth)")
+    parser.add_argument("--quantize", action="store_true", help="also score int8 dynamically quantized variants")
+    parser.add_argument("--shards", type=int, default=1, help="processes to split each file across")
+    parser.add_argument("--seq-length", type=int, default=EVAL_SEQ_LENGTH)
+    parser.add_argument("--stride", type=int, default=EVAL_STRIDE)
+    parser.add_argument("--batch-size", type=int, default=EVAL_BATCH_SIZE)
+    parser.add_argument("--dump-nll", help="write the nll of every scored token here as float32")
+    parser.add_argument("--json", help="write all results to this file")
+    args = parser.parse_args()
+
+    checkpoints = args.checkpoint or ["omni.pth"]
+    variants = [(c, False) for c in checkpoints] + ([(c, True) for c in checkpoints] if args.quantize else [])
+
+    all_results = []
+    print(f"{'checkpoint':<24} {'file':<24} {'ppl':>9} {'loglik':>9} {'grammar':>9} {'unknown':>9} {'tok/s':>10}")
+    for file in args.files:
+        for checkpoint_path, quantized in variants:
+            if args.shards > 1:
+                res = evaluate_sharded(checkpoint_path, file, args.shards, quantized, args.seq_length,
+                                       args.stride, args.batch_size, args.dump_nll)
+            else:
+                res = evaluate_file(checkpoint_path, file, quantize=quantized, seq_length=args.seq_length,
+                                    stride=args.stride, batch_size=args.batch_size, dump_path=args.dump_nll)
+            res.update({"checkpoint": checkpoint_path, "quantized": quantized, "file": file})
+            all_results.append(res)
+
+            name = os.path.basename(checkpoint_path) + (" (int8)" if quantized else "")
+            print(f"{name:<24} {os.path.basename(file):<24} {res['perplexity']:>9.3f} "
+                  f"{res['mean_log_likelihood']:>9.4f} {res['grammar_violation_rate']:>9.4%} "
+                  f"{res['unknown']:>9} {res['tokens_per_sec']:>10.0f}")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(all_results, f, indent=2)
@@ -0,0 +1,98 @@
+from util import chord_token_to_human, vocab_fingerprint
+
+# event kinds
+SKIP = 0
+CHORD = 1
+HARP = 2
+
+
+class TokenEvent:
+    """A token parsed once: what it plays and for how long. Shared by generation, playback and display"""
+    __slots__ = ("id", "token", "kind", "chord", "harp", "duration_ms", "name", "label")
+
+    def __init__(self, token_id, token, kind, chord, harp, duration_ms, name, label):
+        self.id = token_id
+        self.token = token
+        self.kind = kind
+        # index into EventTable.chord_names, -1 for harps
+        self.chord = chord
+        # harp note index (H1 is 0, like the sound files), -1 for chords
+        self.harp = harp
+        self.duration_ms = duration_ms
+        # chord folder name for chords, e.g. "am"
+        self.name = name
+        # human readable text for the status bar
+        self.label = label
+
+    def __repr__(self):
+        return f"TokenEvent({self.token!r})"
+
+
+def make_event(token, token_id=-1, chord_index=None):
+    """Parses a token like am_400 or H3_100. `chord_index` maps chord names to their index"""
+    parts = token.split('_')
+    if len(parts) != 2:
+        return TokenEvent(token_id, token, SKIP, -1, -1, 0, None, token)
+
+    name, duration_str = parts
+    try:
+        duration_ms = int(duration_str)
+    except ValueError:
+        return TokenEvent(token_id, token, SKIP, -1, -1, 0, None, token)
+
+    label = chord_token_to_human(token)
+    if name.startswith('H'):
+        try:
+            harp = int(name[1:]) - 1
+        except ValueError:
+            return TokenEvent(token_id, token, SKIP, -1, -1, 0, None, token)
+        return TokenEvent(token_id, token, HARP, -1, harp, duration_ms, None, label)
+
+    chord = chord_index.get(name, -1) if chord_index is not None else -1
+    return TokenEvent(token_id, token, CHORD, chord, -1, duration_ms, name, label)
+
+
+class EventTable:
+    """Every token of a vocabulary parsed once, looked up by token id"""
+
+    def __init__(self, itos):
+        names = sorted({itos[i].split('_')[0] for i in itos if not itos[i].startswith('H')})
+        self.chord_names = names
+        chord_index = {name: i for i, name in enumerate(names)}
+
+        self.events = [None] * (max(itos) + 1 if itos else 0)
+        for token_id, token in itos.items():
+            self.events[token_id] = make_event(token, token_id, chord_index)
+
+        # per id lookups used in tight loops
+        self.is_chord = [e is not None and e.kind == CHORD for e in self.events]
+
+        self.fingerprint = vocab_fingerprint(itos)
+
+    def __len__(self):
+        return len(self.events)
+
+    def __getitem__(self, token_id):
+        return self.events[token_id]
+
+    def lookup(self, ids):
+        events = self.events
+        return [events[i] for i in ids]
+
+    def count_chords(self, ids):
+        is_chord = self.is_chord
+        return sum(1 for i in ids if is_chord[i])
+
+
+_parsed = {}
+
+
+def parse_tokens(tokens):
+    """Events for loose token strings (files, prompts), for when there is no vocabulary at hand"""
+    events = []
+    for token in tokens:
+        event = _parsed.get(token)
+        if event is None:
+            event = _parsed[token] = make_event(token)
+        events.append(event)
+    return events
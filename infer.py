@@ -1,32 +1,185 @@
+import gc
+import os
+import threading
+
 import torch
 
+from model.checkpoint import load_checkpoint, load_vocabulary
+from model.dataset import token_mapper
 from model.device import device
-from model.gpt import GPT
-from model.grammar_mask import build_allowed_mask
+from cancellation import GenerationCancelled
+from constants import ADAPTER_FILE, INITIAL_PROMPT
+from events import EventTable
+from model.grammar_mask import allowed_range
+from model.vocab_order import reorder_vocabulary, reordered_vocabulary
 from util import make_path
 
 model_file = make_path("omni.pth")
-with open(model_file, "rb") as f:
-    ckpt = torch.load(f, map_location=device)
-
-stoi = ckpt['stoi']
-itos = ckpt['itos']
-vocab_size = len(stoi)
-
-model = GPT(vocab_size=vocab_size)
-model.load_state_dict(ckpt['model_state'])
-model.to(device)
-model.eval()
-
-print("Model loaded from", model_file, "vocabulary size:", vocab_size)
 
 
-def encode(text):
-    return [stoi[token] for token in text.split() if token in stoi]
-
-
-def decode(indices):
-    return ' '.join([itos[idx] for idx in indices])
+def checkpoint_identity(path, adapter, fingerprint):
+    """Names a checkpoint (and adapter) as they are on disk now: paths, sizes and modification times"""
+    parts = [fingerprint]
+    for file in (path, adapter):
+        if file is not None:
+            stat = os.stat(file)
+            parts.append(f"{os.path.abspath(file)}:{stat.st_size}:{stat.st_mtime_ns}")
+    return "|".join(parts)
+
+
+class Vocabulary:
+    """
+    The vocabulary of a checkpoint, numbered the way its Engine numbers it, without the weights.
+    What the app process needs when the model itself lives in the inference worker process
+    """
+
+    def __init__(self, path, stoi, itos, n_chords, adapter=None):
+        self.path = path
+        self.stoi, self.itos, self.n_chords = stoi, itos, n_chords
+        self.vocab_size = len(self.stoi)
+
+        # every token parsed once, so nothing downstream has to split strings again
+        self.events = EventTable(self.itos)
+        # tells the weights apart, not just the vocabulary: what was sampled from them can be told apart too
+        self.identity = checkpoint_identity(path, adapter, self.events.fingerprint)
+
+    @classmethod
+    def load(cls, path, adapter=None):
+        """The vocabulary of the Engine(path, adapter) running in another process"""
+        _, itos = load_vocabulary(path)
+        return cls(path, *reordered_vocabulary(itos), adapter=adapter)
+
+    def encode(self, text):
+        return [self.stoi[token] for token in text.split() if token in self.stoi]
+
+    def decode(self, indices):
+        return ' '.join([self.itos[idx] for idx in indices])
+
+    def remapper(self, old):
+        """
+        Function rewriting id lists of `old`'s vocabulary into this one, None when both are the same.
+        Tokens this vocabulary lacks become the closest one it has (see token_mapper) or are dropped.
+        Raises ValueError when the vocabularies have nothing in common
+        """
+        if old.events.fingerprint == self.events.fingerprint:
+            return None
+
+        map_token = token_mapper(self.stoi)
+        table = {}
+        for old_id, token in old.itos.items():
+            new_token = map_token(token)
+            if new_token is not None:
+                table[old_id] = self.stoi[new_token]
+        if not table:
+            raise ValueError(f"{self.path} shares no tokens with {old.path}")
+
+        def remap(ids):
+            return [table[i] for i in ids if i in table]
+
+        return remap
+
+    def release(self):
+        """Nothing to drop, the weights live in another process"""
+
+
+class Engine(Vocabulary):
+    """A loaded checkpoint with its vocabulary, everything generation needs. The app swaps them at runtime"""
+
+    def __init__(self, path, adapter=None):
+        # the checkpoint carries its own architecture, so a distilled student loads the same way
+        model, stoi, itos, _ = load_checkpoint(path, device, adapter=adapter)
+        # chords first, then harps, so whatever the grammar allows is one contiguous slice of the output layer
+        super().__init__(path, *reorder_vocabulary(model, stoi, itos), adapter=adapter)
+        self.model = model
+
+    def warm_up(self):
+        """One short generation, so the first real chunk does not pay for lazy initialization"""
+        self.generate_ids(self.encode(INITIAL_PROMPT) or [0], max_len=4)
+
+    def release(self):
+        """Drops the weights once another engine took over"""
+        self.model = None
+        gc.collect()
+        if device.type == "cuda":
+            torch.cuda.empty_cache()
+
+    @torch.no_grad()
+    def generate_ids(self, prompt_ids, max_len=256, temperature=1.0, top_p=0.9, debug=False, cancel=None,
+                     on_token=None):
+        """
+        Same as generate, but takes and returns token ids (prompt included).
+        `cancel` is checked every step, raising GenerationCancelled once it fires.
+        `on_token(id)` is called with each new id as soon as it is sampled.
+        """
+        model = self.model
+        n_chords = self.n_chords
+        model.eval()
+
+        # the prompt is a copy (PromptManager.get_prompt), not a view of the history ring: the ring is written by
+        # the playback thread while this runs, and a view would need a seqlock around every read of it
+        tokens = [int(i) for i in prompt_ids]
+        prompt = torch.tensor(tokens, dtype=torch.long)
+
+        # one input buffer for the whole run, instead of a new tensor built from a list every step
+        inp_ids = torch.empty((1, len(tokens) + max_len), dtype=torch.long, device=device)
+        inp_ids[0, :len(tokens)] = prompt
+
+        # kind and length of the run of same-kind tokens at the end, updated as tokens are added
+        run_is_chord = None
+        run_length = 0
+        if tokens:
+            run_is_chord = tokens[-1] < n_chords
+            for token in reversed(tokens):
+                if (token < n_chords) != run_is_chord:
+                    break
+                run_length += 1
+
+        if debug:
+            print(f"Starting generation with prompt ids: {tokens}")
+            print(f"Decoded: {self.decode(tokens) if tokens else 'Empty'}")
+
+        for step in range(max_len):
+            if cancel is not None and cancel.cancelled():
+                raise GenerationCancelled()
+
+            # grammar mask: the allowed tokens are one id range, only that slice of the output layer is computed.
+            # the softmax over the slice is the full softmax with everything else masked out and renormalized
+            start, end = allowed_range(run_is_chord, run_length, n_chords, self.vocab_size)
+            hidden = model.hidden(inp_ids[:, :len(tokens)])[:, -1, :]  # last-token hidden state
+            logits = model.project(hidden, start, end)
+            logits = logits / temperature
+            masked = torch.softmax(logits, dim=-1).squeeze(0)
+
+            if top_p < 1.0:
+                sorted_probs, sorted_indices = torch.sort(masked, descending=True)
+                cumulative_probs = torch.cumsum(sorted_probs, dim=0)
+
+                sorted_indices_to_remove = cumulative_probs > top_p
+                sorted_indices_to_remove[0] = False
+
+                # create a mask to remove tokens
+                indices_to_remove = sorted_indices[sorted_indices_to_remove]
+                masked[indices_to_remove] = 0
+                masked = masked / masked.sum()
+
+            if debug and step < 10:
+                last = self.itos[tokens[-1]] if tokens else 'None'
+                print(f"Step {step}: {end - start} allowed tokens, last token: {last}")
+
+            next_id = start + torch.multinomial(masked, 1).item()
+
+            inp_ids[0, len(tokens)] = next_id
+            tokens.append(next_id)
+            if on_token is not None:
+                on_token(next_id)
+
+            next_is_chord = next_id < n_chords
+            if next_is_chord == run_is_chord:
+                run_length += 1
+            else:
+                run_is_chord, run_length = next_is_chord, 1
+
+        return tokens
 
 
 def sample_logits(logits, temperature=1.0, top_k=None):
@@ -39,63 +192,64 @@ def sample_logits(logits, temperature=1.0, top_k=None):
     return torch.multinomial(probs, num_samples=1)
 
 
-@torch.no_grad()
-def generate(prompt, max_len=256, temperature=1.0, top_p=0.9, debug=False):
-    model.eval()
+_engine = None
+_engine_lock = threading.Lock()
+# set in a process whose model lives in the inference worker, see use_vocabulary_only
+_vocabulary_only = False
+
 
-    tokens = []
-    for t in prompt.split():
-        if t in stoi:
-            tokens.append(stoi[t])
+def default_adapter():
+    return make_path(ADAPTER_FILE) if ADAPTER_FILE else None
 
-    if debug:
-        print(f"Starting generation with prompt: '{prompt}'")
-        print(f"Encoded tokens: {tokens}")
-        print(f"Decoded: {decode(tokens) if tokens else 'Empty'}")
 
-    for step in range(max_len):
-        # encode current tokens
-        inp_ids = torch.tensor([tokens], dtype=torch.long, device=device)
+def use_vocabulary_only():
+    """From now on get_engine() loads only the vocabulary of omni.pth, for a process that never runs the model"""
+    global _vocabulary_only
+    _vocabulary_only = True
 
-        # get logits from model
-        logits = model(inp_ids)[:, -1, :]  # last-token logits
-        logits = logits / temperature
-        probs = torch.softmax(logits, dim=-1).squeeze()
 
-        # apply grammar mask to filter allowed tokens
-        allowed_mask = build_allowed_mask(itos, tokens)
-        allowed_mask = torch.tensor(
-            allowed_mask,
-            dtype=torch.float32,
-            device=device
-        )
+def get_engine():
+    """Returns the engine generating right now, loading omni.pth (and ADAPTER_FILE) on first use"""
+    global _engine
+    with _engine_lock:
+        if _engine is None:
+            if _vocabulary_only:
+                _engine = Vocabulary.load(model_file, adapter=default_adapter())
+                print("Vocabulary loaded from", model_file, "size:", _engine.vocab_size)
+            else:
+                _engine = Engine(model_file, adapter=default_adapter())
+                print("Model loaded from", model_file, "vocabulary size:", _engine.vocab_size)
+        return _engine
 
-        masked = probs * allowed_mask
 
-        if masked.sum().item() == 0:
-            break
+def set_engine(engine):
+    """Makes `engine` the one generating from now on, returns the previous one"""
+    global _engine
+    with _engine_lock:
+        previous, _engine = _engine, engine
+    print("Switched to", engine.path, "vocabulary size:", engine.vocab_size)
+    return previous
 
-        masked = masked / masked.sum()
 
-        if top_p < 1.0:
-            sorted_probs, sorted_indices = torch.sort(masked, descending=True)
-            cumulative_probs = torch.cumsum(sorted_probs, dim=0)
+def __getattr__(name):
+    # model, stoi, itos, n_chords, vocab_size and events of the current engine, for scripts
+    if name in ("model", "stoi", "itos", "n_chords", "vocab_size", "events"):
+        return getattr(get_engine(), name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
-            sorted_indices_to_remove = cumulative_probs > top_p
-            sorted_indices_to_remove[0] = False
 
-            # create a mask to remove tokens
-            indices_to_remove = sorted_indices[sorted_indices_to_remove]
-            masked[indices_to_remove] = 0
-            masked = masked / masked.sum()
+def encode(text):
+    return get_engine().encode(text)
 
-        if debug and step < 10:
-            allowed_tokens = [itos[i] for i in range(len(allowed_mask)) if allowed_mask[i] > 0]
-            print(
-                f"Step {step}: {len(allowed_tokens)} allowed tokens, last token: {itos[tokens[-1]] if tokens else 'None'}")
 
-        next_id = torch.multinomial(masked, 1).item()
+def decode(indices):
+    return get_engine().decode(indices)
 
-        tokens.append(next_id)
 
-    return " ".join([itos[t] for t in tokens])
+def generate_ids(prompt_ids, max_len=256, temperature=1.0, top_p=0.9, debug=False, cancel=None):
+    return get_engine().generate_ids(prompt_ids, max_len=max_len, temperature=temperature, top_p=top_p,
+                                     debug=debug, cancel=cancel)
+
+
+def generate(prompt, max_len=256, temperature=1.0, top_p=0.9, debug=False):
+    return decode(generate_ids(encode(prompt), max_len=max_len, temperature=temperature, top_p=top_p, debug=debug))
@@ -0,0 +1,375 @@
+import atexit
+import multiprocessing
+import threading
+import time
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from cancellation import GenerationCancelled
+from constants import INFERENCE_RING_CAPACITY, INFERENCE_STREAM_BATCH, INFERENCE_WORKER_TIMEOUT, \
+    INFERENCE_REQUEST_TIMEOUT
+
+# ring header: total ids written, total ids read (int64 each), then the ids themselves
+HEADER_BYTES = 16
+
+
+class TokenRing:
+    """
+    Single-producer single-consumer ring of int32 token ids in shared memory.
+    The producer announces new ids over the control pipe, so the consumer never reads a half written slot.
+    """
+
+    def __init__(self, shm, capacity, owner):
+        self.shm = shm
+        self.capacity = capacity
+        self.owner = owner
+        self._counters = np.ndarray((2,), dtype=np.int64, buffer=shm.buf, offset=0)
+        self._ids = np.ndarray((capacity,), dtype=np.int32, buffer=shm.buf, offset=HEADER_BYTES)
+
+    @classmethod
+    def create(cls, capacity=INFERENCE_RING_CAPACITY):
+        shm = shared_memory.SharedMemory(create=True, size=HEADER_BYTES + capacity * 4)
+        ring = cls(shm, capacity, owner=True)
+        ring.reset()
+        return ring
+
+    @classmethod
+    def attach(cls, name, capacity):
+        shm = shared_memory.SharedMemory(name=name)
+        try:
+            # only the parent may unlink the segment, dont let this process' tracker do it on exit
+            from multiprocessing import resource_tracker
+            resource_tracker.unregister(shm._name, "shared_memory")
+        except Exception:
+            pass
+        return cls(shm, capacity, owner=False)
+
+    @property
+    def name(self):
+        return self.shm.name
+
+    def reset(self):
+        self._counters[:] = 0
+
+    def free(self):
+        return self.capacity - int(self._counters[0] - self._counters[1])
+
+    def write(self, ids, should_continue=lambda: True):
+        """Producer side: copies ids in, waiting for the reader when the ring is full"""
+        ids = np.asarray(ids, dtype=np.int32)
+        done = 0
+        while done < len(ids):
+            free = self.free()
+            if free == 0:
+                if not should_continue():
+                    return done
+                time.sleep(0.001)
+                continue
+
+            head = int(self._counters[0])
+            n = min(free, len(ids) - done, self.capacity - head % self.capacity)
+            start = head % self.capacity
+            self._ids[start:start + n] = ids[done:done + n]
+            self._counters[0] = head + n
+            done += n
+        return done
+
+    def read(self, count):
+        """Consumer side: views of the next `count` ids (two when they wrap around), no copy made"""
+        tail = int(self._counters[1])
+        start = tail % self.capacity
+        first = min(count, self.capacity - start)
+        views = [self._ids[start:start + first]]
+        if first < count:
+            views.append(self._ids[:count - first])
+        return views
+
+    def release(self, count):
+        """Consumer side: the ids returned by read() may now be overwritten"""
+        self._counters[1] += count
+
+    def close(self):
+        self._counters = None
+        self._ids = None
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+
+class _PipeCancel:
+    """Cancel token for the child: a cancel (or stop) message arriving on the pipe during generation"""
+
+    def __init__(self, conn, job):
+        self.conn = conn
+        self.job = job
+        self.stop_requested = False
+        self._cancelled = False
+
+    def cancelled(self):
+        # only cancel/stop can arrive while a request runs, since the parent sends one request at a time
+        while not self._cancelled and self.conn.poll():
+            message = self.conn.recv()
+            if message[0] == "stop":
+                self._cancelled = True
+                self.stop_requested = True
+            elif message[0] == "cancel" and message[1] == self.job:
+                # a late cancel for an earlier job is ignored
+                self._cancelled = True
+        return self._cancelled
+
+
+class _RingStream:
+    """Child side of a request: writes ids to the ring as they are sampled and announces them in small batches"""
+
+    def __init__(self, conn, ring, job, cancel, batch=INFERENCE_STREAM_BATCH):
+        self.conn = conn
+        self.ring = ring
+        self.job = job
+        self.cancel = cancel
+        # never more than the ring holds, or a batch could wait on a full ring forever
+        self.batch = max(1, min(batch, ring.capacity))
+        self._pending = []
+
+    def __call__(self, token_id):
+        self._pending.append(token_id)
+        if len(self._pending) >= self.batch:
+            self.flush()
+
+    def flush(self):
+        if not self._pending:
+            return
+        # waits while the parent is behind, unless the request was cancelled meanwhile
+        written = self.ring.write(self._pending, should_continue=lambda: not self.cancel.cancelled())
+        if written:
+            self.conn.send(("tokens", self.job, written))
+        if written < len(self._pending):
+            raise GenerationCancelled()
+        self._pending = []
+
+
+def _worker_main(conn, ring_name, capacity, model_path):
+    """Runs in the child process: owns the model and answers generation requests"""
+    import infer
+    from cpu_governor import get_governor
+
+    # this process only runs the model, it gets the inference cores and thread count. pinned before the
+    # model is loaded and calibrated, so torch's thread pool is created on the inference cores too
+    governor = get_governor()
+    governor.apply_to_inference_thread()
+
+    if model_path is not None:
+        infer.set_engine(infer.Engine(model_path))
+    engine = infer.get_engine()
+
+    governor.configure(engine.model, engine.vocab_size)
+    governor.apply_to_inference_thread()
+    # the first request should not pay for lazy initialization
+    engine.warm_up()
+
+    ring = TokenRing.attach(ring_name, capacity)
+    conn.send(("ready", engine.vocab_size, governor.settings(), time.process_time()))
+
+    while True:
+        try:
+            message = conn.recv()
+        except EOFError:
+            break
+
+        if message[0] == "stop":
+            break
+
+        if message[0] == "generate":
+            _, job, prompt, max_len, temperature, top_p = message
+            cancel = _PipeCancel(conn, job)
+            stream = _RingStream(conn, ring, job, cancel)
+            try:
+                # ids reach the parent while sampling goes on, not after the whole sequence
+                engine.generate_ids(prompt, max_len=max_len, temperature=temperature, top_p=top_p,
+                                    cancel=cancel, on_token=stream)
+                stream.flush()
+                # the cpu time so far, so the app can tell its own load from the rest of the machine's
+                conn.send(("done", job, time.process_time()))
+            except GenerationCancelled:
+                conn.send(("cancelled", job, time.process_time()))
+                if cancel.stop_requested:
+                    break
+            except Exception as e:
+                conn.send(("error", job, str(e)))
+
+    ring.close()
+
+
+class InferenceWorker:
+    """
+    Keeps the model in a child process so sampling never holds the GIL the audio threads need.
+    Parameters go over a pipe and generated ids stream back through a shared-memory TokenRing, a few at a
+    time while the child samples. Each batch is copied once from the ring into the request's numpy array,
+    and slices of that array are what callers get back.
+    If the child dies, or stops answering for INFERENCE_REQUEST_TIMEOUT seconds, it is started again and the
+    request that was running is retried once.
+    `model_path` is the checkpoint the child loads, None for the default one.
+    """
+
+    def __init__(self, capacity=INFERENCE_RING_CAPACITY, model_path=None):
+        self._ctx = multiprocessing.get_context("spawn")
+        self.capacity = capacity
+        self.model_path = model_path
+        self._closed = False
+        self.ring = TokenRing.create(capacity)
+        self.process = None
+        self.conn = None
+        self.restarts = 0
+        self._job = 0
+        # cpu seconds of the current child as of its last answer, and of the children before it
+        self._child_cpu = 0.0
+        self._dead_cpu = 0.0
+        # one request at a time over the pipe
+        self._lock = threading.Lock()
+        self._start()
+
+    def _start(self):
+        parent_conn, child_conn = self._ctx.Pipe()
+        self.ring.reset()
+        self.process = self._ctx.Process(target=_worker_main,
+                                         args=(child_conn, self.ring.name, self.capacity, self.model_path),
+                                         daemon=True, name="omnisong-inference")
+        self.process.start()
+        child_conn.close()
+        self.conn = parent_conn
+
+        message = self._recv(timeout=INFERENCE_WORKER_TIMEOUT)
+        if message[0] != "ready":
+            raise RuntimeError(f"Inference worker failed to start: {message}")
+        from cpu_governor import get_governor
+        get_governor().publish(message[2])
+        # loading and warming up, not generating
+        self._child_cpu = message[3]
+
+    def _restart(self, reason):
+        self.restarts += 1
+        self._dead_cpu += self._child_cpu
+        self._child_cpu = 0.0
+        print(f"Inference worker failed ({reason}), restarting it (restart #{self.restarts})")
+        self._kill()
+        self._start()
+
+    def _kill(self):
+        if self.process is not None and self.process.is_alive():
+            self.process.kill()
+            self.process.join(timeout=5)
+        if self.conn is not None:
+            self.conn.close()
+
+    def _recv(self, timeout=None, poll_cancel=None):
+        """
+        Waits for a message from the child, noticing if it crashed in the meantime.
+        Returns None early if `poll_cancel` fires, so the caller can forward the cancel.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while not self.conn.poll(0.05):
+            if poll_cancel is not None and poll_cancel.cancelled():
+                return None
+            if not self.process.is_alive():
+                raise ChildProcessError(f"Inference worker exited with code {self.process.exitcode}")
+            if deadline is not None and time.monotonic() > deadline:
+                raise TimeoutError("Inference worker did not answer in time")
+        try:
+            return self.conn.recv()
+        except EOFError:
+            raise ChildProcessError("Inference worker closed the pipe")
+
+    def _request(self, prompt, max_len, temperature, top_p, cancel):
+        self._job += 1
+        job = self._job
+        self.conn.send(("generate", job, [int(i) for i in prompt], max_len, temperature, top_p))
+
+        # the ring slots are reused once released, so the ids land here as each batch arrives, behind the prompt
+        sequence = np.empty(len(prompt) + max_len, dtype=np.int32)
+        sequence[:len(prompt)] = prompt
+        received = len(prompt)
+        cancel_sent = False
+        while True:
+            if cancel is not None and not cancel_sent and cancel.cancelled():
+                self.conn.send(("cancel", job))
+                cancel_sent = True
+
+            # a child that is alive but stuck would otherwise keep us (and the lock) here forever
+            message = self._recv(timeout=INFERENCE_REQUEST_TIMEOUT, poll_cancel=None if cancel_sent else cancel)
+            if message is None:
+                continue
+            kind, message_job = message[0], message[1]
+            if kind in ("done", "cancelled"):
+                # an abandoned request's answer counts too, the child spent the time either way
+                self._child_cpu = message[2]
+
+            if kind == "tokens":
+                count = message[2]
+                if message_job == job:
+                    for view in self.ring.read(count):
+                        sequence[received:received + len(view)] = view
+                        received += len(view)
+                # ids of an abandoned request are just skipped
+                self.ring.release(count)
+            elif message_job != job:
+                continue
+            elif kind == "error":
+                raise RuntimeError(message[2])
+            elif kind == "cancelled":
+                raise GenerationCancelled()
+            elif kind == "done":
+                if cancel_sent:
+                    # it finished before it saw our cancel, the result is stale anyway
+                    raise GenerationCancelled()
+                return sequence[:received]
+
+    def generate_ids(self, prompt, max_len=256, temperature=1.0, top_p=0.9, debug=False, cancel=None):
+        """Same contract as infer.generate_ids, but returns the prompt followed by the new ids as an int32 array"""
+        with self._lock:
+            try:
+                return self._request(prompt, max_len, temperature, top_p, cancel)
+            except (ChildProcessError, BrokenPipeError, TimeoutError, OSError) as e:
+                # crash isolation: the app keeps running, we bring the model back and try again once
+                self._restart(e)
+                return self._request(prompt, max_len, temperature, top_p, cancel)
+
+    def cpu_seconds(self):
+        """Cpu time the child processes spent so far, as of their last answers"""
+        return self._dead_cpu + self._child_cpu
+
+    def close(self):
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            try:
+                if self.process is not None and self.process.is_alive():
+                    self.conn.send(("stop",))
+                    self.process.join(timeout=2)
+            except (BrokenPipeError, OSError):
+                pass
+            self._kill()
+            self.ring.close()
+
+
+_worker = None
+_worker_lock = threading.Lock()
+
+
+def get_inference_worker():
+    """Returns the process-wide inference worker, starting it on first use"""
+    global _worker
+    with _worker_lock:
+        if _worker is None:
+            _worker = InferenceWorker()
+            atexit.register(_worker.close)
+        return _worker
+
+
+def set_inference_worker(worker):
+    """Makes `worker` the one generating from now on, returns the previous one (still running)"""
+    global _worker
+    with _worker_lock:
+        previous, _worker = _worker, worker
+        atexit.register(worker.close)
+        return previous
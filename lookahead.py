@@ -0,0 +1,209 @@
+import threading
+import time
+from collections import deque
+
+from constants import LOOKAHEAD_MARGIN_SECONDS, LOOKAHEAD_CHUNK_COMPUTE_SECONDS, LOOKAHEAD_MIN_CHUNK
+from events import CHORD
+from tracing import tracer
+
+
+class Chunk:
+    """A generated run of tokens waiting to be played"""
+    __slots__ = ("ids", "events", "chord_ms", "harp_ms", "version")
+
+    def __init__(self, ids, events, version=0):
+        self.ids = ids
+        self.events = events
+        # version of the sampling parameters it was generated with
+        self.version = version
+        # raw durations, so the length in seconds can follow the slowdown sliders
+        self.chord_ms = sum(e.duration_ms for e in events if e.kind == CHORD)
+        self.harp_ms = sum(e.duration_ms for e in events if e.kind != CHORD)
+
+    def seconds(self, slow_down_chord, slow_down_harp):
+        return (self.chord_ms * slow_down_chord + self.harp_ms * slow_down_harp) / 1000.0
+
+
+class LookaheadBuffer:
+    """
+    Bounded queue between generation and playback, measured in seconds of audio instead of items.
+    The producer waits while there is enough audio ahead, the consumer blocks until a chunk arrives.
+    """
+
+    def __init__(self, slowdowns, on_take=None, on_cut=None, clock=time.monotonic):
+        # slowdowns() returns the current (chord, harp) slowdown factors
+        self.slowdowns = slowdowns
+        # called with each chunk as playback takes it, under the buffer lock
+        self.on_take = on_take
+        # called with (chunk, tokens played) when a playing chunk is cut short, under the buffer lock
+        self.on_cut = on_cut
+        self.clock = clock
+
+        # current version of the sampling parameters, chunks made with an older one are stale
+        self.version = 0
+
+        self._chunks = deque()
+        self._cond = threading.Condition()
+        self._closed = False
+
+        # the chunk being played right now and when it started, to estimate how much of it is left
+        self._playing = None
+        self._playing_index = -1
+        self._playing_seconds = 0.0
+        self._playing_since = 0.0
+
+    def _seconds(self, chunk):
+        return chunk.seconds(*self.slowdowns())
+
+    def _level(self):
+        playing_left = max(0.0, self._playing_seconds - (self.clock() - self._playing_since))
+        return playing_left + sum(self._seconds(c) for c in self._chunks)
+
+    def level(self):
+        """Seconds of audio ready to play, including what is left of the current chunk"""
+        with self._cond:
+            return self._level()
+
+    def __len__(self):
+        with self._cond:
+            return len(self._chunks)
+
+    def wait_for_room(self, target_seconds, should_continue=lambda: True):
+        """Blocks the producer until the look-ahead drops under target_seconds. Returns False if stopped"""
+        with self._cond:
+            while not self._closed and should_continue():
+                level = self._level()
+                if level < target_seconds:
+                    return True
+                # the level drains as audio plays, so we know exactly when to check again
+                self._cond.wait(timeout=min(level - target_seconds + 0.01, 0.5))
+            return False
+
+    def put(self, chunk):
+        with self._cond:
+            if self._closed or chunk.version < self.version:
+                tracer.event("lookahead.put", chunk=id(chunk), tokens=len(chunk.ids), dropped=True)
+                return
+            self._chunks.append(chunk)
+            tracer.event("lookahead.put", chunk=id(chunk), tokens=len(chunk.ids), queued=len(self._chunks))
+            self._cond.notify_all()
+
+    def get(self, timeout=None):
+        """Blocks until a chunk is ready, returns None on timeout or once closed"""
+        with self._cond:
+            deadline = None if timeout is None else self.clock() + timeout
+            while not self._chunks and not self._closed:
+                remaining = None if deadline is None else deadline - self.clock()
+                if remaining is not None and remaining <= 0:
+                    return None
+                self._cond.wait(timeout=remaining)
+
+            if not self._chunks:
+                return None
+
+            chunk = self._chunks.popleft()
+            self._playing = chunk
+            self._playing_index = -1
+            self._playing_seconds = self._seconds(chunk)
+            self._playing_since = self.clock()
+            if self.on_take is not None:
+                self.on_take(chunk)
+            tracer.event("lookahead.get", chunk=id(chunk), tokens=len(chunk.ids), queued=len(self._chunks))
+            self._cond.notify_all()
+            return chunk
+
+    def prompt(self, fallback, cutoff):
+        """
+        The last `cutoff` ids generation should continue from: every queued chunk, after `fallback()`
+        (the history played so far, the playing chunk included) when the queue alone is shorter than that
+        """
+        with self._cond:
+            parts = []
+            count = 0
+            for chunk in reversed(self._chunks):
+                if count >= cutoff:
+                    break
+                parts.append(chunk.ids[-(cutoff - count):])
+                count += len(parts[-1])
+            if count < cutoff:
+                parts.append(fallback()[-(cutoff - count):])
+            return [int(i) for part in reversed(parts) for i in part]
+
+    def set_progress(self, index):
+        """Playback reports which token of the current chunk just started"""
+        self._playing_index = index
+
+    def is_cut(self, chunk):
+        """True once the chunk being played was made stale and should stop"""
+        return chunk is not self._playing
+
+    def invalidate(self):
+        """
+        The sampling parameters changed: drops queued chunks and cuts the playing one after its current token,
+        so generation continues from exactly where playback is. Returns the new version.
+        """
+        with self._cond:
+            self.version += 1
+            tracer.event("lookahead.invalidate", version=self.version, dropped=len(self._chunks))
+            self._chunks.clear()
+
+            if self._playing is not None:
+                played = self._playing_index + 1
+                if self.on_cut is not None and played < len(self._playing.ids):
+                    self.on_cut(self._playing, played)
+                self._playing = None
+                self._playing_seconds = 0.0
+
+            self._cond.notify_all()
+            return self.version
+
+    def remap(self, remap, history=None, initial_prompt_ids=None):
+        """
+        The model's vocabulary changed: rewrites the ids of the queued chunks with `remap`, and the `history`
+        PromptManager with them (its initial prompt becomes `initial_prompt_ids`), under the buffer lock so
+        playback can not take a chunk in between. Their events stay as they are, so they play exactly as generated
+        """
+        with self._cond:
+            for chunk in self._chunks:
+                chunk.ids = remap(list(chunk.ids))
+            if history is not None:
+                history.remap(remap, initial_prompt_ids)
+
+    def clear(self):
+        """Drops every queued chunk, the one playing right now finishes normally"""
+        with self._cond:
+            self._chunks.clear()
+            self._cond.notify_all()
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._chunks.clear()
+            self._cond.notify_all()
+
+
+class ChunkSizer:
+    """
+    Picks how many tokens to generate next from the measured generation speed.
+    Chunks take about LOOKAHEAD_CHUNK_COMPUTE_SECONDS to generate, and generation starts just early enough
+    that the next chunk lands before the look-ahead runs out.
+    """
+
+    def __init__(self, initial_rate=20.0, smoothing=0.3):
+        # tokens per second, exponentially smoothed
+        self.rate = initial_rate
+        self.smoothing = smoothing
+
+    def observe(self, tokens, seconds):
+        if tokens <= 0 or seconds <= 0:
+            return
+        measured = tokens / seconds
+        self.rate += self.smoothing * (measured - self.rate)
+
+    def chunk_size(self, max_len):
+        size = int(self.rate * LOOKAHEAD_CHUNK_COMPUTE_SECONDS)
+        return max(min(LOOKAHEAD_MIN_CHUNK, max_len), min(size, max_len))
+
+    def target_seconds(self, chunk_size):
+        """Look-ahead under which we must start generating: the time to make the next chunk, plus a margin"""
+        return chunk_size / self.rate + LOOKAHEAD_MARGIN_SECONDS
@@ -0,0 +1,29 @@
+import threading
+
+
+class Metrics:
+    """Thread-safe bag of named numbers (rates, counters, settings) that any part of the app can publish"""
+
+    def __init__(self):
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def set(self, name, value):
+        with self._lock:
+            self._values[name] = value
+
+    def add(self, name, amount=1):
+        with self._lock:
+            self._values[name] = self._values.get(name, 0) + amount
+
+    def get(self, name, default=None):
+        with self._lock:
+            return self._values.get(name, default)
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self._values)
+
+
+# shared by the whole app
+metrics = Metrics()
@@ -0,0 +1,26 @@
+import copy
+import time
+
+import torch
+
+
+@torch.no_grad()
+def generation_speed(model, vocab_size, context=20, steps=128, device=torch.device("cpu")):
+    """
+    Tokens/sec of the app's generation loop: one forward pass per token over a growing context,
+    batch size 1. Run it on the cpu to see the latency floor of low-end machines
+    """
+    # a copy, so the model being trained stays where it is
+    model = copy.deepcopy(model).to(device)
+    model.eval()
+
+    ids = torch.randint(0, vocab_size, (1, context + steps), device=device)
+    # warmup
+    model(ids[:, :context])
+
+    started = time.perf_counter()
+    for length in range(context, context + steps):
+        model(ids[:, :length])
+    elapsed = time.perf_counter() - started
+
+    return steps / elapsed
@@ -0,0 +1,39 @@
+import torch
+
+from model.gpt import GPT
+from model.lora import merge_adapter
+
+
+def load_checkpoint(path, device, quantize=False, adapter=None):
+    """
+    Loads a checkpoint written by train.py, returns (model, stoi, itos, ckpt) with the model in eval mode.
+    `adapter` is a fine-tuned adapter file whose deltas get merged into the weights
+    """
+    with open(path, "rb") as f:
+        ckpt = torch.load(f, map_location=device)
+
+    stoi = ckpt['stoi']
+    itos = ckpt['itos']
+
+    # checkpoints from before the config was saved all used the default shape
+    model = GPT(vocab_size=len(stoi), **ckpt.get('config', {}))
+    model.load_state_dict(ckpt['model_state'])
+    if adapter is not None:
+        merge_adapter(model, adapter, itos)
+    model.to(device)
+    model.eval()
+
+    if quantize:
+        # int8 dynamic quantization of the linear layers, cpu only
+        model = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+
+    return model, stoi, itos, ckpt
+
+
+def load_vocabulary(path):
+    """
+    (stoi, itos) of a checkpoint, for a process that never runs the model.
+    The weights are memory-mapped instead of read, and dropped with the rest of the checkpoint
+    """
+    ckpt = torch.load(path, map_location="cpu", mmap=True)
+    return ckpt['stoi'], ckpt['itos']
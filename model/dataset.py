@@ -2,24 +2,85 @@ import torch
 from torch.utils.data import Dataset
 
 
+def token_mapper(stoi):
+    """
+    Function turning any token into one a fixed vocabulary has: itself if known, else the same chord or
+    harp note with the closest duration (ties go to the shorter one), or None when the name is unknown
+    """
+    durations = {}
+    for token in stoi:
+        name, _, duration = token.partition('_')
+        if duration.isdigit():
+            durations.setdefault(name, []).append(int(duration))
+
+    mapping = {}
+
+    def map_token(token):
+        if token in stoi:
+            return token
+        if token not in mapping:
+            name, _, duration = token.partition('_')
+            candidates = durations.get(name)
+            if candidates and duration.isdigit():
+                closest = min(candidates, key=lambda d: (abs(d - int(duration)), d))
+                mapping[token] = f"{name}_{closest}"
+            else:
+                mapping[token] = None
+        return mapping[token]
+
+    return map_token
+
+
+def map_unseen_tokens(text, stoi):
+    """
+    Rewrites tokens a fixed vocabulary does not have into ones it does (see token_mapper), so a corpus can be
+    trained on with an existing checkpoint. Tokens with a name the vocabulary has never seen are dropped.
+    Returns (text, mapped, dropped)
+    """
+    map_token = token_mapper(stoi)
+    mapped = dropped = 0
+    out = []
+    for token in text.split():
+        if token in stoi:
+            out.append(token)
+            continue
+
+        new_token = map_token(token)
+        if new_token is None:
+            dropped += 1
+        else:
+            out.append(new_token)
+            mapped += 1
+
+    return " ".join(out), mapped, dropped
+
+
 class MusicDataset(Dataset):
-    def __init__(self, text, seq_length=64):
+    def __init__(self, text, seq_length=64, stoi=None, stride=1):
         tokens = text.split()
 
-        vocab = set(tokens)
-        # stoi = string to index
-        self.stoi = {word: i for i, word in enumerate(vocab)}
+        if stoi is None:
+            vocab = set(tokens)
+            # stoi = string to index
+            self.stoi = {word: i for i, word in enumerate(vocab)}
+        else:
+            # reuse an existing vocabulary (e.g. a checkpoint's), tokens it does not know are dropped
+            self.stoi = stoi
         # itos = index to string
         self.itos = {i: word for word, i in self.stoi.items()}
 
         # we convert the entire text into a list of indices
-        self.data = [self.stoi[token] for token in tokens]
+        self.data = [self.stoi[token] for token in tokens if token in self.stoi]
+        self.unknown_tokens = len(tokens) - len(self.data)
         self.seq_length = seq_length
+        # distance between the starts of two consecutive windows
+        self.stride = stride
 
     def __len__(self):
-        return len(self.data) - self.seq_length
+        return max(0, (len(self.data) - self.seq_length - 1) // self.stride + 1)
 
     def __getitem__(self, idx):
+        idx = idx * self.stride
         # input sequence
         x = torch.tensor(self.data[idx:idx + self.seq_length], dtype=torch.long)
         # target sequence (next tokens)
@@ -0,0 +1,38 @@
+import torch
+import torch.nn.functional as F
+
+
+def distillation_loss(student_logits, teacher_logits, targets, criterion, alpha=0.5, temperature=2.0):
+    """
+    Blend of matching the teacher's softened distribution and the usual loss on the real next tokens.
+    `alpha` is the weight of the teacher term. The KL term is scaled by temperature^2 so its gradients
+    keep the same size whatever the temperature.
+    """
+    vocab_size = student_logits.size(-1)
+    student_logits = student_logits.reshape(-1, vocab_size)
+    teacher_logits = teacher_logits.reshape(-1, vocab_size)
+
+    soft_loss = F.kl_div(
+        F.log_softmax(student_logits / temperature, dim=-1),
+        F.log_softmax(teacher_logits / temperature, dim=-1),
+        reduction="batchmean",
+        log_target=True,
+    ) * temperature ** 2
+    hard_loss = criterion(student_logits, targets.reshape(-1))
+
+    return alpha * soft_loss + (1 - alpha) * hard_loss
+
+
+@torch.no_grad()
+def perplexity(model, loader, device):
+    """Plain (no label smoothing) perplexity of a model over a loader"""
+    model.eval()
+    total_nll = 0.0
+    total_tokens = 0
+    for x, y in loader:
+        x = x.to(device)
+        y = y.to(device)
+        logits = model(x)
+        total_nll += F.cross_entropy(logits.reshape(-1, logits.size(-1)), y.reshape(-1), reduction="sum").item()
+        total_tokens += y.numel()
+    return torch.exp(torch.tensor(total_nll / max(total_tokens, 1))).item()
@@ -1,4 +1,5 @@
 import torch
+import torch.nn.functional as F
 from torch import nn
 
 
@@ -37,7 +38,18 @@ class GPT(nn.Module):
         self.seq_length = seq_length
         self.max_len = max_len
 
-    def forward(self, x):
+        # saved with checkpoints, so models of any size can be loaded back without knowing their shape
+        self.config = {
+            "embed_size": embed_size,
+            "num_heads": num_heads,
+            "num_layers": num_layers,
+            "seq_length": seq_length,
+            "max_len": max_len,
+            "dropout": dropout,
+        }
+
+    def hidden(self, x):
+        """Final hidden states, before the output projection"""
         batch_size, seq_length = x.size()
         positions = torch.arange(0, seq_length).unsqueeze(0).expand(batch_size, seq_length).to(x.device)
 
@@ -57,7 +69,17 @@ class GPT(nn.Module):
         else:
             x = self.transformer(x, mask=causal_mask)
 
-        x = self.ln_f(x)
-        logits = self.fc_out(x)
+        return self.ln_f(x)
+
+    def forward(self, x):
+        logits = self.fc_out(self.hidden(x))
 
         return logits
+
+    def project(self, h, start=0, end=None):
+        """Logits for the vocabulary slice [start, end) only, the rest of the output layer is never computed"""
+        if isinstance(self.fc_out, nn.Linear):
+            bias = self.fc_out.bias[start:end] if self.fc_out.bias is not None else None
+            return F.linear(h, self.fc_out.weight[start:end], bias)
+        # quantized output layers can't be sliced
+        return self.fc_out(h)[..., start:end]
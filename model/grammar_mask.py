@@ -1,3 +1,11 @@
+import numpy as np
+
+# more chords than this in a row must be followed by a harp
+MAX_CHORD_RUN = 3
+# after this many harps in a row we force a chord
+MAX_HARP_RUN = 12
+
+
 # if it starts with "H" it's a harp, else it's a chord
 def is_harp(tok):
     if not isinstance(tok, str): return False
@@ -41,7 +49,7 @@ def build_allowed_mask(id_to_tok, history):
             break
 
     if is_chord(last_tok):
-        if num_consecutive_chords > 2:
+        if num_consecutive_chords >= MAX_CHORD_RUN:
             # must be followed by a harp
             for idx in id_to_tok:
                 if is_harp(id_to_tok[idx]):
@@ -53,7 +61,7 @@ def build_allowed_mask(id_to_tok, history):
                     mask[idx] = 1
 
     elif is_harp(last_tok):
-        if num_consecutive_harps >= 12:
+        if num_consecutive_harps >= MAX_HARP_RUN:
             # after 12 harps, we force a chord so it doesnt sound too weird or repetitive
             for idx in id_to_tok:
                 if is_chord(id_to_tok[idx]):
@@ -69,3 +77,75 @@ def build_allowed_mask(id_to_tok, history):
         mask = [1] * len(id_to_tok)
 
     return mask
+
+
+def grammar_violations(chords, first_has_history=False):
+    """
+    Vectorized version of the build_allowed_mask rules over a whole sequence.
+    `chords` is a boolean array (True for chords). Returns a boolean array, True where the token
+    would not have been allowed after the ones before it.
+    """
+    chords = np.asarray(chords, dtype=bool)
+    n = len(chords)
+    violations = np.zeros(n, dtype=bool)
+    if n == 0:
+        return violations
+
+    # the first token must be a chord, unless it continues an earlier sequence
+    if not first_has_history:
+        violations[0] = not chords[0]
+
+    # length of the run of same-kind tokens ending at each position
+    idx = np.arange(n)
+    run_starts = np.concatenate(([True], chords[1:] != chords[:-1]))
+    run_len = idx - np.maximum.accumulate(np.where(run_starts, idx, 0)) + 1
+
+    prev_chord = chords[:-1]
+    prev_run = run_len[:-1]
+    current_chord = chords[1:]
+    violations[1:] = (prev_chord & (prev_run >= MAX_CHORD_RUN) & current_chord) | \
+                     (~prev_chord & (prev_run >= MAX_HARP_RUN) & ~current_chord)
+    return violations
+
+
+def allowed_range(last_is_chord, run_length, n_chords, vocab_size):
+    """
+    The build_allowed_mask rules for a vocabulary ordered with chords at [0, n_chords) and harps after them
+    (see reorder_vocabulary): every possible mask is then one contiguous id range.
+    `last_is_chord` is None for an empty history, `run_length` counts the same-kind tokens at its end.
+    Returns (start, end)
+    """
+    if last_is_chord is None:
+        start, end = 0, n_chords
+    elif last_is_chord and run_length >= MAX_CHORD_RUN:
+        start, end = n_chords, vocab_size
+    elif not last_is_chord and run_length >= MAX_HARP_RUN:
+        start, end = 0, n_chords
+    else:
+        start, end = 0, vocab_size
+
+    # if there's nothing we just allow everything so it doesnt get stuck
+    if start == end:
+        return 0, vocab_size
+    return start, end
+
+
+class GrammarChecker:
+    """
+    Counts grammar violations over a stream that arrives in pieces, runs continue from one piece to the next.
+    `history` holds the kinds (True for chords) of the tokens right before the stream, e.g. for a shard
+    of a file; without it the first token fed is the start of the stream and must be a chord.
+    """
+
+    def __init__(self, history=()):
+        # a run only matters up to MAX_HARP_RUN long, so that much of the past is enough
+        self.tail = np.asarray(history, dtype=bool)[-MAX_HARP_RUN:]
+        self.violations = 0
+
+    def feed(self, chords):
+        sequence = np.concatenate((self.tail, np.asarray(chords, dtype=bool)))
+        # with a tail its first token is not checked, it was (or belongs to whoever was) before
+        violations = grammar_violations(sequence, first_has_history=False)[len(self.tail):]
+        self.violations += int(violations.sum())
+        self.tail = sequence[-MAX_HARP_RUN:]
+        return violations
@@ -0,0 +1,98 @@
+import math
+
+import torch
+from torch import nn
+from torch.nn.utils import parametrize
+
+from util import vocab_fingerprint
+
+ADAPTER_VERSION = 1
+
+
+class LoRA(nn.Module):
+    """Parametrization that adds a trainable low-rank delta (B @ A) to a frozen weight"""
+
+    def __init__(self, out_features, in_features, rank=4, alpha=8.0):
+        super().__init__()
+        self.A = nn.Parameter(torch.empty(rank, in_features))
+        # B starts at zero, so before any training the adapted model is exactly the base model
+        self.B = nn.Parameter(torch.zeros(out_features, rank))
+        nn.init.kaiming_uniform_(self.A, a=math.sqrt(5))
+        self.scale = alpha / rank
+
+    def delta(self):
+        return (self.B @ self.A) * self.scale
+
+    def forward(self, weight):
+        return weight + self.delta()
+
+
+def lora_targets(model):
+    """(name, module, parameter name) of every attention and feed-forward projection of a GPT"""
+    for i, layer in enumerate(model.transformer.layers):
+        prefix = f"transformer.layers.{i}"
+        # query/key/value are packed into a single weight
+        yield f"{prefix}.self_attn.in_proj_weight", layer.self_attn, "in_proj_weight"
+        yield f"{prefix}.self_attn.out_proj.weight", layer.self_attn.out_proj, "weight"
+        yield f"{prefix}.linear1.weight", layer.linear1, "weight"
+        yield f"{prefix}.linear2.weight", layer.linear2, "weight"
+
+
+def add_lora(model, rank=4, alpha=8.0):
+    """Freezes every weight of the model and attaches adapters. Returns the adapter parameters to train"""
+    for p in model.parameters():
+        p.requires_grad_(False)
+
+    params = []
+    for _, module, name in lora_targets(model):
+        out_features, in_features = getattr(module, name).shape
+        adapter = LoRA(out_features, in_features, rank, alpha).to(getattr(module, name).device)
+        parametrize.register_parametrization(module, name, adapter)
+        params.extend(adapter.parameters())
+    return params
+
+
+def remove_lora(model):
+    """Takes the adapters off again, leaving the base weights as they were (and still frozen)"""
+    for _, module, name in lora_targets(model):
+        if parametrize.is_parametrized(module, name):
+            parametrize.remove_parametrizations(module, name, leave_parametrized=False)
+
+
+def save_adapter(model, path, itos, base=None):
+    """Writes only the adapter matrices, a few kilobytes, tagged with the base vocabulary"""
+    deltas = {}
+    rank = alpha = None
+    for key, module, name in lora_targets(model):
+        adapter = module.parametrizations[name][0]
+        deltas[key] = {"A": adapter.A.detach().cpu(), "B": adapter.B.detach().cpu()}
+        rank = adapter.A.shape[0]
+        alpha = adapter.scale * rank
+
+    torch.save({
+        "version": ADAPTER_VERSION,
+        "base": base,
+        "vocab": vocab_fingerprint(itos),
+        "rank": rank,
+        "alpha": alpha,
+        "deltas": deltas,
+    }, path)
+
+
+def merge_adapter(model, path, itos):
+    """Adds the deltas of an adapter file into the weights, leaving a plain GPT that runs at full speed"""
+    with open(path, "rb") as f:
+        adapter = torch.load(f, map_location="cpu")
+
+    if adapter.get("version") != ADAPTER_VERSION:
+        raise ValueError(f"{path}: unsupported adapter version {adapter.get('version')}")
+    if adapter["vocab"] != vocab_fingerprint(itos):
+        raise ValueError(f"{path} was trained on another vocabulary than the model it is merged into")
+
+    scale = adapter["alpha"] / adapter["rank"]
+    with torch.no_grad():
+        for key, module, name in lora_targets(model):
+            weight = getattr(module, name)
+            delta = adapter["deltas"][key]
+            weight += (delta["B"] @ delta["A"]).to(weight.device, weight.dtype) * scale
+    return model
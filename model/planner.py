@@ -0,0 +1,233 @@
+import math
+import os
+import sys
+import threading
+import time
+
+import torch
+
+try:
+    import resource
+except ImportError:
+    # windows
+    resource = None
+
+from model.distill import distillation_loss
+from model.gpt import GPT
+from model.lora import add_lora, remove_lora
+
+# fraction of the device memory the planner may fill
+MEMORY_BUDGET_FRACTION = 0.8
+# trial steps per candidate, the first one is a warmup and is not timed
+TRIAL_STEPS = 3
+MIN_MICRO_BATCH = 4
+
+
+class BatchPlan:
+    """What the planner settled on for this machine"""
+
+    def __init__(self, micro_batch, accumulation_steps, gradient_checkpointing, peak_bytes, tokens_per_sec,
+                 budget_bytes):
+        self.micro_batch = micro_batch
+        self.accumulation_steps = accumulation_steps
+        self.gradient_checkpointing = gradient_checkpointing
+        self.peak_bytes = peak_bytes
+        self.tokens_per_sec = tokens_per_sec
+        self.budget_bytes = budget_bytes
+
+    def __repr__(self):
+        return (f"BatchPlan(micro_batch={self.micro_batch}, accumulation_steps={self.accumulation_steps}, "
+                f"gradient_checkpointing={self.gradient_checkpointing}, peak={self.peak_bytes / 2 ** 20:.0f}MiB, "
+                f"tokens_per_sec={self.tokens_per_sec:.0f})")
+
+
+def device_memory(device):
+    """Total memory usable by tensors on `device`, in bytes"""
+    if device.type == "cuda":
+        _, total = torch.cuda.mem_get_info(device)
+        return total
+    if device.type == "mps":
+        return torch.mps.recommended_max_memory()
+    return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+
+
+def _max_rss_bytes():
+    if resource is None:
+        return 0
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # linux reports kilobytes, macOS bytes
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def _rss_bytes():
+    """Resident memory of the process right now. Where that can not be read, the high-water mark instead"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return _max_rss_bytes()
+
+
+class MemoryMeter:
+    """
+    Memory used by a stretch of work, from reset() to peak().
+    On cuda, the exact peak of allocated memory. On cpu, how far resident memory rose above its level at reset,
+    sampled every `interval` seconds by a background thread. On mps there is no peak, so it is the allocator's
+    current footprint (`kind` says which, for logs)
+    """
+
+    def __init__(self, device, interval=0.005):
+        self.device = device
+        self.kind = "current" if device.type == "mps" else "peak"
+        self.interval = interval
+        self._baseline = 0
+        self._high = 0
+        self._sampler = None
+
+    def _sample(self):
+        while True:
+            rss = _rss_bytes()
+            if rss > self._high:
+                self._high = rss
+            time.sleep(self.interval)
+
+    def reset(self):
+        if self.device.type == "cuda":
+            torch.cuda.synchronize(self.device)
+            torch.cuda.reset_peak_memory_stats(self.device)
+        elif self.device.type == "mps":
+            torch.mps.synchronize()
+        else:
+            self._baseline = self._high = _rss_bytes()
+            if self._sampler is None:
+                self._sampler = threading.Thread(target=self._sample, daemon=True, name="memory-meter")
+                self._sampler.start()
+
+    def peak(self):
+        if self.device.type == "cuda":
+            return torch.cuda.max_memory_allocated(self.device)
+        if self.device.type == "mps":
+            return torch.mps.driver_allocated_memory()
+        return max(0, max(self._high, _rss_bytes()) - self._baseline)
+
+    def synchronize(self):
+        if self.device.type == "cuda":
+            torch.cuda.synchronize(self.device)
+        elif self.device.type == "mps":
+            torch.mps.synchronize()
+
+
+def _is_oom(error):
+    if isinstance(error, torch.cuda.OutOfMemoryError):
+        return True
+    return isinstance(error, RuntimeError) and "out of memory" in str(error).lower()
+
+
+def _free(device):
+    if device.type == "cuda":
+        torch.cuda.empty_cache()
+    elif device.type == "mps":
+        torch.mps.empty_cache()
+
+
+def _trial(vocab_size, seq_length, micro_batch, gradient_checkpointing, device, meter, steps, model_kwargs,
+           teacher=None, base_model=None, lora=None):
+    """
+    Runs a few training steps shaped like the real run. Returns (peak bytes, tokens/sec).
+    The model is a throwaway GPT, or `base_model` with temporary adapters of `lora` = (rank, alpha)
+    when fine-tuning. With a `teacher`, each step also runs it as distillation does
+    """
+    if base_model is not None:
+        model = base_model
+        model.gradient_checkpointing = gradient_checkpointing
+        params = add_lora(model, *lora)
+    else:
+        model = GPT(vocab_size=vocab_size, seq_length=seq_length, gradient_checkpointing=gradient_checkpointing,
+                    **model_kwargs).to(device)
+        params = model.parameters()
+    model.train()
+    optimizer = torch.optim.AdamW(params, lr=3e-4)
+    criterion = torch.nn.CrossEntropyLoss()
+    x = torch.randint(0, vocab_size, (micro_batch, seq_length), device=device)
+    y = torch.randint(0, vocab_size, (micro_batch, seq_length), device=device)
+
+    try:
+        meter.reset()
+        started = 0.0
+        for step in range(steps):
+            if step == 1:
+                meter.synchronize()
+                started = time.perf_counter()
+            logits = model(x)
+            if teacher is not None:
+                with torch.no_grad():
+                    teacher_logits = teacher(x)
+                loss = distillation_loss(logits, teacher_logits, y, criterion)
+            else:
+                loss = criterion(logits.reshape(-1, vocab_size), y.reshape(-1))
+            loss.backward()
+            optimizer.step()
+            optimizer.zero_grad(set_to_none=True)
+        meter.synchronize()
+        elapsed = time.perf_counter() - started
+        timed_steps = max(1, steps - 1)
+        return meter.peak(), micro_batch * seq_length * timed_steps / max(elapsed, 1e-9)
+    finally:
+        if base_model is not None:
+            remove_lora(base_model)
+        del model, params, optimizer, x, y
+        _free(device)
+
+
+def plan_batch(vocab_size, effective_batch, device, seq_length=64, budget_fraction=MEMORY_BUDGET_FRACTION,
+               steps=TRIAL_STEPS, log=print, teacher=None, base_model=None, lora=None, **model_kwargs):
+    """
+    Finds the micro-batch size and checkpointing setting with the best throughput that stays under
+    `budget_fraction` of the device memory, and the accumulation steps that keep the effective batch.
+    Micro-batches are powers of two up to `effective_batch`; each setting stops growing at the first
+    candidate that runs out of memory, goes over budget or gets slower.
+    Pass the run's `teacher` when distilling, and the `base_model` with its `lora` (rank, alpha) when
+    fine-tuning, so the trials train what the run will (both must already be on `device`).
+    """
+    budget = int(device_memory(device) * budget_fraction)
+    meter = MemoryMeter(device)
+    best = None
+
+    for gradient_checkpointing in (False, True):
+        micro_batch = MIN_MICRO_BATCH
+        previous_rate = 0.0
+        while micro_batch <= effective_batch:
+            try:
+                peak, rate = _trial(vocab_size, seq_length, micro_batch, gradient_checkpointing, device, meter,
+                                    steps, model_kwargs, teacher, base_model, lora)
+            except (RuntimeError, MemoryError) as e:
+                if not _is_oom(e) and not isinstance(e, MemoryError):
+                    raise
+                _free(device)
+                log(f"  micro-batch {micro_batch:>4} checkpointing={gradient_checkpointing}: out of memory")
+                break
+
+            log(f"  micro-batch {micro_batch:>4} checkpointing={gradient_checkpointing}: "
+                f"{meter.kind} {peak / 2 ** 20:.0f}MiB, {rate:.0f} tokens/sec")
+            if peak > budget:
+                break
+
+            if best is None or rate > best.tokens_per_sec:
+                best = BatchPlan(micro_batch, math.ceil(effective_batch / micro_batch), gradient_checkpointing,
+                                 peak, rate, budget)
+            if rate < previous_rate:
+                # bigger batches stopped paying off
+                break
+            previous_rate = rate
+            micro_batch *= 2
+
+        if best is not None and not best.gradient_checkpointing and best.micro_batch >= effective_batch:
+            # the whole effective batch fits without checkpointing, recomputing activations can only be slower
+            break
+
+    if best is None:
+        # not even the smallest batch fits the budget, fall back to the most frugal setting
+        best = BatchPlan(MIN_MICRO_BATCH, math.ceil(effective_batch / MIN_MICRO_BATCH), True, 0, 0.0, budget)
+
+    log(f"Batch plan: {best} (budget {budget / 2 ** 20:.0f}MiB)")
+    return best
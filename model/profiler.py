@@ -0,0 +1,184 @@
+import os
+import time
+
+import torch
+
+from model.planner import MemoryMeter
+
+# the phases of a training step, in the order they run
+PHASES = ("data", "to_device", "forward", "backward", "grad_norm", "optimizer", "progress")
+
+
+class _Phase:
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+        self._record = None
+
+    def __enter__(self):
+        meter = self.profiler.meter
+        # everything queued before belongs to the previous phase
+        meter.reset()
+        self._record = torch.profiler.record_function(self.name)
+        self._record.__enter__()
+        self._started = time.perf_counter()
+
+    def __exit__(self, *exc):
+        meter = self.profiler.meter
+        meter.synchronize()
+        elapsed = time.perf_counter() - self._started
+        self._record.__exit__(*exc)
+        self.profiler._add(self.name, elapsed, meter.peak())
+        return False
+
+
+class _NoPhase:
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NO_PHASE = _NoPhase()
+
+
+class StepProfiler:
+    """
+    Times the phases of a window of training steps (micro-batches), and runs the torch profiler over it.
+    Phases wait for the device before and after, so asynchronous gpu work lands in the phase that queued it;
+    the window runs a little slower than normal training because of that.
+    Outside the window, or when not `enabled`, every call is a no-op.
+    """
+
+    def __init__(self, device, start_step=10, steps=20, trace_file=None, torch_profiler=True, enabled=True):
+        self.enabled = enabled
+        self.device = device
+        self.start_step = start_step
+        self.end_step = start_step + steps
+        self.trace_file = trace_file
+        self.use_torch_profiler = torch_profiler
+        self.meter = MemoryMeter(device)
+
+        self.step_index = 0
+        self.tokens = 0
+        # phase name -> [calls, seconds, peak bytes]
+        self.phases = {name: [0, 0.0, 0] for name in PHASES}
+        self._window_started = None
+        self._window_open = False
+        self.window_seconds = 0.0
+        self._mark = None
+        self._torch_profiler = None
+
+    @property
+    def active(self):
+        return self.enabled and self.start_step <= self.step_index < self.end_step
+
+    @property
+    def done(self):
+        return self.enabled and self.step_index >= self.end_step
+
+    def phase(self, name):
+        """Context manager timing one phase of the current step"""
+        return _Phase(self, name) if self.active else _NO_PHASE
+
+    def _add(self, name, seconds, peak):
+        stats = self.phases.setdefault(name, [0, 0.0, 0])
+        stats[0] += 1
+        stats[1] += seconds
+        stats[2] = max(stats[2], peak)
+
+    def mark(self):
+        """Starts the clock of the data phase, e.g. right before iterating over a new epoch"""
+        self._mark = time.perf_counter()
+
+    def begin_step(self):
+        """Called first thing in a step: the time since the last step ended went to loading the batch"""
+        if self.enabled and self.step_index == self.start_step and self._window_started is None:
+            self._start_window()
+        if self.active and self._mark is not None:
+            self._add("data", time.perf_counter() - self._mark, 0)
+
+    def end_step(self, tokens):
+        """Called last thing in a step with the number of tokens it trained on"""
+        if self.active:
+            self.tokens += tokens
+        self.step_index += 1
+        if self.enabled and self.step_index == self.end_step:
+            self._stop_window()
+        self.mark()
+
+    def _start_window(self):
+        if self.use_torch_profiler:
+            activities = [torch.profiler.ProfilerActivity.CPU]
+            if self.device.type == "cuda":
+                activities.append(torch.profiler.ProfilerActivity.CUDA)
+            self._torch_profiler = torch.profiler.profile(activities=activities, profile_memory=True)
+            self._torch_profiler.__enter__()
+        self.meter.synchronize()
+        self._window_started = time.perf_counter()
+        self._window_open = True
+
+    def _stop_window(self):
+        if not self._window_open:
+            return
+        self._window_open = False
+        self.meter.synchronize()
+        self.window_seconds = time.perf_counter() - self._window_started
+        if self._torch_profiler is not None:
+            self._torch_profiler.__exit__(None, None, None)
+
+    def summary(self):
+        """One row per phase: calls, total and mean ms, share of the window, tokens/sec, peak MiB"""
+        rows = []
+        for name, (calls, seconds, peak) in self.phases.items():
+            if calls == 0:
+                continue
+            rows.append({
+                "phase": name,
+                "calls": calls,
+                "total_ms": seconds * 1000.0,
+                "mean_ms": seconds / calls * 1000.0,
+                "share": seconds / max(self.window_seconds, 1e-9),
+                # how fast training would go if this phase were all there was
+                "tokens_per_sec": self.tokens / max(seconds, 1e-9),
+                "peak_mib": peak / 2 ** 20,
+            })
+        return rows
+
+    def report(self, summary_file=None, log=print):
+        """
+        Prints the phase table (and writes it to `summary_file`), exports the torch trace.
+        A window that training did not get to the end of is closed here, over the steps it did get
+        """
+        self._stop_window()
+        lines = [f"{'phase':<12} {'calls':>6} {'total ms':>10} {'mean ms':>9} {'share':>7} {'tok/s':>10} "
+                 f"{'peak MiB':>9}"]
+        for row in self.summary():
+            lines.append(f"{row['phase']:<12} {row['calls']:>6} {row['total_ms']:>10.1f} {row['mean_ms']:>9.2f} "
+                         f"{row['share']:>7.1%} {row['tokens_per_sec']:>10.0f} {row['peak_mib']:>9.0f}")
+        steps = max(0, min(self.step_index, self.end_step) - self.start_step)
+        lines.append(f"{steps} steps, {self.tokens} tokens in {self.window_seconds:.2f}s "
+                     f"({self.tokens / max(self.window_seconds, 1e-9):.0f} tokens/sec)")
+        if self.device.type == "cpu":
+            lines.append("peak MiB on cpu is how far resident memory rose during the phase, sampled every few ms")
+        elif self.device.type == "mps":
+            lines.append("peak MiB on mps is the allocator's footprint at the end of the phase, mps keeps no peak")
+
+        if self._torch_profiler is not None:
+            sort_by = "self_cuda_time_total" if self.device.type == "cuda" else "self_cpu_time_total"
+            lines.append("")
+            lines.append(self._torch_profiler.key_averages().table(sort_by=sort_by, row_limit=15))
+
+        text = "\n".join(lines)
+        log(text)
+        if summary_file is not None:
+            os.makedirs(os.path.dirname(summary_file) or ".", exist_ok=True)
+            with open(summary_file, "w") as f:
+                f.write(text + "\n")
+
+        if self._torch_profiler is not None and self.trace_file is not None:
+            os.makedirs(os.path.dirname(self.trace_file) or ".", exist_ok=True)
+            # open it in chrome://tracing or https://ui.perfetto.dev
+            self._torch_profiler.export_chrome_trace(self.trace_file)
+            log(f"Trace written to {self.trace_file}")
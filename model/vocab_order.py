@@ -0,0 +1,39 @@
+import torch
+
+from model.grammar_mask import is_chord
+
+
+def chords_first(itos):
+    """Old ids in their new order, chords then harps, and the number of chords"""
+    old_ids = sorted(itos)
+    chords = [i for i in old_ids if is_chord(itos[i])]
+    harps = [i for i in old_ids if not is_chord(itos[i])]
+    return chords + harps, len(chords)
+
+
+def reordered_vocabulary(itos):
+    """(stoi, itos, n_chords) that reorder_vocabulary gives a model with this vocabulary, without the model"""
+    order, n_chords = chords_first(itos)
+    new_itos = {new_id: itos[old_id] for new_id, old_id in enumerate(order)}
+    new_stoi = {token: i for i, token in new_itos.items()}
+    return new_stoi, new_itos, n_chords
+
+
+def reorder_vocabulary(model, stoi, itos):
+    """
+    Renumbers the vocabulary so chord tokens take ids [0, n_chords) and harp tokens the ids after them,
+    permuting the embedding (and the output layer tied to it) to match. The model computes exactly the
+    same distributions, but every grammar mask becomes a contiguous slice of the output layer.
+    Returns (stoi, itos, n_chords)
+    """
+    order, _ = chords_first(itos)
+
+    perm = torch.tensor(order, dtype=torch.long, device=model.embedding.weight.device)
+    with torch.no_grad():
+        model.embedding.weight.copy_(model.embedding.weight[perm])
+        if model.fc_out.weight is not model.embedding.weight:
+            model.fc_out.weight.copy_(model.fc_out.weight[perm])
+        if model.fc_out.bias is not None:
+            model.fc_out.bias.copy_(model.fc_out.bias[perm])
+
+    return reordered_vocabulary(itos)
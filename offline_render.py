@@ -0,0 +1,268 @@
+import argparse
+import os
+import time
+import wave
+from multiprocessing import Pool
+
+import numpy as np
+
+from constants import CHORD_SLOWDOWN, HARP_SLOWDOWN, HARP_CHANNELS, SAMPLE_RATE, INITIAL_PROMPT, \
+    TOKEN_CUTOFF_FOR_GEN, DEFAULT_TEMPERATURE, DEFAULT_TOP_P, MAX_GENERATION_LENGTH
+from events import CHORD, HARP, parse_tokens
+from sound_bank import get_sound_bank
+
+
+class Voice:
+    """One sound placed on the timeline, in frames. Loops are repeated until `end`"""
+    __slots__ = ("start", "end", "pcm", "loop")
+
+    def __init__(self, start, end, pcm, loop=False):
+        self.start = start
+        self.end = end
+        self.pcm = pcm
+        self.loop = loop
+
+
+class VoiceState:
+    """What live playback carries from one sequence to the next: the chord, and the harp channel rotation"""
+    __slots__ = ("chord_name", "harp_index", "harp_voices")
+
+    def __init__(self, harp_channels=HARP_CHANNELS):
+        self.chord_name = None
+        self.harp_index = 0
+        # what is currently playing on each harp channel
+        self.harp_voices = [None] * harp_channels
+
+
+class OfflineRenderer:
+    """
+    Renders token sequences to pcm with the same rules as AudioManager: the chord loops on its own channel
+    until the next chord, and harp notes rotate over HARP_CHANNELS channels, cutting whatever played there before.
+    """
+
+    def __init__(self, bank=None, slow_down_chord=CHORD_SLOWDOWN, slow_down_harp=HARP_SLOWDOWN,
+                 harp_channels=HARP_CHANNELS, rate=SAMPLE_RATE):
+        self.bank = bank if bank is not None else get_sound_bank()
+        self.slow_down_chord = slow_down_chord
+        self.slow_down_harp = slow_down_harp
+        self.harp_channels = harp_channels
+        self.rate = rate
+
+    def frames(self, events):
+        """Start frame of every event, and the frame where the sequence ends"""
+        durations = [e.duration_ms * (self.slow_down_chord if e.kind == CHORD else self.slow_down_harp)
+                     for e in events]
+
+        # every start time at once, rounded to frames
+        ends = np.rint(np.cumsum(durations, dtype=np.float64) * self.rate / 1000.0).astype(np.int64)
+        starts = np.concatenate(([0], ends[:-1])) if len(ends) else ends
+        end_frame = int(ends[-1]) if len(ends) else 0
+        return starts, end_frame
+
+    def voices(self, events, state=None, offset=0):
+        """
+        Turns TokenEvents into voices placed from frame `offset`, returns them with the frame where the sequence
+        ends (relative to `offset`). `state` carries the chord and the harp rotation over from the previous
+        sequence, as live playback does, and is updated for the next one
+        """
+        starts, end_frame = self.frames(events)
+        if state is None:
+            state = VoiceState(self.harp_channels)
+        chord_name = state.chord_name
+        harp_voices = state.harp_voices
+        harp_index = state.harp_index
+
+        voices = []
+        chord_voice = None
+
+        for event, start in zip(events, (starts + offset).tolist()):
+            if event.kind == CHORD:
+                if chord_voice is not None:
+                    chord_voice.end = start
+                pcm = self.bank.pcm(event.name)
+                if pcm is None:
+                    continue
+                chord_name = event.name
+                chord_voice = Voice(start, offset + end_frame, pcm, loop=True)
+                voices.append(chord_voice)
+
+            elif event.kind == HARP and chord_name is not None:
+                pcm = self.bank.pcm(chord_name, event.harp)
+                if pcm is None:
+                    continue
+
+                previous = harp_voices[harp_index]
+                if previous is not None and previous.end > start:
+                    previous.end = start
+
+                voice = Voice(start, start + len(pcm), pcm)
+                harp_voices[harp_index] = voice
+                harp_index = (harp_index + 1) % self.harp_channels
+                voices.append(voice)
+
+        state.chord_name = chord_name
+        state.harp_index = harp_index
+        return voices, end_frame
+
+    @staticmethod
+    def mix(voices, start, end, out=None):
+        """Adds every voice overlapping [start, end) into an int32 buffer of end - start frames"""
+        if out is None:
+            out = np.zeros((end - start, 2), dtype=np.int32)
+
+        for voice in voices:
+            lo = max(voice.start, start)
+            hi = min(voice.end, end)
+            if hi <= lo:
+                continue
+
+            offset = lo - voice.start
+            if voice.loop:
+                length = len(voice.pcm)
+                # index the loop cyclically, so a long chord is one gather instead of many copies
+                idx = np.arange(offset, offset + hi - lo) % length
+                out[lo - start:hi - start] += voice.pcm[idx]
+            else:
+                out[lo - start:hi - start] += voice.pcm[offset:offset + hi - lo]
+
+        return out
+
+    def render(self, events):
+        """Renders a whole sequence, letting the last harp notes ring out"""
+        voices, end_frame = self.voices(events)
+        total = max([end_frame] + [v.end for v in voices if not v.loop])
+        mixed = self.mix(voices, 0, total)
+        return np.clip(mixed, -32768, 32767).astype(np.int16)
+
+    def render_sequences(self, sequences):
+        """
+        Renders sequences back to back like live playback: the chord loops on into the next sequence until
+        that one changes it, and the harp rotation continues where the previous sequence left it
+        """
+        state = VoiceState(self.harp_channels)
+        voices = []
+        chord_voice = None
+        end_frame = 0
+        for events in sequences:
+            placed, length = self.voices(events, state, offset=end_frame)
+            loops = [v for v in placed if v.loop]
+            if chord_voice is not None:
+                chord_voice.end = loops[0].start if loops else end_frame + length
+            if loops:
+                chord_voice = loops[-1]
+            voices.extend(placed)
+            end_frame += length
+
+        total = max([end_frame] + [v.end for v in voices if not v.loop])
+        mixed = self.mix(voices, 0, total)
+        return np.clip(mixed, -32768, 32767).astype(np.int16)
+
+    def write_wav(self, pcm, path):
+        with wave.open(path, "wb") as f:
+            f.setnchannels(2)
+            f.setsampwidth(2)
+            f.setframerate(self.rate)
+            f.writeframes(np.ascontiguousarray(pcm).tobytes())
+
+    def render_to_wav(self, events, path):
+        pcm = self.render(events)
+        self.write_wav(pcm, path)
+        return len(pcm) / self.rate
+
+
+def generate_piece(seconds, max_len=MAX_GENERATION_LENGTH, temperature=DEFAULT_TEMPERATURE, top_p=DEFAULT_TOP_P,
+                   renderer=None):
+    """
+    Keeps generating like the app does, continuing from the tail, until the piece is long enough.
+    Returns the sequences as they would play, the initial prompt first, for render_sequences
+    """
+    from infer import encode, events, generate_ids
+
+    renderer = renderer if renderer is not None else OfflineRenderer()
+    ids = encode(INITIAL_PROMPT)
+    sequences = [events.lookup(ids)]
+    # in frames, counted per sequence like render_sequences places them, the initial prompt included
+    length = renderer.frames(sequences[0])[1]
+    while length < seconds * renderer.rate:
+        prompt = ids[-TOKEN_CUTOFF_FOR_GEN:]
+        # generate echoes the prompt back, we only keep the new part
+        new_ids = generate_ids(prompt, max_len=max_len, temperature=temperature, top_p=top_p)[len(prompt):]
+        if not new_ids:
+            break
+        ids.extend(new_ids)
+        sequences.append(events.lookup(new_ids))
+        length += renderer.frames(sequences[-1])[1]
+    return sequences
+
+
+_worker_renderer = None
+
+
+def _init_worker(threads, slow_down_chord, slow_down_harp):
+    global _worker_renderer
+    os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+    import torch
+    torch.set_num_threads(threads)
+    _worker_renderer = OfflineRenderer(slow_down_chord=slow_down_chord, slow_down_harp=slow_down_harp)
+
+
+def _render_job(job):
+    index, seed, out_dir, seconds, max_len, temperature, top_p = job
+    import torch
+    torch.manual_seed(seed)
+
+    started = time.time()
+    sequences = generate_piece(seconds, max_len, temperature, top_p, renderer=_worker_renderer)
+    path = os.path.join(out_dir, f"piece_{index:04d}.wav")
+    pcm = _worker_renderer.render_sequences(sequences)
+    _worker_renderer.write_wav(pcm, path)
+    return path, len(pcm) / _worker_renderer.rate, time.time() - started
+
+
+def render_batch(count, out_dir, seconds=60.0, processes=None, seed=0, max_len=MAX_GENERATION_LENGTH,
+                 temperature=DEFAULT_TEMPERATURE, top_p=DEFAULT_TOP_P, slow_down_chord=CHORD_SLOWDOWN,
+                 slow_down_harp=HARP_SLOWDOWN):
+    """Generates and renders `count` pieces in parallel, one model per process"""
+    os.makedirs(out_dir, exist_ok=True)
+    processes = processes or os.cpu_count() or 1
+    threads = max(1, (os.cpu_count() or 1) // processes)
+
+    # decode (or write the packed cache) once here, so workers just memory-map it
+    bank = get_sound_bank()
+    bank.wait()
+    bank.save_cache()
+
+    jobs = [(i, seed + i, out_dir, seconds, max_len, temperature, top_p) for i in range(count)]
+    with Pool(processes, initializer=_init_worker, initargs=(threads, slow_down_chord, slow_down_harp)) as pool:
+        for path, length, elapsed in pool.imap_unordered(_render_job, jobs):
+            print(f"{path}: {length:.1f}s of audio in {elapsed:.1f}s ({length / max(elapsed, 1e-9):.0f}x real-time)")
+
+
+if __name__ == "__main__":
+    # rendering never touches the sound card, so sdl can use its dummy driver if we need to decode
+    os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+
+    parser = argparse.ArgumentParser(description="Render omnisong pieces to wav without playing them")
+    parser.add_argument("--tokens", help="render an existing token file instead of generating")
+    parser.add_argument("--out", default="renders", help="output folder (or .wav file with --tokens)")
+    parser.add_argument("--count", type=int, default=1, help="how many pieces to generate")
+    parser.add_argument("--seconds", type=float, default=60.0, help="length of each generated piece")
+    parser.add_argument("--processes", type=int, default=None)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--chord-slowdown", type=float, default=CHORD_SLOWDOWN)
+    parser.add_argument("--harp-slowdown", type=float, default=HARP_SLOWDOWN)
+    args = parser.parse_args()
+
+    if args.tokens:
+        with open(args.tokens) as f:
+            token_list = f.read().split()
+        renderer = OfflineRenderer(slow_down_chord=args.chord_slowdown, slow_down_harp=args.harp_slowdown)
+        start_time = time.time()
+        out_path = args.out if args.out.endswith(".wav") else os.path.join(args.out, "render.wav")
+        os.makedirs(os.path.dirname(out_path) or ".", exist_ok=True)
+        audio_length = renderer.render_to_wav(parse_tokens(token_list), out_path)
+        render_time = time.time() - start_time
+        print(f"{out_path}: {audio_length:.1f}s of audio in {render_time:.2f}s")
+    else:
+        render_batch(args.count, args.out, seconds=args.seconds, processes=args.processes, seed=args.seed,
+                     slow_down_chord=args.chord_slowdown, slow_down_harp=args.harp_slowdown)
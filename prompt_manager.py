@@ -1,24 +1,136 @@
-from constants import INITIAL_PROMPT, TOKEN_CUTOFF_FOR_GEN, HISTORY_TOKEN_CUTOFF
+import os
+import struct
+import threading
+
+import numpy as np
+
+from constants import TOKEN_CUTOFF_FOR_GEN, HISTORY_TOKEN_CUTOFF
+
+# session snapshot layout: magic, version, capacity, stored tokens, total tokens generated, vocab fingerprint, ids
+SESSION_MAGIC = b"OMPH"
+SESSION_VERSION = 1
+SESSION_HEADER = struct.Struct("<4sIIIQ40s")
 
 
 class PromptManager:
-    def __init__(self):
-        self.history = []
+    """
+    Keeps the token ids played so far, used as the prompt for the next generation.
+    The history is a fixed-capacity ring stored twice back to back, so the newest tokens are always
+    a contiguous slice, copied out in one go. Playback appends to it while generation reads the prompt,
+    so every access goes through a lock and only copies leave it.
+    """
+
+    def __init__(self, initial_prompt_ids, capacity=HISTORY_TOKEN_CUTOFF):
+        self.initial_prompt_ids = np.asarray(initial_prompt_ids, dtype=np.int64)
+        self.capacity = capacity
+        self._ring = np.zeros(capacity * 2, dtype=np.int64)
+        # position right after the newest token, and how many tokens are stored
+        self._end = 0
+        self._count = 0
         self.total_tokens_gen = 0
+        # reentrant, remap and restore go through clear and append_to_history
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return self._count
+
+    def append_to_history(self, new_ids):
+        new_ids = np.asarray(new_ids, dtype=np.int64)[-self.capacity:]
+        n = len(new_ids)
+        if n == 0:
+            return
+
+        with self._lock:
+            positions = (self._end + np.arange(n)) % self.capacity
+            self._ring[positions] = new_ids
+            self._ring[positions + self.capacity] = new_ids
+
+            self._end = (self._end + n) % self.capacity
+            self._count = min(self.capacity, self._count + n)
+            self.total_tokens_gen += n
+
+    def drop_last(self, count):
+        """Forgets the newest `count` tokens, used when a chunk is cut before it finished playing"""
+        with self._lock:
+            count = min(count, self._count)
+            if count > 0:
+                self._end = (self._end - count) % self.capacity
+                self._count -= count
+                self.total_tokens_gen -= count
 
-    def append_to_history(self, new_tokens):
-        self.history.extend(new_tokens)
-        self.total_tokens_gen += len(new_tokens)
+    def _tail(self, count):
+        # a view into the ring, only for use under the lock
+        count = min(count, self._count)
+        stop = self._end + self.capacity
+        return self._ring[stop - count:stop]
 
-        if len(self.history) > HISTORY_TOKEN_CUTOFF:
-            self.history = self.history[-HISTORY_TOKEN_CUTOFF:]
+    def tail(self, count):
+        """Copy of the newest `count` tokens"""
+        with self._lock:
+            return self._tail(count).copy()
 
     def get_prompt(self):
-        if self.total_tokens_gen == 0:
-            return INITIAL_PROMPT
-        else:
-            return ' '.join(self.history[-TOKEN_CUTOFF_FOR_GEN:])
+        """Copy of the ids the next generation continues from, safe to hand to another thread"""
+        with self._lock:
+            if self.total_tokens_gen == 0:
+                return self.initial_prompt_ids.copy()
+            return self._tail(TOKEN_CUTOFF_FOR_GEN).copy()
+
+    def decode_tail(self, itos, count):
+        """The newest tokens as strings, for display only"""
+        return [itos[i] for i in self.tail(count).tolist()]
+
+    def remap(self, remap, initial_prompt_ids):
+        """
+        Rewrites the history into another vocabulary, `remap` maps a list of ids. The initial prompt is not
+        remapped, a token the new vocabulary lacks would leave it empty: `initial_prompt_ids` encodes it anew
+        """
+        with self._lock:
+            ids = remap(self._tail(self._count).tolist())
+            # tokens older than the ring still count, tokens the new vocabulary dropped do not
+            total = self.total_tokens_gen - self._count + len(ids)
+            self.initial_prompt_ids = np.asarray(initial_prompt_ids, dtype=np.int64)
+
+            self.clear()
+            self.append_to_history(ids)
+            self.total_tokens_gen = total
 
     def clear(self):
-        self.history = []
-        self.total_tokens_gen = 0
+        with self._lock:
+            self._end = 0
+            self._count = 0
+            self.total_tokens_gen = 0
+
+    def save(self, path, vocab_fingerprint):
+        """Writes the history to a compact binary snapshot"""
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            with self._lock:
+                f.write(SESSION_HEADER.pack(SESSION_MAGIC, SESSION_VERSION, self.capacity, self._count,
+                                            self.total_tokens_gen, vocab_fingerprint.encode()))
+                f.write(self._tail(self._count).astype(np.int32).tobytes())
+        os.replace(tmp_path, path)
+
+    def restore(self, path, vocab_fingerprint):
+        """Loads a snapshot written by save. Returns False if it is missing or made with another vocabulary"""
+        try:
+            with open(path, "rb") as f:
+                header = f.read(SESSION_HEADER.size)
+                magic, version, _, count, total, fingerprint = SESSION_HEADER.unpack(header)
+                if magic != SESSION_MAGIC or version != SESSION_VERSION:
+                    return False
+                if fingerprint.decode() != vocab_fingerprint:
+                    return False
+                ids = np.frombuffer(f.read(count * 4), dtype=np.int32)
+        except (OSError, struct.error, UnicodeDecodeError):
+            return False
+
+        if len(ids) != count:
+            return False
+
+        with self._lock:
+            self.clear()
+            self.append_to_history(ids)
+            self.total_tokens_gen = total
+        return True
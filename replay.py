@@ -0,0 +1,262 @@
+import argparse
+import json
+import random
+import sys
+import time
+
+from audio_player import NullAudioManager
+from constants import CHORD_SLOWDOWN, HARP_SLOWDOWN, INITIAL_PROMPT, MAX_GENERATION_LENGTH, TOKEN_CUTOFF_FOR_GEN, \
+    DEFAULT_TEMPERATURE, DEFAULT_TOP_P
+from events import EventTable
+from lookahead import Chunk, ChunkSizer, LookaheadBuffer
+from prompt_manager import PromptManager
+from scheduler import FakeClock
+from tracing import tracer, load_trace, summarize
+
+
+def table_from_vocab(vocab):
+    """EventTable of a vocabulary recorded in a trace"""
+    return EventTable({i: token for i, token in enumerate(vocab) if token is not None})
+
+
+class TraceSource:
+    """
+    Plays back the chunks of a recorded trace, each taking as long to 'generate' as it did live.
+    After a model swap in the trace, `table` is the vocabulary of the chunk just returned
+    """
+
+    def __init__(self, records):
+        self._chunks = []
+        table = None
+        for r in records:
+            if r["kind"] == "engine.swap":
+                table = table_from_vocab(r["vocab"])
+            elif r["kind"] == "generation.end":
+                self._chunks.append((r["ids"], r["seconds"], table))
+        self._next = 0
+        self.table = None
+
+    def generate(self, prompt, max_len):
+        if self._next >= len(self._chunks):
+            return None
+        ids, seconds, self.table = self._chunks[self._next]
+        self._next += 1
+        return ids, seconds
+
+
+class ModelSource:
+    """
+    Generates with the real model from a fixed seed. Each chunk costs the measured compute time,
+    or len / `rate` seconds when a rate is given, which makes the whole replay deterministic
+    """
+
+    def __init__(self, seed, temperature=DEFAULT_TEMPERATURE, top_p=DEFAULT_TOP_P, rate=None):
+        import torch
+        # loading infer loads the model, so only do it when we actually generate
+        from infer import generate_ids
+
+        torch.manual_seed(seed)
+        self._generate_ids = generate_ids
+        self.temperature = temperature
+        self.top_p = top_p
+        self.rate = rate
+
+    def generate(self, prompt, max_len):
+        started = time.perf_counter()
+        sequence = self._generate_ids(list(prompt), max_len=max_len, temperature=self.temperature,
+                                      top_p=self.top_p, debug=False)
+        elapsed = time.perf_counter() - started
+
+        new_ids = sequence[len(prompt):]
+        seconds = len(new_ids) / self.rate if self.rate else elapsed
+        return [int(i) for i in new_ids], seconds
+
+
+class _HeadlessWindow:
+    """The bits of the window the audio manager looks at"""
+    is_playing = True
+
+
+class Replay:
+    """
+    Runs the generation/look-ahead/playback pipeline on a fake clock, in one thread.
+    It does what GenerationThread and PlaybackThread do, with the same LookaheadBuffer, ChunkSizer and
+    scheduler, but the order of events only depends on the generation times, so every run is the same.
+    """
+
+    def __init__(self, table, source, initial_ids, slowdowns=(CHORD_SLOWDOWN, HARP_SLOWDOWN),
+                 max_len=MAX_GENERATION_LENGTH, jitter_ms=0.0, seed=0):
+        self.table = table
+        self.source = source
+        self.max_len = max_len
+        self.slowdowns = tuple(slowdowns)
+
+        # late OS wakeups, exponentially distributed around jitter_ms
+        rng = random.Random(seed)
+        overshoot = (lambda: rng.expovariate(1000.0 / jitter_ms)) if jitter_ms > 0 else None
+        self.clock = FakeClock(overshoot=overshoot)
+
+        self.prompt_manager = PromptManager(initial_ids)
+        self.lookahead = LookaheadBuffer(lambda: self.slowdowns,
+                                         on_take=lambda chunk: self.prompt_manager.append_to_history(chunk.ids),
+                                         clock=self.clock.now)
+        self.audio = NullAudioManager(_HeadlessWindow(), *self.slowdowns, clock=self.clock)
+        self.sizer = ChunkSizer()
+
+        # the generation in flight: (when it finishes, ids, compute seconds, its vocabulary)
+        self._pending = None
+        self._exhausted = False
+        self._serial = 0
+        # vocabulary of the last chunk generated, changes when the trace swapped models
+        self._table = table
+
+    def _pump(self):
+        """Catches generation up with the fake clock: delivers a finished chunk, or starts the next one"""
+        now = self.clock.now()
+        if self._pending is not None and now >= self._pending[0]:
+            _, ids, seconds, table = self._pending
+            self._pending = None
+            tracer.event("generation.end", tokens=len(ids), seconds=seconds, ids=ids)
+            self.lookahead.put(Chunk(ids, table.lookup(ids)))
+
+        if self._pending is None and not self._exhausted:
+            max_len = self.sizer.chunk_size(self.max_len)
+            if self.lookahead.level() < self.sizer.target_seconds(max_len):
+                prompt = self.lookahead.prompt(self.prompt_manager.get_prompt, TOKEN_CUTOFF_FOR_GEN)
+                tracer.event("generation.start", max_len=max_len, prompt=len(prompt))
+                result = self.source.generate(prompt, max_len)
+                if result is None:
+                    self._exhausted = True
+                else:
+                    ids, seconds = result
+                    self.sizer.observe(len(ids), seconds)
+                    table = getattr(self.source, "table", None) or self.table
+                    if table is not self._table:
+                        # recorded like a live swap, so this trace replays the same way
+                        tracer.event("engine.swap", vocab=[e.token if e is not None else None for e in table.events])
+                        self._table = table
+                    self._pending = (now + seconds, ids, seconds, table)
+        return True
+
+    def _on_event(self, index, event):
+        self.lookahead.set_progress(index)
+        tracer.event("note", serial=self._serial, index=index, token=event.token,
+                     late=self.audio.scheduler.lateness[-1])
+
+    def run(self, seconds):
+        """Replays up to `seconds` of music, or until the source runs out. Returns the trace"""
+        tracer.start(clock=self.clock.now)
+        # same header as a live trace, so a replay's trace can be replayed again
+        tracer.event("session.start", vocab=[e.token if e is not None else None for e in self.table.events],
+                     prompt=[int(i) for i in self.prompt_manager.get_prompt()], slowdowns=list(self.slowdowns),
+                     max_len=self.max_len)
+
+        self.audio.play_events(self.table.lookup(self.prompt_manager.get_prompt()), should_continue=self._pump)
+        idle_since = self.clock.now()
+
+        while self.clock.now() < seconds:
+            self._pump()
+            chunk = self.lookahead.get(timeout=0)
+            if chunk is None:
+                if self._pending is None:
+                    break
+                # playback starves until the chunk in flight lands
+                self.clock.sleep_until(self._pending[0])
+                continue
+
+            self._serial += 1
+            tracer.event("playback.idle", seconds=self.clock.now() - idle_since)
+            tracer.event("ui.sequence_started", serial=self._serial, tokens=len(chunk.events))
+            self.audio.play_events(chunk.events, on_event=self._on_event, should_continue=self._pump)
+            idle_since = self.clock.now()
+
+        return tracer.stop()
+
+
+def print_report(summary):
+    print(f"first note: {summary['first_note_ms']:.1f}ms" if summary["first_note_ms"] is not None
+          else "first note: none")
+    print(f"{'(ms)':<20} {'count':>7} {'mean':>9} {'p50':>9} {'p95':>9} {'p99':>9} {'max':>9}")
+    for name in ("generation", "queue_wait", "dispatch_lateness", "display_latency", "signal_latency",
+                 "starvation", "start_to_first_note"):
+        d = summary[name]
+        print(f"{name:<20} {d['count']:>7} {d['mean_ms']:>9.1f} {d['p50_ms']:>9.1f} {d['p95_ms']:>9.1f} "
+              f"{d['p99_ms']:>9.1f} {d['max_ms']:>9.1f}")
+    if summary.get("pool_hit_rate") is not None:
+        print(f"pool hit rate: {summary['pool_hit_rate']:.0%}")
+    if summary.get("swap_underruns") is not None:
+        print(f"underruns across model swaps: {summary['swap_underruns']}")
+    if "underruns" in summary:
+        print(f"underruns: {summary['underruns']}")
+
+
+def check_budgets(summary, budgets):
+    """`budgets` are strings like dispatch_lateness.p99_ms=5. Returns the ones that were exceeded"""
+    exceeded = []
+    for budget in budgets:
+        name, limit = budget.split("=")
+        value = summary
+        for key in name.split("."):
+            value = value[key]
+        if value is not None and value > float(limit):
+            exceeded.append(f"{name} = {value:.2f} > {limit}")
+    return exceeded
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replay omnisong sessions headlessly and report latencies")
+    source_group = parser.add_mutually_exclusive_group(required=True)
+    source_group.add_argument("--trace", help="replay the chunks of a trace recorded with TRACE_ENABLED")
+    source_group.add_argument("--seed", type=int, help="generate with the model from this seed")
+    source_group.add_argument("--analyze", help="only summarize a trace, recorded live or by a replay")
+    parser.add_argument("--seconds", type=float, default=300.0, help="seconds of music to replay")
+    parser.add_argument("--gen-rate", type=float, default=None,
+                        help="with --seed, charge len/rate seconds per chunk instead of the measured time")
+    parser.add_argument("--jitter-ms", type=float, default=0.0, help="mean simulated wakeup lateness")
+    parser.add_argument("--max-len", type=int, default=None)
+    parser.add_argument("--save-trace", help="write the replay's own trace here")
+    parser.add_argument("--json", help="write the summary here")
+    parser.add_argument("--budget", action="append", default=[],
+                        help="fail if a value goes over a limit, e.g. dispatch_lateness.p99_ms=5")
+    args = parser.parse_args()
+
+    if args.analyze:
+        summary = summarize(load_trace(args.analyze))
+    else:
+        if args.trace:
+            records = load_trace(args.trace)
+            session = next((r for r in records if r["kind"] == "session.start"), None)
+            if session is None:
+                sys.exit("the trace has no session.start record")
+            table = table_from_vocab(session["vocab"])
+            source = TraceSource(records)
+            initial_ids = session["prompt"]
+            slowdowns = session["slowdowns"]
+            max_len = args.max_len or session["max_len"]
+        else:
+            source = ModelSource(args.seed, rate=args.gen_rate)
+            from infer import encode, events as table
+
+            initial_ids = encode(INITIAL_PROMPT)
+            slowdowns = (CHORD_SLOWDOWN, HARP_SLOWDOWN)
+            max_len = args.max_len or MAX_GENERATION_LENGTH
+
+        replay = Replay(table, source, initial_ids, slowdowns, max_len, jitter_ms=args.jitter_ms,
+                        seed=args.seed or 0)
+        records = replay.run(args.seconds)
+        if args.save_trace:
+            tracer.save(args.save_trace)
+
+        summary = summarize(records)
+        summary["underruns"] = replay.audio.scheduler.underruns
+        summary["music_seconds"] = replay.clock.now()
+
+    print_report(summary)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(summary, f, indent=2)
+
+    exceeded = check_budgets(summary, args.budget)
+    if exceeded:
+        print("over budget: " + ", ".join(exceeded))
+        sys.exit(1)
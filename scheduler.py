@@ -0,0 +1,129 @@
+import threading
+import time
+from collections import deque
+
+from constants import SCHEDULER_LOOKAHEAD_MS, SCHEDULER_RESYNC_MS
+
+
+class MonotonicClock:
+    """Real clock: coarse sleeps until just before the deadline, then a short spin so wakeups land on time"""
+
+    def __init__(self, lookahead_ms=SCHEDULER_LOOKAHEAD_MS):
+        self.lookahead = lookahead_ms / 1000.0
+
+    def now(self):
+        return time.monotonic()
+
+    def sleep_until(self, deadline):
+        remaining = deadline - time.monotonic()
+        if remaining > self.lookahead:
+            time.sleep(remaining - self.lookahead)
+
+        while time.monotonic() < deadline:
+            time.sleep(0)
+
+
+class FakeClock:
+    """
+    Headless clock for tests: sleeping jumps straight to the deadline.
+    `overshoot` is a function returning extra seconds per sleep, to simulate a late OS wakeup.
+    """
+
+    def __init__(self, start=0.0, overshoot=None):
+        self.time = start
+        self.overshoot = overshoot
+        self._lock = threading.Lock()
+
+    def now(self):
+        return self.time
+
+    def sleep_until(self, deadline):
+        with self._lock:
+            if deadline > self.time:
+                self.time = deadline
+            if self.overshoot is not None:
+                self.time += self.overshoot()
+
+    def advance(self, seconds):
+        with self._lock:
+            self.time += seconds
+
+
+class PlaybackScheduler:
+    """
+    Dispatches tokens on an absolute timeline. Each event is due exactly when the previous one ends,
+    so a late wakeup delays a single note instead of pushing every note after it.
+    The timeline carries over between sequences, and audio and display are driven by the same dispatch.
+    """
+
+    def __init__(self, clock=None, resync_ms=SCHEDULER_RESYNC_MS, history=4096):
+        self.clock = clock if clock is not None else MonotonicClock()
+        self.resync = resync_ms / 1000.0
+
+        self.next_due = None
+        self.underruns = 0
+        self.dispatched = 0
+        # how late each dispatch was, in seconds
+        self.lateness = deque(maxlen=history)
+
+    def reset(self):
+        """Forget the timeline, the next event plays immediately"""
+        self.next_due = None
+
+    def remaining(self):
+        """Seconds of already scheduled audio that have not played yet"""
+        if self.next_due is None:
+            return 0.0
+        return max(0.0, self.next_due - self.clock.now())
+
+    def _wait(self, deadline, should_continue, max_slice=0.1):
+        # long chords are waited in slices so stopping does not hang until they end
+        while True:
+            now = self.clock.now()
+            if now >= deadline:
+                return True
+            if not should_continue():
+                return False
+            self.clock.sleep_until(min(deadline, now + max_slice))
+
+    def play(self, events, dispatch, duration_of, should_continue=lambda: True):
+        """
+        Plays a list of events. `dispatch(index, event)` is called when each one is due,
+        `duration_of(event)` returns how long it lasts in seconds (slowdowns included).
+        Returns False if playback was interrupted.
+        """
+        for i, event in enumerate(events):
+            if not should_continue():
+                return False
+
+            now = self.clock.now()
+            if self.next_due is None or now - self.next_due > self.resync:
+                # we fell too far behind (the next sequence was late), restart the timeline from here
+                if self.next_due is not None:
+                    self.underruns += 1
+                self.next_due = now
+
+            if not self._wait(self.next_due, should_continue):
+                return False
+
+            self.lateness.append(self.clock.now() - self.next_due)
+            self.dispatched += 1
+            dispatch(i, event)
+
+            self.next_due += duration_of(event)
+
+        return True
+
+    def stats(self):
+        """Timing error of the dispatches so far, in milliseconds"""
+        if not self.lateness:
+            return {"dispatched": 0, "underruns": self.underruns, "mean_ms": 0.0, "p99_ms": 0.0, "max_ms": 0.0}
+
+        ordered = sorted(self.lateness)
+        return {
+            "dispatched": self.dispatched,
+            "underruns": self.underruns,
+            "mean_ms": sum(ordered) / len(ordered) * 1000.0,
+            "p99_ms": ordered[min(len(ordered) - 1, int(len(ordered) * 0.99))] * 1000.0,
+            "max_ms": ordered[-1] * 1000.0,
+        }
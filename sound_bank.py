@@ -0,0 +1,309 @@
+import hashlib
+import json
+import os
+import struct
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pygame
+
+from constants import SAMPLE_RATE, SOUND_CACHE_FILE, SOUND_BANK_LAZY, SOUND_BANK_WORKERS
+from util import make_path
+
+# packed cache layout: magic, version, header length, json header, padding, raw int16 stereo frames
+CACHE_MAGIC = b"OMSB"
+CACHE_VERSION = 1
+CACHE_ALIGN = 16
+
+_mixer_lock = threading.Lock()
+
+
+def init_mixer():
+    """Initializes the pygame mixer once for the whole process"""
+    with _mixer_lock:
+        if not pygame.mixer.get_init():
+            pygame.mixer.init(frequency=SAMPLE_RATE, size=-16, channels=2, buffer=512)
+
+
+class ChordSounds:
+    """Decoded samples of a single chord folder: the chord loop and its harp notes"""
+    __slots__ = ("loop", "harps", "_sounds")
+
+    def __init__(self):
+        # int16 arrays shaped (frames, 2)
+        self.loop = None
+        self.harps = []
+        self._sounds = {}
+
+    def set(self, note, pcm):
+        if note is None:
+            self.loop = pcm
+            return
+
+        while len(self.harps) <= note:
+            self.harps.append(None)
+        self.harps[note] = pcm
+
+    def pcm(self, note=None):
+        """Returns the samples of a harp note, or the chord loop when note is None"""
+        if note is None:
+            return self.loop
+        if 0 <= note < len(self.harps):
+            return self.harps[note]
+        return None
+
+    def sound(self, note=None):
+        """Returns a pygame Sound for a harp note (or the chord loop), built on first use"""
+        sound = self._sounds.get(note)
+        if sound is None:
+            pcm = self.pcm(note)
+            if pcm is None:
+                return None
+            init_mixer()
+            sound = pygame.mixer.Sound(buffer=np.ascontiguousarray(pcm))
+            self._sounds[note] = sound
+        return sound
+
+
+class SoundBank:
+    """
+    Every chord and harp sample in the sounds folder, decoded once per process.
+    Decoding runs on a thread pool, and the result is packed into a single file that later launches memory-map.
+    """
+
+    def __init__(self, folder="sounds", lazy=SOUND_BANK_LAZY, cache_file=SOUND_CACHE_FILE,
+                 workers=SOUND_BANK_WORKERS):
+        self.folder = make_path(folder)
+        self.lazy = lazy
+        self.cache_file = cache_file
+
+        self._files = self._list_files()
+        self._chords = {}
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="sound-bank")
+        # chords were decoded that the cache file does not have yet
+        self._dirty = False
+        self._save_lock = threading.Lock()
+
+        self.from_cache = self._load_cache()
+        if self.from_cache:
+            print(f"Loaded {len(self._chords)} chords from {self.cache_file}")
+
+    @property
+    def chords(self):
+        return list(self._files.keys())
+
+    def __contains__(self, chord):
+        return chord in self._files
+
+    def _list_files(self):
+        """Maps each chord folder to its (note, path) pairs; note is None for the chord loop"""
+        files = {}
+        for chord in sorted(os.listdir(self.folder)):
+            chord_path = os.path.join(self.folder, chord)
+            if not os.path.isdir(chord_path):
+                continue
+
+            files[chord] = []
+            for file in sorted(os.listdir(chord_path)):
+                if not file.endswith('.ogg'):
+                    continue
+
+                if file.endswith('chord.ogg'):
+                    note = None
+                else:
+                    try:
+                        note = int(file.replace(chord, '', 1).replace('.ogg', ''))
+                    except ValueError:
+                        print(f"Skipping unexpected sound file {file}")
+                        continue
+
+                files[chord].append((note, os.path.join(chord_path, file)))
+
+        return files
+
+    def _fingerprint(self):
+        """Cheap identity of the sounds folder so a stale cache is never used"""
+        parts = [str(SAMPLE_RATE)]
+        for chord, entries in self._files.items():
+            for note, file_path in entries:
+                stat = os.stat(file_path)
+                parts.append(f"{chord}:{note}:{stat.st_size}:{int(stat.st_mtime)}")
+        # hash() is salted per process, so we need something stable across launches
+        return hashlib.sha1("|".join(parts).encode()).hexdigest()
+
+    @staticmethod
+    def _decode(file_path):
+        init_mixer()
+        sound = pygame.mixer.Sound(file_path)
+        return sound, pygame.sndarray.array(sound)
+
+    def _submit(self, chord):
+        """Queues the decoding of a chord on the pool, returns its futures"""
+        with self._lock:
+            if chord in self._chords:
+                return []
+            futures = self._pending.get(chord)
+            if futures is None:
+                futures = [(note, file_path, self._pool.submit(self._decode, file_path))
+                           for note, file_path in self._files[chord]]
+                self._pending[chord] = futures
+            return futures
+
+    def _collect(self, chord, futures):
+        sounds = ChordSounds()
+        for note, file_path, future in futures:
+            try:
+                sound, pcm = future.result()
+            except Exception as e:
+                print(f"Error loading {file_path}: {e}")
+                continue
+            sounds.set(note, pcm)
+            sounds._sounds[note] = sound
+
+        with self._lock:
+            if chord not in self._chords:
+                self._chords[chord] = sounds
+                self._dirty = True
+            self._pending.pop(chord, None)
+            complete = self._dirty and len(self._chords) == len(self._files)
+            sounds = self._chords[chord]
+
+        if complete:
+            # the last chord came in, lazily or not: later launches start from the cache
+            threading.Thread(target=self.save_cache, daemon=True).start()
+        return sounds
+
+    def preload(self):
+        """Starts decoding every chord in the background, then writes the packed cache"""
+        if self.lazy or len(self._chords) == len(self._files):
+            return
+
+        for chord in self._files:
+            self._submit(chord)
+
+        threading.Thread(target=self._finish_preload, daemon=True).start()
+
+    def _finish_preload(self):
+        self.wait()
+        print(f"Loaded {len(self._chords)} chords")
+        self.save_cache()
+
+    def wait(self):
+        """Blocks until every chord is decoded"""
+        for chord in self._files:
+            self.get(chord)
+
+    def get(self, chord):
+        """Returns the ChordSounds of a chord, decoding it now if it was not loaded yet"""
+        sounds = self._chords.get(chord)
+        if sounds is not None:
+            return sounds
+        if chord not in self._files:
+            return None
+        return self._collect(chord, self._submit(chord))
+
+    def pcm(self, chord, note=None):
+        sounds = self.get(chord)
+        return sounds.pcm(note) if sounds is not None else None
+
+    def sound(self, chord, note=None):
+        sounds = self.get(chord)
+        return sounds.sound(note) if sounds is not None else None
+
+    def _load_cache(self):
+        """Memory-maps the packed cache if it matches the sounds folder"""
+        if self.cache_file is None or not os.path.exists(self.cache_file):
+            return False
+
+        try:
+            with open(self.cache_file, "rb") as f:
+                magic, version, header_len = struct.unpack("<4sII", f.read(12))
+                if magic != CACHE_MAGIC or version != CACHE_VERSION:
+                    return False
+                header = json.loads(f.read(header_len))
+
+            if header["fingerprint"] != self._fingerprint() or header["rate"] != SAMPLE_RATE:
+                return False
+
+            data = np.memmap(self.cache_file, dtype=np.int16, mode="r", offset=header["data_offset"])
+            data = data.reshape(-1, 2)
+
+            for chord, note, start, frames in header["entries"]:
+                if chord not in self._chords:
+                    self._chords[chord] = ChordSounds()
+                self._chords[chord].set(note, data[start:start + frames])
+            return True
+        except (OSError, ValueError, KeyError, struct.error) as e:
+            print(f"Ignoring sound cache {self.cache_file}: {e}")
+            self._chords = {}
+            return False
+
+    def save_cache(self):
+        """
+        Writes every decoded chord into a single packed file, if any was decoded since the cache was read.
+        With a lazy bank that may be a part of them, the rest is decoded on demand next time
+        """
+        if self.cache_file is None:
+            return
+        with self._save_lock:
+            with self._lock:
+                if not self._dirty:
+                    return
+                self._dirty = False
+                chords = list(self._chords.items())
+            if not self._write_cache(chords):
+                with self._lock:
+                    self._dirty = True
+
+    def _write_cache(self, chords):
+        entries = []
+        arrays = []
+        start = 0
+        for chord, sounds in chords:
+            for note in [None] + list(range(len(sounds.harps))):
+                pcm = sounds.pcm(note)
+                if pcm is None:
+                    continue
+                pcm = np.ascontiguousarray(pcm, dtype=np.int16).reshape(-1, 2)
+                entries.append([chord, note, start, len(pcm)])
+                arrays.append(pcm)
+                start += len(pcm)
+
+        header = {"fingerprint": self._fingerprint(), "rate": SAMPLE_RATE, "entries": entries}
+        # the data offset depends on the header length, so we reserve room for it before encoding
+        header["data_offset"] = 0
+        header_len = len(json.dumps(header).encode()) + 32
+        data_offset = -(-(12 + header_len) // CACHE_ALIGN) * CACHE_ALIGN
+        header["data_offset"] = data_offset
+        header_bytes = json.dumps(header).encode().ljust(header_len)
+
+        os.makedirs(os.path.dirname(self.cache_file), exist_ok=True)
+        tmp_file = self.cache_file + ".tmp"
+        try:
+            with open(tmp_file, "wb") as f:
+                f.write(struct.pack("<4sII", CACHE_MAGIC, CACHE_VERSION, header_len))
+                f.write(header_bytes)
+                f.write(b"\0" * (data_offset - 12 - header_len))
+                for pcm in arrays:
+                    f.write(pcm.tobytes())
+            os.replace(tmp_file, self.cache_file)
+            return True
+        except OSError as e:
+            print(f"Could not write sound cache {self.cache_file}: {e}")
+            return False
+
+
+_bank = None
+_bank_lock = threading.Lock()
+
+
+def get_sound_bank():
+    """Returns the process-wide sound bank, creating it on first use"""
+    global _bank
+    with _bank_lock:
+        if _bank is None:
+            _bank = SoundBank()
+        return _bank
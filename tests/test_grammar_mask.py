@@ -0,0 +1,76 @@
+import random
+
+import numpy as np
+import pytest
+
+from model.grammar_mask import MAX_CHORD_RUN, MAX_HARP_RUN, GrammarChecker, grammar_violations, is_chord
+
+CLEAN = [is_chord(t) for t in "c_200 H3_100 H5_100 c_400 c_200 H1_100".split()]
+
+
+def random_stream(seed, length=2000):
+    """Kinds of a stream with runs of every length up to past both limits, so it breaks the grammar now and then"""
+    rng = random.Random(seed)
+    chords = []
+    kind = True
+    while len(chords) < length:
+        chords += [kind] * rng.randint(1, MAX_HARP_RUN + 2 if not kind else MAX_CHORD_RUN + 2)
+        kind = not kind
+    return chords[:length]
+
+
+def test_clean_stream():
+    assert GrammarChecker().feed(CLEAN).sum() == 0
+
+
+def test_clean_stream_in_pieces():
+    pieces = GrammarChecker()
+    for start in range(0, len(CLEAN), 2):
+        pieces.feed(CLEAN[start:start + 2])
+    assert pieces.violations == 0
+
+
+def test_shard_starting_on_a_harp():
+    assert GrammarChecker(history=CLEAN[:1]).feed(CLEAN[1:]).sum() == 0
+
+
+def test_stream_must_open_with_a_chord():
+    assert GrammarChecker().feed([False]).sum() == 1
+
+
+def test_chord_run_limit():
+    assert GrammarChecker().feed([True] * (MAX_CHORD_RUN + 1)).sum() == 1
+    assert GrammarChecker().feed([True] * MAX_CHORD_RUN + [False] * (MAX_HARP_RUN + 1)).sum() == 1
+
+
+def test_runs_continue_across_pieces():
+    runs = GrammarChecker(history=[True] * (MAX_CHORD_RUN - 1))
+    assert runs.feed([True, True]).tolist() == [False, True]
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_shards_add_up_to_the_whole_stream(seed):
+    chords = random_stream(seed)
+    whole = grammar_violations(chords)
+    assert whole.sum() > 0
+
+    # shards seeded with the tokens in front of them, like dataset workers checking parts of a file
+    rng = random.Random(seed)
+    cuts = sorted(rng.sample(range(1, len(chords)), 20))
+    found = []
+    for start, end in zip([0] + cuts, cuts + [len(chords)]):
+        found.append(GrammarChecker(history=chords[:start]).feed(chords[start:end]))
+    assert np.array_equal(np.concatenate(found), whole)
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_pieces_add_up_to_the_whole_stream(seed):
+    chords = random_stream(seed)
+    checker = GrammarChecker()
+    rng = random.Random(seed)
+    start = 0
+    while start < len(chords):
+        end = start + rng.randint(1, 3 * MAX_HARP_RUN)
+        checker.feed(chords[start:end])
+        start = end
+    assert checker.violations == grammar_violations(chords).sum()
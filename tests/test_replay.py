@@ -0,0 +1,70 @@
+import pytest
+
+# replay.py plays through the audio manager, which needs pygame even when nothing is heard
+pytest.importorskip("pygame")
+
+from replay import Replay, TraceSource, table_from_vocab  # noqa: E402
+from tracing import summarize  # noqa: E402
+
+VOCAB = ["c_400", "am_400", "g_200", "H1_100", "H3_100", "H5_200"]
+PROMPT = [0, 3]
+CHUNKS = [
+    [1, 4, 5, 2, 3, 3],
+    [0, 5, 4, 1, 2, 3, 4],
+    [2, 3, 0, 4, 5],
+]
+
+
+def recorded_trace(seconds=0.05):
+    """What a live session with these chunks leaves in its trace, each chunk taking `seconds` to generate"""
+    records = [{"t": 0.0, "kind": "session.start", "vocab": VOCAB, "prompt": PROMPT,
+                "slowdowns": [1.0, 1.0], "max_len": 8}]
+    for i, ids in enumerate(CHUNKS):
+        records.append({"t": i, "kind": "generation.end", "tokens": len(ids), "seconds": seconds, "ids": ids})
+    return records
+
+
+def replay(records, seconds=60.0, jitter_ms=0.0):
+    session = records[0]
+    run = Replay(table_from_vocab(session["vocab"]), TraceSource(records), session["prompt"],
+                 session["slowdowns"], session["max_len"], jitter_ms=jitter_ms)
+    return run, run.run(seconds)
+
+
+def notes(records):
+    return [r["token"] for r in records if r["kind"] == "note"]
+
+
+def test_plays_every_recorded_chunk_in_order():
+    run, records = replay(recorded_trace())
+
+    expected = [VOCAB[i] for ids in CHUNKS for i in ids]
+    assert notes(records) == expected
+    assert [r["ids"] for r in records if r["kind"] == "generation.end"] == CHUNKS
+    # on the fake clock, with generation well ahead of playback, every note is on time
+    summary = summarize(records)
+    assert summary["dispatch_lateness"]["max_ms"] == pytest.approx(0.0)
+    assert run.audio.scheduler.underruns == 0
+
+
+def test_same_trace_same_replay():
+    _, first = replay(recorded_trace(), jitter_ms=1.0)
+    _, second = replay(recorded_trace(), jitter_ms=1.0)
+    # chunks are traced by object id, everything else must match
+    assert [(r["t"], r["kind"], r.get("late")) for r in first] == \
+           [(r["t"], r["kind"], r.get("late")) for r in second]
+
+
+def test_replay_of_a_replay():
+    # a replay's own trace has the same header and chunks, so it replays to the same music
+    _, records = replay(recorded_trace())
+    _, again = replay(records)
+    assert notes(again) == notes(records)
+
+
+def test_slow_generation_starves_playback():
+    # every chunk takes longer than the music before it lasts
+    _, records = replay(recorded_trace(seconds=5.0))
+    summary = summarize(records)
+    assert summary["starvation"]["max_ms"] > 1000.0
+    assert notes(records) == [VOCAB[i] for ids in CHUNKS for i in ids]
@@ -0,0 +1,80 @@
+import random
+
+import pytest
+
+from constants import SCHEDULER_RESYNC_MS
+from scheduler import FakeClock, PlaybackScheduler
+
+# note lengths in seconds, some longer than the scheduler's wait slices
+DURATIONS = [0.1, 0.2, 0.4, 0.05, 0.8, 0.1] * 50
+
+
+def play(scheduler, durations=DURATIONS):
+    dispatched = []
+    scheduler.play(list(range(len(durations))), lambda i, _: dispatched.append(scheduler.clock.now()),
+                   lambda i: durations[i])
+    return dispatched
+
+
+def test_no_overshoot_dispatches_exactly_on_time():
+    clock = FakeClock()
+    scheduler = PlaybackScheduler(clock=clock)
+    dispatched = play(scheduler)
+
+    expected = 0.0
+    for at, duration in zip(dispatched, DURATIONS):
+        assert at == pytest.approx(expected)
+        expected += duration
+    assert scheduler.stats()["max_ms"] == pytest.approx(0.0)
+    assert scheduler.underruns == 0
+
+
+@pytest.mark.parametrize("overshoot_ms", [0.5, 2.0, 10.0])
+def test_late_wakeups_do_not_drift(overshoot_ms):
+    # the timeline is absolute: each note is late by one wakeup at most, never by the sum of the ones before
+    overshoot = overshoot_ms / 1000.0
+    clock = FakeClock(overshoot=lambda: overshoot)
+    scheduler = PlaybackScheduler(clock=clock)
+    dispatched = play(scheduler)
+
+    expected = 0.0
+    for at, duration in zip(dispatched, DURATIONS):
+        assert expected <= at <= expected + overshoot + 1e-9
+        expected += duration
+    assert scheduler.stats()["max_ms"] <= overshoot_ms + 1e-6
+    assert scheduler.underruns == 0
+
+
+def test_random_jitter_stays_within_bounds():
+    rng = random.Random(0)
+    clock = FakeClock(overshoot=lambda: rng.uniform(0.0, 0.005))
+    scheduler = PlaybackScheduler(clock=clock)
+    play(scheduler)
+
+    stats = scheduler.stats()
+    assert stats["dispatched"] == len(DURATIONS)
+    assert 0.0 < stats["mean_ms"] <= stats["p99_ms"] <= stats["max_ms"] <= 5.0
+    # the clock ends where the music does, plus at most the last wakeup's lateness
+    assert clock.now() - sum(DURATIONS) <= 0.005
+
+
+def test_gap_past_resync_counts_an_underrun():
+    clock = FakeClock()
+    scheduler = PlaybackScheduler(clock=clock)
+    play(scheduler, [0.1, 0.1])
+
+    # the next sequence arrives later than the resync window allows, its timeline restarts from now
+    clock.advance(SCHEDULER_RESYNC_MS / 1000.0 + 0.5)
+    dispatched = play(scheduler, [0.1, 0.1])
+    assert scheduler.underruns == 1
+    assert dispatched[0] == pytest.approx(clock.now() - 0.1)
+
+
+def test_short_gap_keeps_the_timeline():
+    clock = FakeClock()
+    scheduler = PlaybackScheduler(clock=clock)
+    play(scheduler, [0.1, 0.1])
+
+    clock.advance(SCHEDULER_RESYNC_MS / 2000.0)
+    play(scheduler, [0.1])
+    assert scheduler.underruns == 0
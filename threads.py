@@ -1,45 +1,118 @@
+import itertools
+import math
+import os
 import threading
 import time
-from queue import Queue
 
-from infer import generate
-from util import chord_token_to_human, count_chords
+from cancellation import CancelToken, GenerationCancelled
+from constants import TOKEN_CUTOFF_FOR_GEN, INFERENCE_IN_SUBPROCESS, LOOKAHEAD_MIN_CHUNK, INITIAL_PROMPT, \
+    POOL_PER_KEY, POOL_SEQUENCE_LENGTH, POOL_IDLE_LOAD
+from continuation_pool import get_pool, pool_key
+from cpu_governor import get_governor
+from infer import Engine, Vocabulary, get_engine
+from inference_worker import InferenceWorker, get_inference_worker
+from lookahead import Chunk, ChunkSizer
+from metrics import metrics
+from tracing import tracer
+
+
+# numbers the chunks (across Start/Stop) so the ui can tell which one a playing position belongs to
+_chunk_serials = itertools.count(1)
 
 
 class GenerationThread(threading.Thread):
     def __init__(self, window):
-        super().__init__(daemon=True)
+        super().__init__(daemon=True, name="generation")
         self.window = window
         self._stop_event = threading.Event()
+        self.sizer = ChunkSizer()
+        # token of the generation running right now
+        self._cancel = CancelToken()
 
     def stop(self):
         self._stop_event.set()
-        self.window.generation_queue = Queue()
+        self._cancel.cancel()
+        self.window.lookahead.clear()
+
+    def cancel(self):
+        """Abandons the running generation, the loop starts over with the current parameters"""
+        self._cancel.cancel()
 
     def stopped(self):
         return self._stop_event.is_set()
 
-    def push_to_queue(self, item):
-        if self.stopped():
-            raise StopIteration
-        self.window.generation_queue.put(item)
-
     def run(self):
+        lookahead = self.window.lookahead
+        governor = get_governor()
+        if not INFERENCE_IN_SUBPROCESS:
+            engine = get_engine()
+            # a calibration still running in the background does not hold up Start
+            governor.configure(engine.model, engine.vocab_size, wait=False)
+        # thread count this thread runs with
+        threads = None
+
+        version = lookahead.version
+
         while not self.stopped():
             try:
-                prompt = self.window.prompt_manager.get_prompt()
-                self.window.signals.status_update.emit(f"Generating from {count_chords(prompt)} chords...")
+                if not INFERENCE_IN_SUBPROCESS and governor.threads != threads:
+                    # the provisional count until calibration finishes, then the calibrated one
+                    threads = governor.threads
+                    governor.apply_to_inference_thread()
+                # a model loaded in the background takes over here, between two chunks
+                self.window.apply_pending_engine()
+                engine = get_engine()
+                # either the model in this process, or the one living in the inference worker process
+                if INFERENCE_IN_SUBPROCESS:
+                    generate = get_inference_worker().generate_ids
+                else:
+                    generate = engine.generate_ids
 
+                max_len = self.sizer.chunk_size(self.window.max_len_slider.value())
+                if lookahead.version != version:
+                    # parameters just changed and the look-ahead was dropped, a short chunk gets the change out fastest
+                    max_len = min(max_len, LOOKAHEAD_MIN_CHUNK)
+
+                # sleep until the audio ahead of playback is about to run out
+                if not lookahead.wait_for_room(self.sizer.target_seconds(max_len), lambda: not self.stopped()):
+                    break
+
+                prompt = lookahead.prompt(self.window.prompt_manager.get_prompt, TOKEN_CUTOFF_FOR_GEN)
+                status = f"Generating from {engine.events.count_chords(prompt)} chords..."
+                tracer.event("ui.status", message=status)
+                self.window.signals.status_update.emit(status)
+
+                # the version is read before the sliders, so a change in between can only make this chunk stale
+                self._cancel = CancelToken()
+                version = lookahead.version
                 temperature = self.window.temp_slider.value() / 100.0
                 top_p = self.window.top_p_slider.value() / 100.0
-                max_len = self.window.max_len_slider.value()
 
-                sequence = generate(prompt, max_len=max_len, temperature=temperature,
-                                    top_p=top_p, debug=False)
+                tracer.event("generation.start", max_len=max_len, prompt=len(prompt), version=version,
+                             temperature=temperature, top_p=top_p)
+                started = time.monotonic()
+                try:
+                    sequence = generate(prompt, max_len=max_len, temperature=temperature,
+                                        top_p=top_p, debug=False, cancel=self._cancel)
+                except GenerationCancelled:
+                    tracer.event("generation.cancelled", seconds=time.monotonic() - started)
+                    continue
+                elapsed = time.monotonic() - started
 
-                # adds the whole seq as a string to the queue
-                self.push_to_queue(sequence)
-                time.sleep(1)
+                # generate echoes the prompt back, playback continues from it so we only queue the new part
+                new_ids = sequence[len(prompt):]
+                if tracer.enabled:
+                    # the ids make the trace replayable without the model
+                    tracer.event("generation.end", tokens=len(new_ids), seconds=elapsed,
+                                 ids=[int(i) for i in new_ids])
+                self.sizer.observe(len(new_ids), elapsed)
+                metrics.set("generation.tokens_per_sec", self.sizer.rate)
+                metrics.set("generation.chunk_size", max_len)
+
+                if self.stopped():
+                    break
+                lookahead.put(Chunk(new_ids, engine.events.lookup(new_ids), version))
+                metrics.set("lookahead.seconds", lookahead.level())
 
             except Exception as e:
                 self.window.signals.status_update.emit(f"Generation error: {str(e)}")
@@ -48,9 +121,15 @@ class GenerationThread(threading.Thread):
 
 class PlaybackThread(threading.Thread):
     def __init__(self, window):
-        super().__init__(daemon=True)
+        super().__init__(daemon=True, name="playback")
         self.window = window
         self._stop_event = threading.Event()
+        self._serial = 0
+        # playback threads are made by Start, so this is when the user asked for music
+        self._started = time.monotonic()
+        self._first_note = True
+        # scheduler underruns already traced
+        self._underruns = window.audio.scheduler.underruns
 
     def stop(self):
         self._stop_event.set()
@@ -58,45 +137,194 @@ class PlaybackThread(threading.Thread):
     def stopped(self):
         return self._stop_event.is_set()
 
+    def on_event(self, index, event):
+        """Called by the audio scheduler exactly when a token starts playing"""
+        self.window.lookahead.set_progress(index)
+        if self._first_note:
+            self._first_note = False
+            # the first generated (or pooled) note, the initial prompt is only a lead-in
+            metrics.set("playback.time_to_first_note_ms", (time.monotonic() - self._started) * 1000.0)
+        # no signal per note: the ui refresh timer reads this at most once per frame
+        self.window.playing_position = (self._serial, index, event)
+        if tracer.enabled:
+            underruns = self.window.audio.scheduler.underruns
+            if underruns != self._underruns:
+                # counted right before this note was dispatched, the summary tells the ones around a model swap
+                tracer.event("playback.underrun", count=underruns - self._underruns)
+                self._underruns = underruns
+            tracer.event("note", serial=self._serial, index=index, token=event.token,
+                         late=self.window.audio.scheduler.lateness[-1])
+
     def run(self):
+        get_governor().apply_to_realtime_thread()
+
         # play the initial prompt first
-        initial_prompt = self.window.prompt_manager.get_prompt()
-        self.window.audio.interpret_sequence(initial_prompt)
+        initial_prompt = get_engine().events.lookup(self.window.prompt_manager.get_prompt())
+        self.window.audio.play_events(initial_prompt, should_continue=lambda: not self.stopped())
+        # when playback last ran out of notes
+        idle_since = time.monotonic()
 
         while not self.stopped():
             try:
-                # wait for next seq
-                if not self.window.generation_queue.empty():
-                    sequence = self.window.generation_queue.get()
-                    tokens = sequence.split()
-
-                    self.window.currently_playing_tokens = tokens
-                    self.window.current_token_index = 0
-                    self.window.prompt_manager.append_to_history(tokens)
-
-                    def update_display_progress():
-                        for i, token in enumerate(tokens):
-                            if not self.window.is_playing or self.stopped():
-                                raise StopIteration
-                            self.window.signals.token_playing.emit(i)
-                            self.window.signals.status_update.emit(f"Playing {chord_token_to_human(token)}")
-
-                            # estimate duration based on token type
-                            if '_' in token:
-                                parts = token.split('_')
-                                duration = int(parts[1])
-                                if parts[0].startswith('H'):
-                                    time.sleep(duration * self.window.audio.slow_down_harp / 1000.0)
-                                else:
-                                    time.sleep(duration * self.window.audio.slow_down_chord / 1000.0)
-
-                    # another thread so we can update display progress without blocking audio playback
-                    display_thread = threading.Thread(target=update_display_progress, daemon=True)
-                    display_thread.start()
-
-                    self.window.audio.interpret_sequence(sequence)
-                else:
-                    time.sleep(0.1)
+                # block until the next chunk is ready, waking up now and then to notice a stop
+                chunk = self.window.lookahead.get(timeout=0.5)
+                if chunk is None:
+                    continue
+
+                self.window.currently_playing_tokens = chunk.events
+                self.window.current_token_index = 0
+                self._serial = next(_chunk_serials)
+                tracer.event("playback.idle", seconds=time.monotonic() - idle_since)
+                # the view is rendered once per chunk, playback then only moves the highlight
+                tracer.event("ui.sequence_started", serial=self._serial, tokens=len(chunk.events))
+                self.window.signals.sequence_started.emit(self._serial, chunk.events)
+
+                # audio and highlighting run off the same timeline, so they cant drift apart.
+                # a chunk made stale by a parameter change stops early so the new one plays right away
+                self.window.audio.play_events(
+                    chunk.events, on_event=self.on_event,
+                    should_continue=lambda: not self.stopped() and not self.window.lookahead.is_cut(chunk))
+                idle_since = time.monotonic()
+                metrics.set("playback.underruns", self.window.audio.scheduler.underruns)
+                # next to generation.tokens_per_sec, this shows what the thread settings cost playback
+                metrics.set("playback.jitter_p99_ms", self.window.audio.scheduler.stats()["p99_ms"])
             except Exception as e:
                 self.window.signals.status_update.emit(f"Playback error: {str(e)}")
                 time.sleep(1)
+
+
+class ReloadThread(threading.Thread):
+    """Loads and warms up another checkpoint while the current one keeps generating"""
+
+    def __init__(self, window, path):
+        super().__init__(daemon=True, name="reload")
+        self.window = window
+        self.path = path
+
+    def run(self):
+        started = time.monotonic()
+        tracer.event("engine.load", path=self.path)
+        try:
+            if INFERENCE_IN_SUBPROCESS:
+                # the new model lives in its own worker process, this one only needs its vocabulary
+                engine = Vocabulary.load(self.path)
+            else:
+                # loading and warming up compete with the live generation and playback: this thread gets the
+                # inference cores and thread count, the cores reserved for playback stay free
+                get_governor().apply_to_inference_thread()
+                engine = Engine(self.path)
+            # fails before the switch if the history could not be carried over
+            engine.remapper(get_engine())
+            if not engine.encode(INITIAL_PROMPT):
+                # Clear History would leave generation without a prompt
+                raise ValueError("none of the initial prompt's tokens are in its vocabulary")
+            if INFERENCE_IN_SUBPROCESS:
+                # the running worker keeps generating meanwhile
+                worker = InferenceWorker(model_path=self.path)
+            else:
+                engine.warm_up()
+                worker = None
+        except Exception as e:
+            tracer.event("engine.load_failed", path=self.path, error=str(e))
+            self.window.signals.engine_failed.emit(f"Could not load {self.path}: {e}")
+            return
+
+        metrics.set("engine.load_seconds", time.monotonic() - started)
+        self.window.signals.engine_loaded.emit(engine, worker)
+
+
+class PoolFillThread(threading.Thread):
+    """
+    Fills the continuation pool while the app is stopped and the machine is idle: continuations of the prompt
+    the next Start would use, and of the initial prompt for after a Clear History
+    """
+
+    def __init__(self, window):
+        super().__init__(daemon=True, name="pool-fill")
+        self.window = window
+        self.pool = get_pool()
+        self._stop_event = threading.Event()
+        self._cancel = CancelToken()
+        # cores this process keeps busy, averaged like the load average, and the (time, cpu time) it was read at
+        self._own_load = 0.0
+        self._last_sample = None
+
+    def stop(self):
+        self._stop_event.set()
+        self._cancel.cancel()
+
+    def pause(self):
+        """Abandons the continuation being generated, Start needs the model"""
+        self._cancel.cancel()
+
+    def stopped(self):
+        return self._stop_event.is_set()
+
+    def _own_cpu_seconds(self):
+        """Cpu time of this process and, when the model lives there, of the inference worker"""
+        user, system = os.times()[:2]
+        seconds = user + system
+        if INFERENCE_IN_SUBPROCESS:
+            seconds += get_inference_worker().cpu_seconds()
+        return seconds
+
+    def _idle(self):
+        if self.window.is_playing:
+            return False
+        if not hasattr(os, "getloadavg"):
+            return True
+
+        # the load average counts our own generation too, which would throttle the filler as soon as it ran.
+        # our share is averaged the same way, over a minute, and taken out
+        now = time.monotonic()
+        cpu = self._own_cpu_seconds()
+        if self._last_sample is not None:
+            elapsed = now - self._last_sample[0]
+            if elapsed > 0:
+                # a new worker process (after a model swap) starts its count over
+                used = max(0.0, cpu - self._last_sample[1])
+                decay = math.exp(-elapsed / 60.0)
+                self._own_load = self._own_load * decay + used / elapsed * (1.0 - decay)
+        self._last_sample = (now, cpu)
+
+        others = max(0.0, os.getloadavg()[0] - self._own_load)
+        return others / (os.cpu_count() or 1) < POOL_IDLE_LOAD
+
+    def _wanted(self):
+        """(key, prompt, temperature, top_p) of the next continuation to make, None if the pool is full"""
+        engine = get_engine()
+        temperature = self.window.temp_slider.value() / 100.0
+        top_p = self.window.top_p_slider.value() / 100.0
+        for prompt in (self.window.prompt_manager.get_prompt(), engine.encode(INITIAL_PROMPT)):
+            prompt = [int(i) for i in prompt]
+            key = pool_key(engine.identity, prompt, temperature, top_p)
+            if self.pool.count(key) < POOL_PER_KEY:
+                return key, prompt, temperature, top_p
+        return None
+
+    def run(self):
+        while not self.stopped():
+            try:
+                wanted = self._wanted() if self._idle() else None
+                if wanted is None:
+                    self._stop_event.wait(1.0)
+                    continue
+
+                key, prompt, temperature, top_p = wanted
+                engine = get_engine()
+                generate = get_inference_worker().generate_ids if INFERENCE_IN_SUBPROCESS else engine.generate_ids
+                self._cancel = CancelToken()
+                if not self._idle():
+                    continue
+                try:
+                    sequence = generate(prompt, max_len=POOL_SEQUENCE_LENGTH, temperature=temperature,
+                                        top_p=top_p, cancel=self._cancel)
+                except GenerationCancelled:
+                    continue
+
+                # the model may have been swapped meanwhile, then the key no longer matches the ids
+                if get_engine() is engine:
+                    self.pool.put(key, sequence[len(prompt):])
+            except Exception as e:
+                print(f"Continuation pool: {e}")
+                self._stop_event.wait(5.0)
@@ -0,0 +1,177 @@
+import json
+import os
+import threading
+import time
+
+
+class Tracer:
+    """
+    Timestamped log of what the pipeline does (generation, look-ahead, note dispatch, ui updates),
+    for finding timing problems after the fact. Recording is off until start() is called,
+    and a disabled tracer costs a single attribute check per event.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.clock = time.monotonic
+        self._start = 0.0
+        self._records = []
+        self._lock = threading.Lock()
+
+    def start(self, clock=None):
+        """Starts a new trace. `clock` returns seconds, the replay harness passes its fake clock here"""
+        with self._lock:
+            self.clock = clock if clock is not None else time.monotonic
+            self._start = self.clock()
+            self._records = []
+            self.enabled = True
+
+    def stop(self):
+        self.enabled = False
+        return self.records()
+
+    def event(self, kind, **fields):
+        if not self.enabled:
+            return
+        record = {"t": self.clock() - self._start, "thread": threading.current_thread().name, "kind": kind}
+        record.update(fields)
+        with self._lock:
+            self._records.append(record)
+
+    def records(self):
+        with self._lock:
+            return list(self._records)
+
+    def save(self, path):
+        """Writes the trace as one json object per line"""
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with open(path, "w") as f:
+            for record in self.records():
+                f.write(json.dumps(record) + "\n")
+
+
+def load_trace(path):
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def distribution(values):
+    """Summary of a list of seconds, in milliseconds"""
+    if not values:
+        return {"count": 0, "mean_ms": 0.0, "p50_ms": 0.0, "p95_ms": 0.0, "p99_ms": 0.0, "max_ms": 0.0}
+
+    ordered = sorted(values)
+
+    def percentile(p):
+        return ordered[min(len(ordered) - 1, int(len(ordered) * p))] * 1000.0
+
+    return {
+        "count": len(ordered),
+        "mean_ms": sum(ordered) / len(ordered) * 1000.0,
+        "p50_ms": percentile(0.5),
+        "p95_ms": percentile(0.95),
+        "p99_ms": percentile(0.99),
+        "max_ms": ordered[-1] * 1000.0,
+    }
+
+
+def summarize(records):
+    """
+    Latency distributions from a trace, recorded live or by the replay harness:
+    - generation: how long each chunk took to generate
+    - queue_wait: from a chunk entering the look-ahead to playback taking it
+    - dispatch_lateness: how late each note was dispatched against its timeline
+    - display_latency: from a note being dispatched to the ui showing it
+    - signal_latency: from a sequence_started signal being emitted to the ui handling it
+    - starvation: how long playback sat idle between two chunks
+    - first_note: from the start of the trace to the first note
+    - start_to_first_note: from each Start to the first note of a chunk after it
+    - pool_hit_rate: share of Starts that found a pre-generated continuation
+    - swap_underruns: playback underruns from a model starting to load until the first note after the swap,
+      None when the trace has no model load
+    """
+    generation = []
+    queue_wait = []
+    lateness = []
+    display = []
+    signal = []
+    starvation = []
+    first_note = None
+    start_to_note = []
+    started_at = None
+    pool_takes = []
+    # a model is loading (or was just swapped in and playback has not played a note of it yet)
+    swapping = swapped = False
+    swap_underruns = None
+
+    put_at = {}
+    dispatched_at = {}
+    emitted_at = {}
+    for record in records:
+        kind = record["kind"]
+        if kind == "generation.end":
+            generation.append(record["seconds"])
+        elif kind == "lookahead.put" and not record.get("dropped"):
+            put_at[record["chunk"]] = record["t"]
+        elif kind == "lookahead.get":
+            started = put_at.pop(record["chunk"], None)
+            if started is not None:
+                queue_wait.append(record["t"] - started)
+        elif kind == "playback.idle":
+            starvation.append(record["seconds"])
+        elif kind == "engine.load":
+            swapping, swapped = True, False
+            swap_underruns = swap_underruns or 0
+        elif kind == "engine.load_failed":
+            swapping = False
+        elif kind == "engine.swap":
+            swapped = True
+        elif kind == "playback.underrun":
+            if swapping:
+                swap_underruns += record["count"]
+        elif kind == "note":
+            if swapped:
+                swapping = swapped = False
+            lateness.append(record["late"])
+            dispatched_at[(record["serial"], record["index"])] = record["t"]
+            if first_note is None:
+                first_note = record["t"]
+            if started_at is not None:
+                start_to_note.append(record["t"] - started_at)
+                started_at = None
+        elif kind == "ui.start":
+            started_at = record["t"]
+        elif kind == "pool.take":
+            pool_takes.append(record["hit"])
+        elif kind == "ui.sequence_started":
+            emitted_at[record["serial"]] = record["t"]
+        elif kind == "ui.render":
+            emitted = emitted_at.pop(record["serial"], None)
+            if emitted is not None:
+                signal.append(record["t"] - emitted)
+        elif kind == "ui.refresh":
+            dispatched = dispatched_at.get((record["serial"], record["index"]))
+            if dispatched is not None:
+                display.append(record["t"] - dispatched)
+
+    counts = {}
+    for record in records:
+        counts[record["kind"]] = counts.get(record["kind"], 0) + 1
+
+    return {
+        "events": counts,
+        "first_note_ms": first_note * 1000.0 if first_note is not None else None,
+        "generation": distribution(generation),
+        "queue_wait": distribution(queue_wait),
+        "dispatch_lateness": distribution(lateness),
+        "display_latency": distribution(display),
+        "signal_latency": distribution(signal),
+        "starvation": distribution(starvation),
+        "start_to_first_note": distribution(start_to_note),
+        "pool_hit_rate": sum(pool_takes) / len(pool_takes) if pool_takes else None,
+        "swap_underruns": swap_underruns,
+    }
+
+
+# shared by the whole app
+tracer = Tracer()
@@ -1,18 +1,73 @@
+import sys
 import time
 
 import torch
 from torch.utils.data import DataLoader
 from tqdm import tqdm
 
-from model.dataset import MusicDataset
+from model.benchmark import generation_speed
+from model.checkpoint import load_checkpoint
+from model.dataset import MusicDataset, map_unseen_tokens
 from model.device import device
+from model.distill import distillation_loss, perplexity
 from model.gpt import GPT
+from model.lora import add_lora, save_adapter
+from model.planner import plan_batch, MemoryMeter, MEMORY_BUDGET_FRACTION
+from model.profiler import StepProfiler
 
 TRAIN_FILE = "training_plain.txt"
 EPOCHS = 50
 GRADIENT_CLIP = 1.0
 BATCH_SIZE = 16
 ACCUMULATION_STEPS = 4
+# samples per optimizer step, kept the same whatever micro-batch the planner picks
+EFFECTIVE_BATCH_SIZE = BATCH_SIZE * ACCUMULATION_STEPS
+# probe the largest micro-batch and checkpointing setting that fit this machine instead of the fixed ones above
+AUTO_BATCH = True
+
+# distillation: train a smaller student on the soft targets of a frozen teacher, for faster cpu inference
+DISTILL = False
+TEACHER_FILE = "omni.pth"
+# what the student changes from the default GPT shape (fewer layers and/or a narrower embedding)
+STUDENT_CONFIG = {"num_layers": 2, "embed_size": 96}
+# weight of the teacher term against the label-smoothed loss on the real tokens
+DISTILL_ALPHA = 0.7
+# softens both distributions so the student also learns the teacher's ranking of the unlikely tokens
+DISTILL_TEMPERATURE = 2.0
+
+# fine-tuning: adapt omni.pth to a new corpus by training small low-rank adapters on top of its frozen weights.
+# only the adapters are saved; set ADAPTER_FILE in constants.py to use them in the app
+FINETUNE = False
+FINETUNE_BASE = "omni.pth"
+FINETUNE_EPOCHS = 3
+FINETUNE_LR = 1e-3
+LORA_RANK = 4
+LORA_ALPHA = 8.0
+
+# profiling: time each phase of a window of steps (micro-batches) and run the torch profiler over it, then
+# print a per-phase table and stop. validation and checkpoints are skipped, so no model file is touched;
+# only the table (PROFILE_SUMMARY_FILE) and the trace (PROFILE_TRACE_FILE) are written
+PROFILE = False
+# steps skipped before the window, so warmup and allocator growth are not measured
+PROFILE_START_STEP = 10
+PROFILE_STEPS = 20
+PROFILE_SUMMARY_FILE = "train_profile.txt"
+# chrome trace, for chrome://tracing or https://ui.perfetto.dev
+PROFILE_TRACE_FILE = "train_profile.json"
+
+if DISTILL and FINETUNE:
+    # not an assert, python -O would skip it
+    raise SystemExit("pick one of DISTILL and FINETUNE")
+if FINETUNE:
+    EPOCHS = FINETUNE_EPOCHS
+
+# where the best and the final model are saved. the student gets its own files so the teacher is never overwritten
+if DISTILL:
+    BEST_FILE, FINAL_FILE = "omni_student.pth", "omni_student_s.pth"
+elif FINETUNE:
+    BEST_FILE, FINAL_FILE = "omni_adapter.pt", "omni_adapter_s.pt"
+else:
+    BEST_FILE, FINAL_FILE = "omni.pth", "omni_s.pth"
 
 
 def compute_grad_norm(model):
@@ -34,23 +89,66 @@ split_idx = int(len(lines) * 0.9)
 train_text = '\n'.join(lines[:split_idx])
 val_text = '\n'.join(lines[split_idx:])
 
-train_dataset = MusicDataset(train_text)
+teacher = None
+base_model = None
+base_stoi = None
+if DISTILL:
+    # the student predicts over the teacher's vocabulary, so it is a drop-in replacement for it
+    teacher, base_stoi, _, _ = load_checkpoint(TEACHER_FILE, device)
+    for p in teacher.parameters():
+        p.requires_grad_(False)
+    print(f"Distilling {TEACHER_FILE} ({teacher.config}) into a student with {STUDENT_CONFIG}")
+elif FINETUNE:
+    base_model, base_stoi, _, _ = load_checkpoint(FINETUNE_BASE, device)
+    print(f"Fine-tuning {FINETUNE_BASE} with rank {LORA_RANK} adapters")
+
+if base_stoi is not None:
+    # the vocabulary is fixed by the checkpoint, tokens it lacks become their closest known token
+    train_text, mapped, dropped = map_unseen_tokens(train_text, base_stoi)
+    val_text, val_mapped, val_dropped = map_unseen_tokens(val_text, base_stoi)
+    print(f"Unseen tokens: {mapped + val_mapped} mapped to known ones, {dropped + val_dropped} dropped")
+    train_dataset = MusicDataset(train_text, stoi=base_stoi)
+else:
+    train_dataset = MusicDataset(train_text)
 val_dataset = MusicDataset(val_text)
 
 val_dataset.stoi = train_dataset.stoi
 val_dataset.itos = train_dataset.itos
 val_dataset.data = [train_dataset.stoi.get(token, 0) for token in val_text.split()]
 
+vocab_size = len(train_dataset.stoi)
+model_config = STUDENT_CONFIG if DISTILL else {}
+
+gradient_checkpointing = True
+if AUTO_BATCH:
+    print("Planning batch size...")
+    # the trials carry the teacher, or train only the adapters, like the run itself
+    plan = plan_batch(vocab_size, EFFECTIVE_BATCH_SIZE, device, seq_length=train_dataset.seq_length,
+                      budget_fraction=MEMORY_BUDGET_FRACTION, teacher=teacher, base_model=base_model,
+                      lora=(LORA_RANK, LORA_ALPHA) if FINETUNE else None, **model_config)
+    BATCH_SIZE = plan.micro_batch
+    ACCUMULATION_STEPS = plan.accumulation_steps
+    gradient_checkpointing = plan.gradient_checkpointing
+
 train_loader = DataLoader(train_dataset, batch_size=BATCH_SIZE, shuffle=True)
 val_loader = DataLoader(val_dataset, batch_size=BATCH_SIZE, shuffle=False)
 
-vocab_size = len(train_dataset.stoi)
-
-# gradient checkpointing to save memory
-model = GPT(vocab_size=vocab_size, gradient_checkpointing=True).to(device)
+if FINETUNE:
+    model = base_model
+    model.gradient_checkpointing = gradient_checkpointing
+    trainable = add_lora(model, LORA_RANK, LORA_ALPHA)
+    print(f"Training {sum(p.numel() for p in trainable)} adapter parameters, "
+          f"{sum(p.numel() for p in model.parameters())} in total")
+    optimizer = torch.optim.AdamW(trainable, lr=FINETUNE_LR, weight_decay=0.0)
+else:
+    # gradient checkpointing to save memory
+    model = GPT(vocab_size=vocab_size, gradient_checkpointing=gradient_checkpointing, **model_config).to(device)
+    optimizer = torch.optim.AdamW(model.parameters(), lr=3e-4,
+                                  weight_decay=0.01)  # decay should be changed probs because loss is kinda high
+memory_meter = MemoryMeter(device)
+profiler = StepProfiler(device, start_step=PROFILE_START_STEP, steps=PROFILE_STEPS, trace_file=PROFILE_TRACE_FILE,
+                        enabled=PROFILE)
 
-optimizer = torch.optim.AdamW(model.parameters(), lr=3e-4,
-                              weight_decay=0.01)  # decay should be changed probs because loss is kinda high
 scheduler = torch.optim.lr_scheduler.CosineAnnealingLR(optimizer, T_max=EPOCHS)
 criterion = torch.nn.CrossEntropyLoss(label_smoothing=0.1)
 
@@ -62,6 +160,14 @@ if __name__ == "__main__":
     avg_train_loss = 0.0
     avg_val_loss = 0.0
 
+    teacher_ppl = None
+    if teacher is not None:
+        teacher_ppl = perplexity(teacher, val_loader, device)
+        print(f"Teacher val perplexity: {teacher_ppl:.3f}")
+    if FINETUNE:
+        # the adapters start at zero, so this is the base model on the new corpus
+        print(f"Base val perplexity: {perplexity(model, val_loader, device):.3f}")
+
     for epoch in range(EPOCHS):
         model.train()
         epoch_start = time.time()
@@ -72,33 +178,79 @@ if __name__ == "__main__":
 
         optimizer.zero_grad()
         grad_norm = 0.0
+        # peak memory and throughput of the last optimizer step
+        step_peak = 0
+        step_tokens = 0
+        tokens_per_sec = 0.0
+        memory_meter.reset()
+        step_start = time.time()
+        profiler.mark()
 
         for batch_idx, (x, y) in enumerate(pbar):
-            x = x.to(device)
-            y = y.to(device)
+            profiler.begin_step()
+            with profiler.phase("to_device"):
+                x = x.to(device)
+                y = y.to(device)
+
+            # forward through the whole model, the (checkpointed) transformer and the loss
+            with profiler.phase("forward"):
+                logits = model(x)
+                if teacher is not None:
+                    with torch.no_grad():
+                        teacher_logits = teacher(x)
+                    loss = distillation_loss(logits, teacher_logits, y, criterion, DISTILL_ALPHA,
+                                             DISTILL_TEMPERATURE)
+                else:
+                    loss = criterion(logits.reshape(-1, vocab_size), y.reshape(-1))
 
-            logits = model(x)
-            loss = criterion(logits.reshape(-1, vocab_size), y.reshape(-1))
+                # we scale loss down by ACCUMULATION_STEPS and then we unscale when logging
+                loss = loss / ACCUMULATION_STEPS
 
-            # we scale loss down by ACCUMULATION_STEPS and then we unscale when logging
-            loss = loss / ACCUMULATION_STEPS
-            loss.backward()
-            total_loss += loss.item() * ACCUMULATION_STEPS
+            # with gradient checkpointing this includes recomputing the transformer's activations
+            with profiler.phase("backward"):
+                loss.backward()
+
+            step_tokens += x.numel()
 
             # update weights every ACCUMULATION_STEPS
             if (batch_idx + 1) % ACCUMULATION_STEPS == 0 or (batch_idx + 1) == len(train_loader):
-                grad_norm = compute_grad_norm(model)
-                total_grad_norm += grad_norm
-                # we clip gradients to prevent exploding gradients
-                torch.nn.utils.clip_grad_norm_(model.parameters(), GRADIENT_CLIP)
-                optimizer.step()
-                optimizer.zero_grad()
-
-            # Update progress bar
-            pbar.set_postfix({
-                'loss': f'{loss.item() * ACCUMULATION_STEPS:.4f}',
-                'grad': f'{grad_norm:.4f}' if (batch_idx + 1) % ACCUMULATION_STEPS == 0 else 'acc'
-            })
+                with profiler.phase("grad_norm"):
+                    grad_norm = compute_grad_norm(model)
+                    total_grad_norm += grad_norm
+                with profiler.phase("optimizer"):
+                    # we clip gradients to prevent exploding gradients
+                    torch.nn.utils.clip_grad_norm_(model.parameters(), GRADIENT_CLIP)
+                    optimizer.step()
+                    optimizer.zero_grad()
+
+                memory_meter.synchronize()
+                step_peak = memory_meter.peak()
+                tokens_per_sec = step_tokens / max(time.time() - step_start, 1e-9)
+                step_tokens = 0
+                memory_meter.reset()
+                step_start = time.time()
+
+            # running loss and progress bar, loss.item() is where the cpu waits for the step's device work
+            with profiler.phase("progress"):
+                step_loss = loss.item() * ACCUMULATION_STEPS
+                total_loss += step_loss
+                pbar.set_postfix({
+                    'loss': f'{step_loss:.4f}',
+                    'grad': f'{grad_norm:.4f}' if (batch_idx + 1) % ACCUMULATION_STEPS == 0 else 'acc',
+                    # on mps the meter only knows current usage, not the step's peak
+                    'mem': f'{step_peak / 2 ** 20:.0f}M' + ('' if memory_meter.kind == 'peak' else ' now'),
+                    'tok/s': f'{tokens_per_sec:.0f}'
+                })
+            profiler.end_step(x.numel())
+            if profiler.done:
+                break
+
+        if PROFILE:
+            if profiler.done:
+                break
+            # the window goes on into the next epoch, without validating or saving
+            scheduler.step()
+            continue
 
         avg_train_loss = total_loss / len(train_loader)
 
@@ -118,38 +270,65 @@ if __name__ == "__main__":
         avg_val_loss = val_loss / len(val_loader)
         epoch_time = time.time() - epoch_start
 
-        print(f"Epoch {epoch + 1} completed in {epoch_time:.1f}s.")
+        print(f"Epoch {epoch + 1} completed in {epoch_time:.1f}s "
+              f"({len(train_dataset) * train_dataset.seq_length / epoch_time:.0f} tokens/sec, "
+              f"micro-batch {BATCH_SIZE} x {ACCUMULATION_STEPS}).")
         print(
             f"  Train Loss: {avg_train_loss:.4f} | Val Loss: {avg_val_loss:.4f} | LR: {scheduler.get_last_lr()[0]:.6f}")
+        if FINETUNE:
+            print(f"  Val Perplexity: {perplexity(model, val_loader, device):.3f}")
+        if teacher is not None:
+            print(f"  Val Perplexity: student {perplexity(model, val_loader, device):.3f} | teacher {teacher_ppl:.3f}")
 
         # if validation loss improved, save model
         if avg_val_loss < best_loss:
             best_loss = avg_val_loss
-            torch.save({
-                'epoch': epoch,
-                'model_state': model.state_dict(),
-                'optimizer_state': optimizer.state_dict(),
-                'scheduler_state': scheduler.state_dict(),
-                'train_loss': avg_train_loss,
-                'val_loss': avg_val_loss,
-                'stoi': train_dataset.stoi,
-                'itos': train_dataset.itos
-            }, "omni.pth")
+            if FINETUNE:
+                save_adapter(model, BEST_FILE, train_dataset.itos, base=FINETUNE_BASE)
+            else:
+                torch.save({
+                    'epoch': epoch,
+                    'model_state': model.state_dict(),
+                    'optimizer_state': optimizer.state_dict(),
+                    'scheduler_state': scheduler.state_dict(),
+                    'train_loss': avg_train_loss,
+                    'val_loss': avg_val_loss,
+                    'stoi': train_dataset.stoi,
+                    'itos': train_dataset.itos,
+                    'config': model.config
+                }, BEST_FILE)
             print(f"New best model saved (val_loss: {best_loss:.4f})")
 
         scheduler.step()  # finally update LR
 
+    if PROFILE:
+        # also when training ran out of steps before the window ended
+        pbar.close()
+        profiler.report(PROFILE_SUMMARY_FILE)
+        sys.exit(0)
+
     # save final model
-    torch.save({
-        'epoch': EPOCHS - 1,
-        'model_state': model.state_dict(),
-        'optimizer_state': optimizer.state_dict(),
-        'scheduler_state': scheduler.state_dict(),
-        'train_loss': avg_train_loss,
-        'val_loss': avg_val_loss,
-        'stoi': train_dataset.stoi,
-        'itos': train_dataset.itos
-    }, "omni_s.pth")
+    if FINETUNE:
+        save_adapter(model, FINAL_FILE, train_dataset.itos, base=FINETUNE_BASE)
+    else:
+        torch.save({
+            'epoch': EPOCHS - 1,
+            'model_state': model.state_dict(),
+            'optimizer_state': optimizer.state_dict(),
+            'scheduler_state': scheduler.state_dict(),
+            'train_loss': avg_train_loss,
+            'val_loss': avg_val_loss,
+            'stoi': train_dataset.stoi,
+            'itos': train_dataset.itos,
+            'config': model.config
+        }, FINAL_FILE)
 
     total_time = time.time() - start_time
     print(f"Training completed in {total_time / 60:.2f} minutes.")
+
+    if teacher is not None:
+        # the generation loop on the cpu, where a smaller model matters most
+        student_speed = generation_speed(model, vocab_size)
+        teacher_speed = generation_speed(teacher, vocab_size)
+        print(f"CPU generation: student {student_speed:.1f} tokens/sec | teacher {teacher_speed:.1f} tokens/sec "
+              f"({student_speed / teacher_speed:.2f}x)")
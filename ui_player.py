@@ -1,25 +1,40 @@
+import multiprocessing
+import os
 import sys
-from queue import Queue
+import threading
 
-from PyQt6.QtCore import Qt, pyqtSignal, QObject
-from PyQt6.QtGui import QFont, QTextCharFormat, QColor
+from PyQt6.QtCore import Qt, pyqtSignal, QObject, QTimer
+from PyQt6.QtGui import QFont, QTextCharFormat, QColor, QTextCursor
 from PyQt6.QtWidgets import (
     QApplication, QMainWindow, QWidget, QVBoxLayout, QHBoxLayout,
-    QLabel, QSlider, QPushButton, QTextEdit, QGroupBox, QStatusBar
+    QLabel, QSlider, QPushButton, QTextEdit, QGroupBox, QStatusBar, QFileDialog
 )
 
 from audio_player import AudioManager
+from audio_stream import StreamingAudioManager
 from constants import DEFAULT_TEMPERATURE, DEFAULT_TOP_P, MAX_GENERATION_LENGTH, HARP_SLOWDOWN, CHORD_SLOWDOWN, \
-    INITIAL_PROMPT
+    INITIAL_PROMPT, INFERENCE_IN_SUBPROCESS, DISPLAY_REFRESH_MS, PARAMS_DEBOUNCE_MS, SESSION_FILE, TRACE_ENABLED, TRACE_FILE, \
+    AUDIO_STREAMING, CONTINUATION_POOL
+from continuation_pool import get_pool, pool_key
+from cpu_governor import get_governor
+from infer import get_engine, set_engine, use_vocabulary_only
+from inference_worker import get_inference_worker, set_inference_worker
+from lookahead import Chunk, LookaheadBuffer
+from metrics import metrics
 from prompt_manager import PromptManager
-from threads import GenerationThread, PlaybackThread
+from sound_bank import get_sound_bank
+from threads import GenerationThread, PlaybackThread, ReloadThread, PoolFillThread
+from tracing import tracer
 from ui.dialogues import Dialogues
 from util import chord_token_to_human
 
 
 class GenerationSignals(QObject):
     status_update = pyqtSignal(str)
-    token_playing = pyqtSignal(int)  # index, token
+    sequence_started = pyqtSignal(int, object)  # serial, events
+    engine_loaded = pyqtSignal(object, object)  # engine, its inference worker or None
+    engine_failed = pyqtSignal(str)
+    engine_swapped = pyqtSignal(str)  # checkpoint path
 
 
 class MusicGeneratorWindow(QMainWindow):
@@ -32,20 +47,82 @@ class MusicGeneratorWindow(QMainWindow):
         self.is_playing = False
         self.current_token_index = 0
         self.currently_playing_tokens = []
-        self.generation_queue = Queue()
+        # (serial, index, event) of the note playing right now, written by the playback thread.
+        # the refresh timer picks it up at most once per frame instead of reacting to every note
+        self.playing_position = None
+        self._shown_position = None
+        self._rendered_serial = None
+        self._token_ranges = []
+        self._highlighted = None
+        # generated chunks waiting to be played, bounded by seconds of audio
+        self.lookahead = LookaheadBuffer(self.current_slowdowns, on_take=self.on_chunk_taken,
+                                         on_cut=self.on_chunk_cut)
 
         self.playback_thread = None
         self.generation_thread = None
+        self.pool_fill_thread = None
+        # (engine, worker) loaded in the background, waiting for the generation thread to switch to it
+        self._pending_engine = None
+        self._engine_lock = threading.Lock()
 
         self.signals = GenerationSignals()
         self.signals.status_update.connect(self.update_status)
-        self.signals.token_playing.connect(self.update_current_token)
+        self.signals.sequence_started.connect(self.render_sequence)
+        self.signals.engine_loaded.connect(self.on_engine_loaded)
+        self.signals.engine_failed.connect(self.on_engine_failed)
+        self.signals.engine_swapped.connect(self.on_engine_swapped)
 
         self.dialogues = Dialogues(self)
-        self.prompt_manager = PromptManager()
+        if INFERENCE_IN_SUBPROCESS:
+            # the worker process holds the model, this one only maps ids to tokens
+            use_vocabulary_only()
+        engine = get_engine()
+        self.prompt_manager = PromptManager(engine.encode(INITIAL_PROMPT))
+        # pick up where the last session left off
+        self.session_restored = self.prompt_manager.restore(SESSION_FILE, engine.events.fingerprint)
+
+        # decode the sound bank in the background so Start does not have to
+        get_sound_bank().preload()
+        if INFERENCE_IN_SUBPROCESS:
+            # the worker loads its own copy of the model, start it now rather than on the first Start
+            threading.Thread(target=get_inference_worker, daemon=True).start()
+        else:
+            # calibrate the inference thread count in the background, a Start meanwhile uses the provisional count
+            threading.Thread(target=get_governor().configure, args=(engine.model, engine.vocab_size),
+                             daemon=True).start()
+
+        self.normal_format = QTextCharFormat()
+        self.normal_format.setForeground(QColor("#FFFFFF"))
+        self.normal_format.setFontWeight(QFont.Weight.Normal)
+
+        self.highlight_format = QTextCharFormat()
+        self.highlight_format.setForeground(QColor("#007AFF"))  # mac blue
+        self.highlight_format.setFontWeight(QFont.Weight.Bold)
 
         self.init_ui()
 
+        if TRACE_ENABLED:
+            tracer.start()
+            # everything replay.py needs to replay the session without the model
+            tracer.event("session.start",
+                         vocab=[e.token if e is not None else None for e in engine.events.events],
+                         prompt=[int(i) for i in self.prompt_manager.get_prompt()],
+                         slowdowns=self.current_slowdowns(), max_len=self.max_len_slider.value())
+
+        if CONTINUATION_POOL:
+            self.pool_fill_thread = PoolFillThread(self)
+            self.pool_fill_thread.start()
+
+        self.display_timer = QTimer(self)
+        self.display_timer.setInterval(DISPLAY_REFRESH_MS)
+        self.display_timer.timeout.connect(self.refresh_display)
+        self.display_timer.start()
+
+        if self.session_restored:
+            last_tokens = engine.events.lookup(self.prompt_manager.tail(4).tolist())
+            self.prompt_display.setPlainText(
+                f"Resumed session ({len(self.prompt_manager)} tokens): " + ", ".join(e.label for e in last_tokens))
+
     # https://www.pythonguis.com/pyqt6-tutorial/
     def init_ui(self):
         central_widget = QWidget()
@@ -70,6 +147,12 @@ class MusicGeneratorWindow(QMainWindow):
         layout = QVBoxLayout()
         layout.setSpacing(15)
 
+        # the sampling sliders update their labels on every tick, but invalidate once they settle
+        self.params_timer = QTimer(self)
+        self.params_timer.setSingleShot(True)
+        self.params_timer.setInterval(PARAMS_DEBOUNCE_MS)
+        self.params_timer.timeout.connect(self.on_generation_params_changed)
+
         # Temperature slider
         self.temp_label = QLabel(f"Temperature: {DEFAULT_TEMPERATURE:.2f}")
         self.temp_slider = QSlider(Qt.Orientation.Horizontal)
@@ -79,6 +162,7 @@ class MusicGeneratorWindow(QMainWindow):
         self.temp_slider.setTickPosition(QSlider.TickPosition.TicksBelow)
         self.temp_slider.setTickInterval(20)
         self.temp_slider.valueChanged.connect(lambda v: self.temp_label.setText(f"Temperature: {v / 100:.2f}"))
+        self.temp_slider.valueChanged.connect(lambda _: self.params_timer.start())
         layout.addWidget(self.temp_label)
         layout.addWidget(self.temp_slider)
 
@@ -91,6 +175,7 @@ class MusicGeneratorWindow(QMainWindow):
         self.top_p_slider.setTickPosition(QSlider.TickPosition.TicksBelow)
         self.top_p_slider.setTickInterval(10)
         self.top_p_slider.valueChanged.connect(lambda v: self.top_p_label.setText(f"Top-p: {v / 100:.2f}"))
+        self.top_p_slider.valueChanged.connect(lambda _: self.params_timer.start())
         layout.addWidget(self.top_p_label)
         layout.addWidget(self.top_p_slider)
 
@@ -104,6 +189,7 @@ class MusicGeneratorWindow(QMainWindow):
         self.max_len_slider.setTickPosition(QSlider.TickPosition.TicksBelow)
         self.max_len_slider.setTickInterval(64)
         self.max_len_slider.valueChanged.connect(lambda v: self.max_len_label.setText(f"Max Length: {v}"))
+        self.max_len_slider.valueChanged.connect(lambda _: self.params_timer.start())
         layout.addWidget(self.max_len_label)
         layout.addWidget(self.max_len_slider)
 
@@ -155,6 +241,11 @@ class MusicGeneratorWindow(QMainWindow):
         self.clear_button.clicked.connect(self.clear_history)
         layout.addWidget(self.clear_button)
 
+        self.load_model_button = QPushButton("Load Model...")
+        self.load_model_button.setMinimumHeight(32)
+        self.load_model_button.clicked.connect(self.load_model)
+        layout.addWidget(self.load_model_button)
+
         self.info_button = QPushButton("Information")
         self.info_button.setMinimumHeight(32)
         self.info_button.clicked.connect(self.dialogues.show_about_dialog)
@@ -204,6 +295,81 @@ class MusicGeneratorWindow(QMainWindow):
         if self.audio:
             self.audio.slow_down_harp = multiplier
 
+    def current_slowdowns(self):
+        return self.chord_slowdown_slider.value() / 100.0, self.harp_slowdown_slider.value() / 100.0
+
+    def on_chunk_taken(self, chunk):
+        """Playback just took a chunk from the look-ahead, so it becomes part of the history"""
+        self.prompt_manager.append_to_history(chunk.ids)
+
+    def on_chunk_cut(self, chunk, played):
+        """A chunk was cut short, so its unplayed tokens never made it into the music"""
+        self.prompt_manager.drop_last(len(chunk.ids) - played)
+
+    def on_generation_params_changed(self):
+        """Sampling sliders settled: drop the look-ahead made with the old values and regenerate from here"""
+        self.lookahead.invalidate()
+        if self.generation_thread is not None:
+            self.generation_thread.cancel()
+
+    def load_model(self):
+        """Loads another checkpoint in the background, playback goes on with the current one meanwhile"""
+        path, _ = QFileDialog.getOpenFileName(self, "Load Model", "", "Checkpoints (*.pth)")
+        if not path:
+            return
+
+        self.load_model_button.setEnabled(False)
+        self.signals.status_update.emit(f"Loading {os.path.basename(path)}...")
+        ReloadThread(self, path).start()
+
+    def on_engine_loaded(self, engine, worker):
+        with self._engine_lock:
+            self._pending_engine = (engine, worker)
+        if self.is_playing:
+            self.signals.status_update.emit(f"Switching to {os.path.basename(engine.path)} after this chunk...")
+        else:
+            # nothing is generating, switch right away
+            self.apply_pending_engine()
+
+    def on_engine_failed(self, message):
+        self.load_model_button.setEnabled(True)
+        self.signals.status_update.emit(message)
+
+    def on_engine_swapped(self, path):
+        self.load_model_button.setEnabled(True)
+        self.signals.status_update.emit(f"Now playing {os.path.basename(path)}")
+
+    def apply_pending_engine(self):
+        """
+        Switches to the model loaded in the background, if any. Runs between two generation chunks, or on Stop:
+        the history and the queued chunks move to the new vocabulary, and the old weights are released
+        """
+        with self._engine_lock:
+            pending, self._pending_engine = self._pending_engine, None
+        if pending is None:
+            return
+
+        engine, worker = pending
+        old = get_engine()
+        remap = engine.remapper(old)
+        if remap is not None:
+            # ReloadThread made sure the new vocabulary encodes some of the initial prompt
+            self.lookahead.remap(remap, self.prompt_manager, engine.encode(INITIAL_PROMPT))
+        set_engine(engine)
+        if worker is not None:
+            # the old worker is idle between chunks, it shuts down off this thread
+            threading.Thread(target=set_inference_worker(worker).close, daemon=True).start()
+        old.release()
+        if self.pool_fill_thread is not None:
+            # whatever it is making comes from the old model, it starts over with the new one
+            self.pool_fill_thread.pause()
+
+        # ids after this point belong to the new vocabulary, replay.py needs it
+        tracer.event("engine.swap", path=engine.path,
+                     vocab=[e.token if e is not None else None for e in engine.events.events])
+        metrics.set("engine.path", engine.path)
+        self.signals.engine_swapped.emit(engine.path)
+
     def start_generation(self):
         """Start the infinite generation and playback loop"""
         if self.is_playing:
@@ -212,13 +378,19 @@ class MusicGeneratorWindow(QMainWindow):
         if self.audio is None:
             chord_slowdown = self.chord_slowdown_slider.value() / 100.0
             harp_slowdown = self.harp_slowdown_slider.value() / 100.0
-            self.audio = AudioManager(
+            # pre-mixed chunks on a single channel, or one mixer channel per note
+            audio_class = StreamingAudioManager if AUDIO_STREAMING else AudioManager
+            self.audio = audio_class(
                 window=self,
                 slow_down_chord=chord_slowdown,
                 slow_down_harp=harp_slowdown
             )
 
         self.is_playing = True
+        tracer.event("ui.start")
+        if self.pool_fill_thread is not None:
+            self.pool_fill_thread.pause()
+            self.play_from_pool()
         self.start_button.setEnabled(False)
         self.stop_button.setEnabled(True)
         self.signals.status_update.emit("Starting generation...")
@@ -230,6 +402,21 @@ class MusicGeneratorWindow(QMainWindow):
         self.generation_thread.start()
         self.playback_thread.start()
 
+    def play_from_pool(self):
+        """Queues a pre-generated continuation of the current prompt, so playback starts without waiting"""
+        engine = get_engine()
+        prompt = [int(i) for i in self.prompt_manager.get_prompt()]
+        key = pool_key(engine.identity, prompt, self.temp_slider.value() / 100.0,
+                       self.top_p_slider.value() / 100.0)
+        ids = get_pool().take(key)
+        if ids is not None and max(ids) >= len(engine.events):
+            # a damaged file
+            ids = None
+        tracer.event("pool.take", hit=ids is not None)
+        if ids is not None:
+            # live generation continues from the tail of this chunk
+            self.lookahead.put(Chunk(ids, engine.events.lookup(ids), self.lookahead.version))
+
     def stop_generation(self):
         """Stop generation and playback"""
         self.is_playing = False
@@ -245,13 +432,18 @@ class MusicGeneratorWindow(QMainWindow):
         self.start_button.setEnabled(True)
         self.stop_button.setEnabled(False)
         self.signals.status_update.emit("Stopped")
+        # a model loaded during playback was waiting for the next chunk, which is not coming now
+        self.apply_pending_engine()
 
     def clear_history(self):
         """Clear token history"""
         self.current_display.clear()
+        self._rendered_serial = None
+        self._token_ranges = []
+        self._highlighted = None
         self.prompt_manager.clear()
         self.prompt_display.setPlainText(chord_token_to_human(INITIAL_PROMPT))
-        self.generation_queue = Queue()
+        self.lookahead.clear()
         self.current_token_index = 0
         self.currently_playing_tokens = []
         self.signals.status_update.emit("History cleared")
@@ -259,35 +451,78 @@ class MusicGeneratorWindow(QMainWindow):
     def update_status(self, message):
         self.status_bar.showMessage(message)
 
-    def update_current_token(self, index):
-        """Highlight current token being played"""
-        self.current_token_index = index
-
-        tokens = self.currently_playing_tokens
+    def render_sequence(self, serial, events):
+        """Writes a new sequence into the view once; after this only the highlight moves"""
         self.current_display.clear()
 
-        cursor = self.current_display.textCursor()
+        # one insert for the whole sequence, remembering where each token landed
+        ranges = []
+        position = 0
+        for event in events:
+            ranges.append((position, position + len(event.token)))
+            position += len(event.token) + 1
 
-        normal_format = QTextCharFormat()
-        normal_format.setForeground(QColor("#FFFFFF"))
+        cursor = self.current_display.textCursor()
+        cursor.setCharFormat(self.normal_format)
+        cursor.insertText("".join(event.token + " " for event in events))
+
+        self._token_ranges = ranges
+        self._rendered_serial = serial
+        self._highlighted = None
+        tracer.event("ui.render", serial=serial, tokens=len(events))
+
+    def _format_token(self, index, char_format):
+        start, end = self._token_ranges[index]
+        cursor = QTextCursor(self.current_display.document())
+        cursor.setPosition(start)
+        cursor.setPosition(end, QTextCursor.MoveMode.KeepAnchor)
+        cursor.setCharFormat(char_format)
+
+    def refresh_display(self):
+        """Runs once per frame: moves the highlight and status to the latest note, if it changed"""
+        position = self.playing_position
+        if position is None or position is self._shown_position:
+            return
 
-        highlight_format = QTextCharFormat()
-        highlight_format.setForeground(QColor("#007AFF"))  # mac blue
-        highlight_format.setFontWeight(QFont.Weight.Bold)
+        serial, index, event = position
+        if serial != self._rendered_serial or index >= len(self._token_ranges):
+            # the sequence_started signal for it has not been handled yet
+            return
+        self._shown_position = position
 
-        for i, tok in enumerate(tokens):
-            if i == index:
-                cursor.setCharFormat(highlight_format)
-            else:
-                cursor.setCharFormat(normal_format)
+        self.current_token_index = index
+        # only the previous and the current token are touched, whatever the sequence length
+        if self._highlighted is not None:
+            self._format_token(self._highlighted, self.normal_format)
+        self._format_token(index, self.highlight_format)
+        self._highlighted = index
+        tracer.event("ui.refresh", serial=serial, index=index)
 
-            cursor.insertText(tok + " ")
+        self.status_bar.showMessage(f"Playing {event.label}")
 
     def closeEvent(self, event):
         """Handle window close"""
         self.stop_generation()
+        if self.pool_fill_thread is not None:
+            self.pool_fill_thread.stop()
         if self.audio:
             self.audio.stop_all()
+        with self._engine_lock:
+            pending, self._pending_engine = self._pending_engine, None
+        if pending is not None and pending[1] is not None:
+            # a model that was loaded but never switched to still has its worker process running
+            pending[1].close()
+        # a lazy bank only completes its cache once every chord was used, keep what this session decoded
+        get_sound_bank().save_cache()
+        try:
+            self.prompt_manager.save(SESSION_FILE, get_engine().events.fingerprint)
+        except OSError as e:
+            print(f"Could not save session: {e}")
+        if tracer.enabled:
+            try:
+                tracer.save(TRACE_FILE)
+            except OSError as e:
+                print(f"Could not save trace: {e}")
         event.accept()
 
 
@@ -306,4 +541,6 @@ def main():
 
 
 if __name__ == "__main__":
+    # needed for the inference worker process in frozen (PyInstaller) builds
+    multiprocessing.freeze_support()
     main()
@@ -1,3 +1,4 @@
+import hashlib
 import sys
 from os import path
 
@@ -12,6 +13,11 @@ def make_path(paths):
         return paths
 
 
+def vocab_fingerprint(itos):
+    """Identifies a vocabulary, so ids (sessions, adapters) are never read back with another one"""
+    return hashlib.sha1("\n".join(itos[i] for i in sorted(itos)).encode()).hexdigest()
+
+
 def chord_token_to_human(txt):
     """Transforms chords like c_200 into C Major, am into A Minor, c7 into C Seventh, etc"""
     if txt.startswith('H'):
@@ -47,13 +53,3 @@ def chord_token_to_human(txt):
                 quality = "Seventh"
 
     return f"{root} {quality}"
-
-
-def count_chords(tokens):
-    chords = 0
-
-    for token in tokens:
-        if not token.startswith("H"):
-            chords += 1
-
-    return chords